@@ -80,6 +80,16 @@ class Backend(log.Loggable, Plugin):
 class BackendStore(Backend):
 
     """ the base class for all MediaServer backend stores
+
+        a store able to search faster than walking through all its
+        items can have a
+
+        search_items(self, container, expression)
+
+        method, that gets the BackendItem to search below and the
+        parsed SearchCriteria from coherence.upnp.core.search_criteria,
+        and returns a list of the matching BackendItems, a Deferred,
+        or None to have the ContentDirectoryServer search on its own
     """
 
     logCategory = 'backend_store'
@@ -132,6 +142,39 @@ class BackendStore(Backend):
         """
         pass
 
+    def content_changed(self, container=None, change=None, item=None):
+        """ to be called after a change of the content and an
+            increase of self.update_id
+
+            container is the BackendItem whose children changed, if
+            any, change one of 'add', 'modify' or 'remove' for the
+            BackendItem item, to tell clients what exactly changed
+        """
+        cds = getattr(self.server, 'content_directory_server', None)
+        if cds is None:
+            return
+        if change is not None and item is not None:
+            cds.record_change(change, item, self.update_id)
+        else:
+            cds.record_unknown_change(self.update_id)
+        value = None
+        if container is not None:
+            value = (container.get_id(), container.get_update_id())
+        cds.content_changed(self.update_id, value)
+
+    def begin_changes(self):
+        """ hold back the updates of content_changed until
+            end_changes, for changes in bulk
+        """
+        cds = getattr(self.server, 'content_directory_server', None)
+        if cds is not None:
+            cds.begin_changes()
+
+    def end_changes(self):
+        cds = getattr(self.server, 'content_directory_server', None)
+        if cds is not None:
+            cds.end_changes()
+
     def _get_all_items(self, id):
         """ a helper method to get all items as a response
             to some XBox 360 UPnP Search action
@@ -188,6 +231,18 @@ class BackendStore(Backend):
 class BackendItem(log.Loggable):
 
     """ the base class for all MediaServer backend items
+
+        a container able to hand out the DIDLLite objects of its
+        children in one go can have a
+
+        get_children_items(self, start=0, request_count=0)
+
+        method, returning a tuple of the DIDLLite objects of the
+        children[start:start + request_count], or of all after start
+        if request_count is 0, and the number of all its children,
+        or a Deferred firing with that tuple. The ContentDirectoryServer
+        uses it instead of get_children, get_child_count and
+        get_item for every child.
     """
 
     logCategory = 'backend_item'
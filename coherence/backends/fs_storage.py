@@ -392,6 +392,13 @@ class FSItem(BackendItem):
     def get_child_count(self):
         return self.child_count
 
+    def get_children_items(self, start=0, request_count=0):
+        if request_count == 0:
+            children = self.get_children(start)
+        else:
+            children = self.get_children(start, start + request_count)
+        return [child.get_item() for child in children], self.child_count
+
     def get_id(self):
         return self.id
 
@@ -643,6 +650,13 @@ class FSStore(BackendStore):
 
     def walk(self, path, parent=None, ignore_file_pattern=''):
         self.debug("walk %r", path)
+        self.begin_changes()
+        try:
+            self._walk(path, parent, ignore_file_pattern)
+        finally:
+            self.end_changes()
+
+    def _walk(self, path, parent, ignore_file_pattern):
         containers = []
         parent = self.append(path, parent)
         if parent != None:
@@ -679,15 +693,7 @@ class FSStore(BackendStore):
         self.store[id] = FSItem(id, parent, path, mimetype, self.urlbase, UPnPClass, update=True, store=self)
         if hasattr(self, 'update_id'):
             self.update_id += 1
-            #print self.update_id
-            if self.server:
-                if hasattr(self.server, 'content_directory_server'):
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-            if parent is not None:
-                value = (parent.get_id(), parent.get_update_id())
-                if self.server:
-                    if hasattr(self.server, 'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+            self.content_changed(parent, 'add', self.store[id])
 
         return id
 
@@ -733,12 +739,7 @@ class FSStore(BackendStore):
             del self.store[id]
             if hasattr(self, 'update_id'):
                 self.update_id += 1
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                #value = '%d,%d' % (parent.get_id(),parent_get_update_id())
-                value = (parent.get_id(), parent.get_update_id())
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+                self.content_changed(parent, 'remove', item)
 
         except:
             pass
@@ -852,14 +853,7 @@ class FSStore(BackendStore):
             item.rebuild(self.urlbase)
             if hasattr(self, 'update_id'):
                 self.update_id += 1
-                if self.server:
-                    if hasattr(self.server, 'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                if item.parent is not None:
-                    value = (item.parent.get_id(), item.parent.get_update_id())
-                    if self.server:
-                        if hasattr(self.server, 'content_directory_server'):
-                            self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+                self.content_changed(item.parent, 'modify', item)
 
         def gotError(error, url):
             self.warning("error requesting %s", url)
@@ -11,6 +11,7 @@ from twisted.python import failure
 
 from coherence.upnp.core.soap_service import errorCode
 from coherence.upnp.core import DIDLLite
+from coherence.upnp.core.action import PRIORITY_BACKGROUND
 
 import string
 import os
@@ -823,7 +824,10 @@ class GStreamerPlayer(log.Loggable, Plugin):
                             self.info("got %d out of %d", number_returned, total_matches)
                             self.info("requesting more starting now at %d", starting_index + number_returned)
                             self.playcontainer[4]['StartingIndex'] = str(starting_index + number_returned)
-                            d = self.playcontainer[3].call(**self.playcontainer[4])
+                            # fetching the rest of the container must not
+                            # delay the calls of controlling the playback
+                            d = self.playcontainer[3].call(priority=PRIORITY_BACKGROUND,
+                                                           **self.playcontainer[4])
                             d.addCallback(handle_reply, starting_index + number_returned)
                             d.addErrback(handle_error)
                     except:
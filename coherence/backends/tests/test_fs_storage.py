@@ -120,3 +120,15 @@ class TestFSStorage(unittest.TestCase):
                          'audio')
         self.assertEqual(self.storage.get_by_id('1005').get_name(),
                          'album-1')
+
+    def test_ChildrenItems(self):
+        content = self.storage.get_by_id('1001')
+        items, total = content.get_children_items(0, 0)
+        self.assertEqual(total, 3)
+        self.assertEqual([i.title for i in items],
+                         [c.get_item().title
+                          for c in content.get_children(0, 0)])
+        items, total = content.get_children_items(1, 1)
+        self.assertEqual(total, 3)
+        self.assertEqual([i.title for i in items],
+                         [content.get_children(0, 0)[1].get_item().title])
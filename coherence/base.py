@@ -25,6 +25,9 @@ from coherence import log
 from coherence.upnp.core.ssdp import SSDPServer
 from coherence.upnp.core.msearch import MSearch
 from coherence.upnp.core.device import Device, RootDevice
+from coherence.upnp.core import description_cache
+from coherence.upnp.core import soap_proxy
+from coherence.upnp.core import action
 from coherence.upnp.core.utils import parse_xml, get_ip_address, get_host_address
 
 from coherence.upnp.core.utils import Site
@@ -242,6 +245,11 @@ class Coherence(log.Loggable):
         self.mirabeau = None
 
         self.devices = []
+        # indexes of self.devices, each key -> list of devices
+        self._devices_by_usn = {}
+        self._devices_by_udn = {}
+        self._devices_by_uuid = {}  # the UDN without the uuid: prefix
+        self._devices_by_host = {}
         self.children = {}
         self._callbacks = {}
         self.active_backends = {}
@@ -292,8 +300,18 @@ class Coherence(log.Loggable):
 
         self.warning("Coherence UPnP framework version %s starting...", __version__)
 
+        # the addresses of all interfaces to serve, if several
+        self.hostnames = []
+        self.network_interfaces = []
+        self._network_addresses = None
+        self.network_check = None
         if network_if:
-            self.hostname = get_ip_address('%s' % network_if)
+            if isinstance(network_if, basestring):
+                network_if = network_if.split(',')
+            network_if = [i.strip() for i in network_if if i.strip()]
+            self.network_interfaces = network_if
+            self.hostnames = [get_ip_address('%s' % i) for i in network_if]
+            self.hostname = self.hostnames[0]
         else:
             try:
                 self.hostname = socket.gethostbyname(socket.gethostname())
@@ -324,16 +342,57 @@ class Coherence(log.Loggable):
         else:
             unittest = True
 
-        self.ssdp_server = SSDPServer(test=unittest, interface=self.hostname)
+        if len(self.hostnames) > 1:
+            self.info('serving the interfaces %s', ', '.join(self.hostnames))
+            interface = self.hostnames
+        else:
+            interface = self.hostname
+        cache_path = self.config.get('description_cache')
+        if cache_path:
+            try:
+                description_cache.set_cache(
+                    description_cache.DescriptionCache(cache_path))
+            except OSError as e:
+                self.warning("can't use description cache %s: %s", cache_path, e)
+        self.setup_action_call_policies(self.config.get('action_call_cache'))
+        max_concurrency = int(self.config.get('action_max_concurrency', 4))
+        if max_concurrency > 0:
+            action.set_scheduler(action.CallScheduler(
+                max_limit=max_concurrency,
+                latency_target=float(self.config.get('action_latency_target', 2.0))))
+        else:
+            action.set_scheduler(None)
+        if (self.config.get('soap_keep_alive', 'yes') == 'yes' and
+            soap_proxy.HTTPConnectionPool is not None):
+            # the CallScheduler limits the calls per device, if at all,
+            # the pool just keeps a connection for each of them
+            soap_proxy.set_pool(soap_proxy.ConnectionPool(
+                max_per_host=max_concurrency or 2,
+                idle_timeout=int(self.config.get('soap_idle_timeout', 30)),
+                limit_per_host=False))
+
+        self.ssdp_server = SSDPServer(test=unittest, interface=interface,
+            response_rate=int(self.config.get('ssdp_response_rate', 100)),
+            announce_window=int(self.config.get('ssdp_announce_window', 10)),
+            announce_budget=int(self.config.get('ssdp_announce_budget', 10)))
         louie.connect(self.create_device, 'Coherence.UPnP.SSDP.new_device', louie.Any)
         louie.connect(self.remove_device, 'Coherence.UPnP.SSDP.removed_device', louie.Any)
         louie.connect(self.add_device, 'Coherence.UPnP.RootDevice.detection_completed', louie.Any)
+        louie.connect(self.redetect_device, 'Coherence.UPnP.RootDevice.description_changed', louie.Any)
         #louie.connect( self.receiver, 'Coherence.UPnP.Service.detection_completed', louie.Any)
 
         self.ssdp_server.subscribe("new_device", self.add_device)
         self.ssdp_server.subscribe("removed_device", self.remove_device)
 
-        self.msearch = MSearch(self.ssdp_server, test=unittest)
+        self.msearch = MSearch(self.ssdp_server, test=unittest,
+            mx=int(self.config.get('msearch_mx', 5)),
+            interval=int(self.config.get('msearch_interval', 120)),
+            max_interval=int(self.config.get('msearch_max_interval', 1800)),
+            interfaces=self.hostnames)
+        network_check_interval = int(self.config.get('network_check_interval', 30))
+        if network_check_interval > 0 and not unittest:
+            self.network_check = task.LoopingCall(self.check_network)
+            self.network_check.start(network_check_interval)
 
         reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown, force=True)
 
@@ -521,6 +580,27 @@ class Coherence(log.Loggable):
         #print kwargs
         pass
 
+    def setup_action_call_policies(self, policies):
+        """ set up merging and caching of action calls from entries
+            like 'AVTransport/GetPositionInfo:1', service type and
+            action name, with the seconds to cache the results
+        """
+        if not policies:
+            return
+        if isinstance(policies, basestring):
+            policies = policies.split(',')
+        for policy in policies:
+            policy = policy.strip()
+            if not policy:
+                continue
+            try:
+                name, ttl = policy.rsplit(':', 1)
+                service_type, action_name = name.rsplit('/', 1)
+                action.set_call_policy(service_type, action_name, float(ttl))
+            except ValueError:
+                self.warning("ignoring invalid action_call_cache entry %r",
+                             policy)
+
     def shutdown(self, force=False):
         if force == True:
             self._incarnations_ = 1
@@ -537,10 +617,17 @@ class Coherence(log.Loggable):
             louie.disconnect(self.add_device,
                              'Coherence.UPnP.RootDevice.detection_completed',
                              louie.Any)
+            louie.disconnect(self.redetect_device,
+                             'Coherence.UPnP.RootDevice.description_changed',
+                             louie.Any)
             self.ssdp_server.shutdown()
             if self.ctrl:
                 self.ctrl.shutdown()
             self.warning('Coherence UPnP framework shutdown')
+            pool = soap_proxy.get_pool()
+            if pool is not None:
+                soap_proxy.set_pool(None)
+                return pool.close().addCallback(lambda _: result)
             return result
 
         def _shutdown():
@@ -561,6 +648,8 @@ class Coherence(log.Loggable):
             except:
                 # :fixme: this may leave some loops running
                 pass
+            if self.network_check is not None and self.network_check.running:
+                self.network_check.stop()
             self.msearch.stopDiscovery()
             self.ssdp_server.stopNotifying()
             l = []
@@ -583,6 +672,47 @@ class Coherence(log.Loggable):
         else:
             return _shutdown()
 
+    def network_addresses(self):
+        """ the current addresses of the interfaces we serve,
+            or of the one with the default route, as a Deferred
+        """
+        if self.network_interfaces:
+
+            def addresses():
+                result = []
+                for interface in self.network_interfaces:
+                    try:
+                        result.append(get_ip_address(interface))
+                    except (IOError, KeyError, ValueError):
+                        result.append(None)
+                return result
+            return defer.maybeDeferred(addresses)
+        d = defer.maybeDeferred(get_host_address)
+        d.addCallback(lambda address: [address])
+        return d
+
+    def check_network(self):
+        """ search for devices at once when an address changed,
+            like after moving to another network
+        """
+
+        def compare(addresses):
+            if(self._network_addresses is not None and
+               addresses != self._network_addresses):
+                self.info('network addresses changed to %s', addresses)
+                louie.send('Coherence.UPnP.Network.changed', None,
+                           addresses=addresses)
+                self.msearch.network_changed()
+            self._network_addresses = addresses
+
+        def failed(f):
+            self.debug("can't check the network addresses: %s",
+                       f.getErrorMessage())
+
+        d = self.network_addresses()
+        d.addCallbacks(compare, failed)
+        return d
+
     def check_devices(self):
         """ iterate over devices and their embedded ones and renew subscriptions """
         for root_device in self.get_devices():
@@ -603,31 +733,44 @@ class Coherence(log.Loggable):
         for callback in self._callbacks.get(name, []):
             callback(*args)
 
+    def _device_indexes(self, device):
+        udn = device.get_id()
+        yield self._devices_by_usn, device.get_usn()
+        if udn is not None:
+            yield self._devices_by_udn, udn
+            yield self._devices_by_uuid, udn[5:]
+        yield self._devices_by_host, device.get_host()
+
+    def _index_device(self, device):
+        for index, key in self._device_indexes(device):
+            index.setdefault(key, []).append(device)
+
+    def _unindex_device(self, device):
+        for index, key in self._device_indexes(device):
+            devices = index.get(key, [])
+            if device in devices:
+                devices.remove(device)
+                if not devices:
+                    del index[key]
+
     def get_device_by_host(self, host):
-        found = []
-        for device in self.devices:
-            if device.get_host() == host:
-                found.append(device)
-        return found
+        return list(self._devices_by_host.get(host, []))
 
     def get_device_with_usn(self, usn):
-        found = None
-        for device in self.devices:
-            if device.get_usn() == usn:
-                found = device
-                break
-        return found
+        try:
+            return self._devices_by_usn[usn][0]
+        except KeyError:
+            return None
 
     def get_device_with_id(self, device_id):
-        found = None
-        for device in self.devices:
-            id = device.get_id()
-            if device_id[:5] != 'uuid:':
-                id = id[5:]
-            if id == device_id:
-                found = device
-                break
-        return found
+        if device_id[:5] != 'uuid:':
+            index = self._devices_by_uuid
+        else:
+            index = self._devices_by_udn
+        try:
+            return index[device_id][0]
+        except KeyError:
+            return None
 
     def get_devices(self):
         return self.devices
@@ -656,6 +799,7 @@ class Coherence(log.Loggable):
     def add_device(self, device):
         self.info("adding device %s %s %s", device.get_id(), device.get_usn(), device.friendly_device_type)
         self.devices.append(device)
+        self._index_device(device)
 
     def remove_device(self, device_type, infos):
         self.info("removed device %s %s", infos['ST'], infos['USN'])
@@ -663,11 +807,21 @@ class Coherence(log.Loggable):
         if device:
             louie.send('Coherence.UPnP.Device.removed', None, usn=infos['USN'])
             self.devices.remove(device)
+            self._unindex_device(device)
             device.remove()
             if infos['ST'] == 'upnp:rootdevice':
                 louie.send('Coherence.UPnP.RootDevice.removed', None, usn=infos['USN'])
                 self.callback("removed_device", infos['ST'], infos['USN'])
 
+    def redetect_device(self, device):
+        """ re-create a remote device whose description was taken
+            from the cache, but has changed meanwhile """
+        if device not in self.devices:
+            return
+        infos = device.infos
+        self.remove_device(infos['ST'], infos)
+        self.create_device(infos['ST'], infos)
+
     def add_web_resource(self, name, sub):
         self.children[name] = sub
 
@@ -88,6 +88,44 @@ def namespace_map_update(namespaces):
 class ElementInterface(elementtree.ElementTree._ElementInterface): pass
 
 
+def fragment_tostring(elem, encoding='utf-8'):
+    """ serialize elem like tostring, but without namespace declarations
+
+        Returns the string and the {uri: prefix} map of the namespaces
+        it uses, to be declared by an enclosing element. Returns None
+        as the string if elem uses namespaces without a registered
+        prefix, or if this ElementTree can't serialize fragments.
+    """
+    module = elementtree.ElementTree
+    if not hasattr(module, '_serialize_xml'):
+        return None, {}
+    qnames, namespaces = module._namespaces(elem, encoding)
+    for uri in namespaces:
+        if uri not in module._namespace_map:
+            # the generated ns0, ns1... prefixes are only unique
+            # within one tostring call
+            return None, namespaces
+    data = []
+    module._serialize_xml(data.append, elem, encoding, qnames, None)
+    return ''.join(data), namespaces
+
+
+def start_tag(tag, attrib, namespaces, encoding='utf-8'):
+    """ the start tag tostring would write for an element with
+        children using namespaces, see fragment_tostring
+    """
+    module = elementtree.ElementTree
+    data = ['<' + tag]
+    for uri, prefix in sorted(namespaces.items(), key=lambda x: x[1]):
+        data.append(' xmlns:%s="%s"' % (prefix.encode(encoding),
+                                         module._escape_attrib(uri, encoding)))
+    for key, value in sorted(attrib.items()):
+        data.append(' %s="%s"' % (key.encode(encoding),
+                                   module._escape_attrib(value, encoding)))
+    data.append('>')
+    return ''.join(data)
+
+
 def indent(elem, level=0):
     """
     generate pretty looking XML, based upon:
@@ -14,7 +14,7 @@ import time
 from twisted.trial import unittest
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 
 from coherence.base import Coherence
 
@@ -54,3 +54,151 @@ class TestCoherence(unittest.TestCase):
         reactor.callLater(3, d.callback, None)
 
         return d
+
+    def test_network_change_searches(self):
+        addresses = ['192.168.1.2']
+        searches = []
+        self.patch(self.coherence, 'network_addresses',
+                   lambda: succeed(list(addresses)))
+        self.patch(self.coherence.msearch, 'network_changed',
+                   lambda: searches.append(True))
+
+        self.coherence.check_network()
+        self.coherence.check_network()
+        self.assertEqual(searches, [])
+
+        addresses[0] = '10.0.0.2'
+        self.coherence.check_network()
+        self.assertEqual(searches, [True])
+        self.coherence.check_network()
+        self.assertEqual(searches, [True])
+
+
+class FakeDevice(object):
+
+    friendly_device_type = 'MediaServer'
+    manifestation = 'remote'
+
+    def __init__(self, udn, host):
+        self.udn = udn
+        self.host = host
+        self.friendly_name = 'device %s' % udn
+        self.client = None
+
+    def get_id(self):
+        return self.udn
+
+    def get_uuid(self):
+        return self.udn[5:]
+
+    def get_usn(self):
+        return '%s::upnp:rootdevice' % self.udn
+
+    def get_host(self):
+        return self.host
+
+    def get_friendly_name(self):
+        return self.friendly_name
+
+    def get_device_type(self):
+        return 'urn:schemas-upnp-org:device:MediaServer:1'
+
+    def get_friendly_device_type(self):
+        return 'Unknown'
+
+    def get_devices(self):
+        return []
+
+    def unsubscribe_service_subscriptions(self):
+        return succeed(None)
+
+    def remove(self, *args):
+        pass
+
+
+class TestDeviceIndexes(unittest.TestCase):
+
+    def setUp(self):
+        louie.reset()
+        self.coherence = Coherence({'unittest': 'yes', 'logmode': 'error'})
+        self.d1 = FakeDevice('uuid:1111', '192.168.1.1')
+        self.d2 = FakeDevice('uuid:2222', '192.168.1.1')
+        self.coherence.add_device(self.d1)
+        self.coherence.add_device(self.d2)
+
+    def tearDown(self):
+
+        def cleaner(r):
+            self.coherence.clear()
+            return r
+
+        dl = self.coherence.shutdown()
+        dl.addBoth(cleaner)
+        return dl
+
+    def test_lookups(self):
+        c = self.coherence
+        self.assertIs(c.get_device_with_usn(self.d1.get_usn()), self.d1)
+        self.assertIs(c.get_device_with_id('uuid:2222'), self.d2)
+        self.assertIs(c.get_device_with_id('2222'), self.d2)
+        self.assertEqual(c.get_device_with_id('uuid:3333'), None)
+        self.assertEqual(c.get_device_with_usn('uuid:3333'), None)
+        self.assertEqual(c.get_device_by_host('192.168.1.1'),
+                         [self.d1, self.d2])
+        self.assertEqual(c.get_device_by_host('192.168.1.2'), [])
+
+    def test_remove_device(self):
+        c = self.coherence
+        c.remove_device('upnp:rootdevice', {'ST': 'upnp:rootdevice',
+                                            'USN': self.d1.get_usn()})
+        self.assertEqual(c.get_devices(), [self.d2])
+        self.assertEqual(c.get_device_with_usn(self.d1.get_usn()), None)
+        self.assertEqual(c.get_device_with_id('1111'), None)
+        self.assertEqual(c.get_device_by_host('192.168.1.1'), [self.d2])
+        self.assertEqual(c._devices_by_uuid.keys(), ['2222'])
+
+    def test_first_added_wins(self):
+        d3 = FakeDevice('uuid:1111', '192.168.1.3')
+        self.coherence.add_device(d3)
+        self.assertIs(self.coherence.get_device_with_id('1111'), self.d1)
+        self.coherence.remove_device('upnp:rootdevice',
+                                     {'ST': 'upnp:rootdevice',
+                                      'USN': self.d1.get_usn()})
+        self.assertIs(self.coherence.get_device_with_id('1111'), d3)
+
+
+class TestControlPointQueries(unittest.TestCase):
+
+    def setUp(self):
+        louie.reset()
+        self.coherence = Coherence({'unittest': 'yes', 'logmode': 'error',
+                                    'controlpoint': 'yes'})
+        self.ctrl = self.coherence.ctrl
+        self.found = []
+
+    def tearDown(self):
+
+        def cleaner(r):
+            self.coherence.clear()
+            return r
+
+        dl = self.coherence.shutdown()
+        dl.addBoth(cleaner)
+        return dl
+
+    def test_query_by_type(self):
+        from coherence.upnp.devices.control_point import DeviceQuery
+        self.ctrl.add_query(DeviceQuery('uuid', 'uuid:1111',
+                                        self.found.append, timeout=10))
+        self.ctrl.add_query(DeviceQuery('host', '192.168.1.2',
+                                        self.found.append, timeout=10,
+                                        oneshot=False))
+        d1 = FakeDevice('uuid:1111', '192.168.1.1')
+        d2 = FakeDevice('uuid:2222', '192.168.1.2')
+        self.ctrl.process_queries(d1)
+        self.ctrl.process_queries(d2)
+        self.ctrl.process_queries(d1)
+        self.ctrl.process_queries(d2)
+        self.assertEqual(self.found, [d1, d2, d2])
+        # the fired oneshot query is gone
+        self.assertEqual(self.ctrl.queries.keys(), ['host'])
@@ -13,6 +13,7 @@ TODO:
 """
 import os
 import urllib
+import itertools
 from datetime import datetime
 
 DC_NS = 'http://purl.org/dc/elements/1.1/'
@@ -32,6 +33,7 @@ my_namespaces = {
     }
 
 from coherence.extern.et import (ET, namespace_map_update, ElementInterface,
+                                 fragment_tostring, start_tag,
                                  qname, textElement, textElementIfNotNone)
 namespace_map_update(my_namespaces)
 
@@ -70,6 +72,77 @@ def is_video(mimetype):
     return False
 
 
+# stamps for the changes of Objects and Resources, increasing
+# so a new Resource never looks like an old one at the same address
+_stamps = itertools.count(1)
+
+
+class Filter(object):
+    """ a compiled Filter argument of a Browse or Search action
+
+        names holds the requested properties, like 'upnp:artist',
+        'res' or 'res@duration'. The required ones are always included,
+        and so is res, if one of its attributes is requested.
+    """
+
+    required = frozenset(['@id', '@parentID', '@restricted',
+                          'dc:title', 'upnp:class'])
+
+    def __init__(self, filter):
+        self.names = frozenset(name.strip() for name in filter.split(',')
+                               if name.strip())
+        self.res = ('res' in self.names or
+                    [name for name in self.names if name.startswith('res@')] != [])
+
+    def allows(self, name):
+        return name in self.names or name in self.required or \
+               (name == 'res' and self.res)
+
+    def apply(self, element):
+        """ remove the properties not asked for from the
+            item or container element """
+        for name in element.attrib.keys():
+            if not self.allows('@' + name):
+                del element.attrib[name]
+        for child in list(element):
+            tag = child.tag
+            if tag[0] == '{':
+                namespace, tag = tag[1:].split('}', 1)
+                tag = '%s:%s' % (my_namespaces.get(namespace, namespace), tag)
+            if not self.allows(tag):
+                element.remove(child)
+        return element
+
+    def __repr__(self):
+        return 'Filter(%r)' % ','.join(sorted(self.names))
+
+
+_filters = {}
+_FILTERS_MAX = 64
+
+
+def get_filter(filter):
+    """ the compiled Filter for a Filter argument,
+        None if all properties are requested """
+    if filter is None or isinstance(filter, Filter):
+        return filter
+    try:
+        return _filters[filter]
+    except KeyError:
+        pass
+    names = [name.strip() for name in filter.split(',')]
+    # an empty filter should mean just the required properties, but
+    # clients sending one had always got everything from us
+    if '*' in names or filter.strip() == '':
+        compiled = None
+    else:
+        compiled = Filter(filter)
+    if len(_filters) >= _FILTERS_MAX:
+        _filters.clear()
+    _filters[filter] = compiled
+    return compiled
+
+
 class Resources(list):
 
     """ a list of resources, always sorted after an append """
@@ -232,6 +305,11 @@ class Resource(object):
             elif additional_info == '#':
                 self.protocolInfo = ':'.join((protocol, network, content_format, '*'))
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            self.__dict__['_stamp'] = _stamps.next()
+
     def get_additional_info(self, upnp_client=''):
         protocol, network, content_format, additional_info = self.protocolInfo.split(':')
         if upnp_client  in ('XBox', 'Philips-TV', ):
@@ -270,10 +348,12 @@ class Resource(object):
 
         root.text = self.data
 
+        filter = kwargs.get('filter')
         for attrname in self.__attributes:
             val = getattr(self, attrname, None)
             if val is not None:
-                root.attrib[attrname] = str(val)
+                if filter is None or filter.allows('res@' + attrname):
+                    root.attrib[attrname] = str(val)
 
         return root
 
@@ -394,6 +474,24 @@ class Object(log.Loggable):
         self.restricted = restricted
         self.res = Resources()
 
+    def __setattr__(self, name, value):
+        log.Loggable.__setattr__(self, name, value)
+        if name[0] != '_':
+            self.__dict__['_stamp'] = _stamps.next()
+
+    def changed(self):
+        """ to be called after changing a list attribute, like genres,
+            in place - setting attributes is noticed on its own and
+            drops the DIDL fragments kept for this object
+        """
+        self.__dict__['_stamp'] = _stamps.next()
+
+    def get_stamp(self):
+        """ changes whenever this object or one of its res does """
+        return (getattr(self, '_stamp', None),
+                tuple((id(r), getattr(r, '_stamp', None))
+                      for r in self.res or ()))
+
     def checkUpdate(self):
         return self
 
@@ -584,7 +682,10 @@ class Item(Object):
         #if self.language is not None:
         #    ET.SubElement(root, qname('language',DC_NS)).text = self.language
 
-        if kwargs.get('transcoding', False) == True:
+        filter = kwargs.get('filter')
+        if filter is not None and not filter.res:
+            pass
+        elif kwargs.get('transcoding', False) == True:
             res = self.res.get_matching(['*:*:*:*'], protocol_type='http-get')
             if len(res) > 0 and is_audio(res[0].protocolInfo):
                 old_res = res[0]
@@ -797,8 +898,10 @@ class Container(Object):
             else:
                 root.attrib['searchable'] = '0'
 
-        for res in self.res:
-            root.append(res.toElement(**kwargs))
+        filter = kwargs.get('filter')
+        if filter is None or filter.res:
+            for res in self.res:
+                root.append(res.toElement(**kwargs))
         return root
 
     def fromElement(self, elt):
@@ -864,13 +967,23 @@ class StorageFolder(Container):
     upnp_class = Container.upnp_class + '.storageFolder'
 
 
+# the number of differently serialized fragments an Object keeps
+FRAGMENTS_PER_OBJECT = 4
+
+# the namespaces declared up front by DIDLElement.startTag
+STREAMED_NAMESPACES = {DC_NS: 'dc', UPNP_NS: 'upnp'}
+
+
 class DIDLElement(ElementInterface, log.Loggable):
 
     logCategory = 'didllite'
 
     def __init__(self, upnp_client='',
                  parent_container=None, requested_id=None,
-                 transcoding=False):
+                 transcoding=False, filter=None):
+        """ filter is the Filter argument of a Browse or Search
+            action, only the properties it names get serialized
+        """
         ElementInterface.__init__(self, 'DIDL-Lite', {})
         log.Loggable.__init__(self)
         self.attrib['xmlns'] = 'urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/'
@@ -879,25 +992,100 @@ class DIDLElement(ElementInterface, log.Loggable):
         self.parent_container = parent_container
         self.requested_id = requested_id
         self.transcoding = transcoding
+        self.filter = get_filter(filter)
+        self._fragments = []
 
     def addContainer(self, id, parentID, title, restricted=False):
         e = Container(id, parentID, title, restricted, creator='')
         self.append(e.toElement())
 
+    def _toElement(self, item):
+        element = item.toElement(upnp_client=self.upnp_client,
+                                 parent_container=self.parent_container,
+                                 requested_id=self.requested_id,
+                                 transcoding=self.transcoding,
+                                 filter=self.filter)
+        if self.filter is not None:
+            self.filter.apply(element)
+        return element
+
+    def _fragment(self, item, keep_element=True):
+        """ the element of item and a list for its serialized fragment
+
+            Both are kept on the item, for each combination of our
+            options, until it changes. The fragment gets serialized
+            by toString, when needed. Without keep_element only the
+            fragment is kept, serialized right away, and the element
+            returned may be None.
+        """
+        if not isinstance(item, Object):
+            return self._toElement(item), [None, {}]
+        key = (self.upnp_client, self.parent_container, self.requested_id,
+               self.transcoding, self.filter and self.filter.names)
+        stamp = item.get_stamp()
+        fragments = item.__dict__.get('_fragments')
+        if fragments is None:
+            fragments = item.__dict__['_fragments'] = {}
+        cached = fragments.get(key)
+        if(cached is not None and cached[0] == stamp and
+           (cached[1] is not None or not keep_element)):
+            return cached[1], cached[2]
+        if cached is None and len(fragments) >= FRAGMENTS_PER_OBJECT:
+            fragments.clear()
+        element = self._toElement(item)
+        if keep_element:
+            fragment = [None, {}]
+            fragments[key] = (stamp, element, fragment)
+        else:
+            fragment = list(fragment_tostring(element))
+            if fragment[0] is None:
+                fragments[key] = (stamp, element, fragment)
+            else:
+                fragments[key] = (stamp, None, fragment)
+        return element, fragment
+
+    def startTag(self):
+        """ the DIDL-Lite start tag for a document built from
+            itemToString fragments
+        """
+        return start_tag(self.tag, self.attrib, STREAMED_NAMESPACES)
+
+    def endTag(self):
+        return '</%s>' % self.tag
+
+    def itemToString(self, item):
+        """ item serialized like in toString, but without adding it
+
+            Goes between startTag and endTag, to produce large documents
+            piecewise.
+        """
+        element, fragment = self._fragment(item, keep_element=False)
+        if fragment[0] is None and element is not None:
+            fragment[:] = fragment_tostring(element)
+        if fragment[0] is not None:
+            for uri in fragment[1]:
+                if uri not in STREAMED_NAMESPACES:
+                    break
+            else:
+                return fragment[0]
+        # with the namespaces declared on the item itself
+        if element is None:
+            element = self._toElement(item)
+        return ET.tostring(element, encoding='utf-8')
+
     def addItem(self, item):
-        self.append(item.toElement(upnp_client=self.upnp_client,
-                                   parent_container=self.parent_container,
-                                   requested_id=self.requested_id,
-                                   transcoding=self.transcoding))
+        element, fragment = self._fragment(item)
+        self.append(element)
+        self._fragments.append((element, fragment))
         self._items.append(item)
 
     def rebuild(self):
         self._children = []
+        self._fragments = []
         for item in self._items:
-            self.append(item.toElement(upnp_client=self.upnp_client,
-                                       parent_container=self.parent_container,
-                                       requested_id=self.requested_id,
-                                       transcoding=self.transcoding))
+            element, fragment = self._fragment(item)
+            self.append(element)
+            self._fragments.append((element, fragment))
 
     def numItems(self):
         return len(self)
@@ -911,7 +1099,19 @@ class DIDLElement(ElementInterface, log.Loggable):
         """
         #preamble = """<?xml version="1.0" encoding="utf-8"?>"""
         #return preamble + ET.tostring(self,encoding='utf-8')
-        return ET.tostring(self, encoding='utf-8')
+        if len(self._fragments) == 0 or len(self._fragments) != len(self):
+            return ET.tostring(self, encoding='utf-8')
+        parts = []
+        used = {}
+        for element, fragment in self._fragments:
+            if fragment[0] is None:
+                fragment[:] = fragment_tostring(element)
+                if fragment[0] is None:
+                    return ET.tostring(self, encoding='utf-8')
+            parts.append(fragment[0])
+            used.update(fragment[1])
+        return ''.join([start_tag(self.tag, self.attrib, used)] + parts +
+                       ['</%s>' % self.tag])
 
     def get_upnp_class(self, name):
         try:
@@ -4,11 +4,157 @@
 # Copyright (C) 2006 Fluendo, S.A. (www.fluendo.com).
 # Copyright 2006,2007,2008,2009 Frank Scholz <coherence@beebits.net>
 
+import heapq
+import itertools
+from urlparse import urlsplit
+
+from twisted.internet import reactor, defer
 from twisted.python import failure
 from twisted.python.util import OrderedDict
 
 from coherence import log
 
+# (service type, action name) -> seconds to serve the results of a
+# call from the cache, 0 only merges identical calls while in flight
+call_policies = {}
+
+
+def set_call_policy(service_type, action_name, ttl=0):
+    """Merge identical calls of action_name on services of service_type
+    while one is in flight, and serve their results for ttl seconds
+    afterwards. A ttl of None removes the policy again.
+
+    service_type is either a full service type or just its name, like
+    'AVTransport'.
+    """
+    if ttl is None:
+        call_policies.pop((service_type, action_name), None)
+    else:
+        call_policies[(service_type, action_name)] = ttl
+
+
+def get_call_policy(service_type, action_name):
+    ttl = call_policies.get((service_type, action_name))
+    if ttl is None and service_type:
+        parts = service_type.split(':')
+        if len(parts) > 3:
+            ttl = call_policies.get((parts[3], action_name))
+    return ttl
+
+
+# priorities of action calls, lower ones are made first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class _DeviceQueue(object):
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.active = 0
+        self.waiting = []
+        self.last_decrease = None
+
+
+class CallScheduler(log.Loggable):
+    """ Limits the number of concurrent action calls per device
+
+        Calls beyond the limit of a device are queued and made in order
+        of their priority, then in order of their arrival.
+
+        The limit of each device starts at initial_limit and adapts
+        between min_limit and max_limit: it grows slowly while calls
+        succeed within latency_target seconds and is halved when one
+        fails or takes longer. A call still unanswered after
+        call_timeout seconds gives up its place to the next one.
+    """
+
+    logCategory = 'action'
+
+    def __init__(self, max_limit=4, min_limit=1, initial_limit=2,
+                 latency_target=2.0, call_timeout=30):
+        log.Loggable.__init__(self)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.initial_limit = max(min_limit, min(initial_limit, max_limit))
+        self.latency_target = latency_target
+        self.call_timeout = call_timeout
+        self._queues = {}
+        self._sequence = itertools.count()
+
+    def get_limit(self, key):
+        queue = self._queues.get(key)
+        if queue is None:
+            return self.initial_limit
+        return int(queue.limit)
+
+    def run(self, key, priority, f, *args, **kwargs):
+        """ call f with args and kwargs once a call to the device
+            identified by key is allowed, returns a Deferred firing
+            with its result
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _DeviceQueue(self.initial_limit)
+        d = defer.Deferred()
+        heapq.heappush(queue.waiting, (priority, self._sequence.next(),
+                                       d, f, args, kwargs))
+        self._process(key, queue)
+        return d
+
+    def _process(self, key, queue):
+        while queue.waiting and queue.active < int(queue.limit):
+            priority, _, d, f, args, kwargs = heapq.heappop(queue.waiting)
+            queue.active += 1
+            slot = {'started': reactor.seconds(), 'timeout': None}
+            call = defer.maybeDeferred(f, *args, **kwargs)
+            if not call.called and self.call_timeout:
+                slot['timeout'] = reactor.callLater(
+                    self.call_timeout, self._release, key, queue, slot, False)
+            call.addBoth(self._done, key, queue, slot)
+            call.chainDeferred(d)
+        if queue.waiting:
+            self.debug("%d calls to %r waiting, %d in flight",
+                       len(queue.waiting), key, queue.active)
+
+    def _done(self, result, key, queue, slot):
+        succeeded = not isinstance(result, failure.Failure)
+        self._release(key, queue, slot, succeeded)
+        return result
+
+    def _release(self, key, queue, slot, succeeded):
+        if slot.get('released'):
+            return
+        slot['released'] = True
+        timeout = slot['timeout']
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        queue.active -= 1
+        started = slot['started']
+        if not succeeded or reactor.seconds() - started > self.latency_target:
+            # only once for all the calls in flight at that time
+            if queue.last_decrease is None or started > queue.last_decrease:
+                queue.limit = max(self.min_limit, queue.limit / 2)
+                queue.last_decrease = reactor.seconds()
+                self.info("lowering the concurrency limit of %r to %d",
+                          key, int(queue.limit))
+        else:
+            queue.limit = min(self.max_limit, queue.limit + 1 / queue.limit)
+        self._process(key, queue)
+
+
+scheduler = CallScheduler()
+
+
+def get_scheduler():
+    return scheduler
+
+
+def set_scheduler(call_scheduler):
+    """Set the CallScheduler for action calls, None disables it."""
+    global scheduler
+    scheduler = call_scheduler
+
 
 class Argument:
 
@@ -56,6 +202,9 @@ class Action(log.Loggable):
         self.implementation = implementation
         self.arguments_list = arguments_list
         self.callback = None
+        self._in_flight = {}
+        self._results = {}
+        self._generation = 0
 
     def _get_client(self):
         client = self.service._get_client(self.name)
@@ -88,7 +237,13 @@ class Action(log.Loggable):
         return self.callback
 
     def call(self, *args, **kwargs):
+        """ call the action on the remote device
+
+            The keyword arguments are the in arguments of the action,
+            plus an optional priority, PRIORITY_INTERACTIVE by default.
+        """
         self.info("calling %s", self.name)
+        priority = kwargs.pop('priority', PRIORITY_INTERACTIVE)
         in_arguments = self.get_in_arguments()
         self.info("in arguments %s", [a.get_name() for a in in_arguments])
         instance_id = kwargs.get('InstanceID', 0)
@@ -128,13 +283,67 @@ class Action(log.Loggable):
         if kwargs.has_key('headers'):
             ordered_arguments['headers'] = kwargs['headers']
 
+        ttl = get_call_policy(getattr(self.service, 'service_type', None),
+                              self.name)
+        if ttl is None:
+            return self._call_remote(action_name, ordered_arguments,
+                                     instance_id, priority)
+
+        key = (action_name, tuple((name, value) for name, value
+                                  in ordered_arguments.items()
+                                  if name != 'headers'))
+        cached = self._results.get(key)
+        if cached is not None:
+            expires, results = cached
+            if reactor.seconds() < expires:
+                self.info("%s served from the cache", self.name)
+                return defer.succeed(dict(results))
+            del self._results[key]
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            self.info("%s joins the identical call in flight", self.name)
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+        waiting = self._in_flight[key] = []
+        d = self._call_remote(action_name, ordered_arguments, instance_id,
+                              priority)
+        d.addBoth(self._call_done, key, ttl, waiting, self._generation)
+        return d
+
+    def _call_remote(self, action_name, ordered_arguments, instance_id,
+                     priority):
         client = self._get_client()
-        d = client.callRemote(action_name, ordered_arguments)
+        if scheduler is None:
+            d = client.callRemote(action_name, ordered_arguments)
+        else:
+            # calls are limited per host, that's what falls over
+            key = urlsplit(getattr(self.service, 'control_url', None) or '')[1]
+            d = scheduler.run(key, priority, client.callRemote,
+                              action_name, ordered_arguments)
         d.addCallback(self._got_results, instance_id=instance_id,
                       name=action_name)
         d.addErrback(self._got_error)
         return d
 
+    def _call_done(self, result, key, ttl, waiting, generation):
+        del self._in_flight[key]
+        if isinstance(result, failure.Failure):
+            for d in waiting:
+                d.errback(result)
+            return result
+        # results of calls made before an event arrived may be outdated
+        if ttl > 0 and generation == self._generation:
+            self._results[key] = (reactor.seconds() + ttl, dict(result))
+        for d in waiting:
+            d.callback(dict(result))
+        return result
+
+    def invalidate_cache(self):
+        """ forget the cached results, as the state of the service changed """
+        self._results.clear()
+        self._generation += 1
+
     def _got_error(self, failure):
         self.warning("error on %s request with %s %s",
                      self.name, self.service.service_type,
@@ -0,0 +1,149 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+On-disk cache of remote device and service descriptions
+
+Fetching and parsing every device description and SCPD again on each
+start is what keeps a control point on a large network busy for a long
+time. With a cache set up, pages already seen are served from disk at
+once and revalidated in the background.
+
+Entries are keyed by their URL. If the device announced UPnP 1.1
+BOOTID.UPNP.ORG/CONFIGID.UPNP.ORG headers, these are stored with the
+entry: a matching CONFIGID means an unchanged description, so such an
+entry is used without refetching it. Otherwise the page is fetched
+again after it was served and its SHA-1 digest compared with the
+cached one; if it differs, the cache is updated and the caller told
+about the change.
+"""
+
+import os
+from hashlib import sha1
+
+from twisted.internet import reactor, task
+
+from coherence.upnp.core import utils
+from coherence import log
+
+
+class DescriptionCache(log.Loggable):
+    logCategory = 'description_cache'
+
+    def __init__(self, path):
+        log.Loggable.__init__(self)
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.counters = {'hits': 0, 'misses': 0, 'changed': 0}
+
+    def _filename(self, url):
+        return os.path.join(self.path, sha1(url).hexdigest())
+
+    def get(self, url, key=None):
+        """Return the cached entry for url as (data, key, digest),
+        or None, if there is none, or it was stored for another key."""
+        try:
+            f = open(self._filename(url), 'rb')
+            try:
+                stored_key = f.readline().rstrip('\n')
+                digest = f.readline().rstrip('\n')
+                data = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+        if key is not None and key != stored_key:
+            return None
+        if sha1(data).hexdigest() != digest:
+            self.warning("ignoring corrupt cache entry for %r", url)
+            return None
+        return data, stored_key, digest
+
+    def put(self, url, data, key=None):
+        filename = self._filename(url)
+        tmp = filename + '.tmp'
+        try:
+            f = open(tmp, 'wb')
+            try:
+                f.write('%s\n%s\n' % (key or '', sha1(data).hexdigest()))
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            self.warning("can't cache description of %r: %s", url, e)
+
+    def remove(self, url):
+        try:
+            os.unlink(self._filename(url))
+        except OSError:
+            pass
+
+    def getPage(self, url, key=None, changed=None):
+        """Like utils.getPage, but served from the cache if possible.
+
+        changed is called with url, when a page served from the cache
+        turned out to be outdated on revalidation.
+        """
+        entry = self.get(url, key)
+        if entry is None:
+            self.counters['misses'] += 1
+            d = utils.getPage(url)
+            d.addCallback(self._store, url, key)
+            return d
+
+        self.counters['hits'] += 1
+        data, stored_key, digest = entry
+        if key is None:
+            # no CONFIGID to rely on, compare the content instead
+            d = utils.getPage(url)
+            d.addCallback(self._revalidated, url, key, digest, changed)
+            d.addErrback(self._revalidation_failed, url)
+        # never call back synchronously, the callers expect to be
+        # done with setting things up before the page arrives
+        return task.deferLater(reactor, 0, lambda: (data, {}))
+
+    def _store(self, result, url, key):
+        self.put(url, result[0], key)
+        return result
+
+    def _revalidated(self, result, url, key, digest, changed):
+        data = result[0]
+        if sha1(data).hexdigest() == digest:
+            return
+        self.info("description of %r changed", url)
+        self.counters['changed'] += 1
+        self.put(url, data, key)
+        if changed is not None:
+            changed(url)
+
+    def _revalidation_failed(self, failure, url):
+        self.info("revalidating %r failed: %s", url, failure.getErrorMessage())
+
+
+_cache = None
+
+
+def get_cache():
+    return _cache
+
+
+def set_cache(cache):
+    """Set the DescriptionCache used by getPage, None disables caching."""
+    global _cache
+    _cache = cache
+
+
+def description_key(boot_id, config_id):
+    """Return the cache key for the BOOTID.UPNP.ORG and
+    CONFIGID.UPNP.ORG values of an announcement, or None."""
+    if config_id is None:
+        return None
+    return '%s/%s' % (boot_id, config_id)
+
+
+def getPage(url, key=None, changed=None):
+    if _cache is None:
+        return utils.getPage(url)
+    return _cache.getPage(url, key, changed)
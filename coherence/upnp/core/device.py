@@ -11,6 +11,7 @@ from twisted.internet import defer
 
 from coherence.upnp.core.service import Service
 from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence import log
 
 import coherence.extern.louie as louie
@@ -301,6 +302,12 @@ class Device(log.Loggable):
         except:
             return ''
 
+    def get_description_key(self):
+        return self.parent.get_description_key()
+
+    def description_changed(self, url=None):
+        self.parent.description_changed(url)
+
     def get_parent_id(self):
         try:
             return self.parent.get_id()
@@ -376,7 +383,9 @@ class RootDevice(Device):
         self.location = infos['LOCATION']
         self.manifestation = infos['MANIFESTATION']
         self.host = infos['HOST']
+        self.infos = infos
         self.root_detection_completed = False
+        self.description_stale = False
         Device.__init__(self, None)
         louie.connect(self.device_detect, 'Coherence.UPnP.Device.detection_completed', self)
         # we need to handle root device completion
@@ -409,6 +418,23 @@ class RootDevice(Device):
     def get_host(self):
         return self.host
 
+    def get_description_key(self):
+        return description_cache.description_key(
+                    self.infos.get('BOOTID.UPNP.ORG'),
+                    self.infos.get('CONFIGID.UPNP.ORG'))
+
+    def description_changed(self, url=None):
+        """ our description or one of our SCPDs was served from the
+            cache and turned out to be outdated, so we have to be
+            detected again - once we are complete, to not race our
+            own detection
+        """
+        if not self.root_detection_completed:
+            self.description_stale = True
+            return
+        self.info("description of %r changed, detecting it again", self)
+        louie.send('Coherence.UPnP.RootDevice.description_changed', None, device=self)
+
     def is_local(self):
         if self.manifestation == 'local':
             return True
@@ -440,6 +466,8 @@ class RootDevice(Device):
         self.root_detection_completed = True
         self.info("rootdevice %r %r %r initialized, manifestation %r", self.friendly_name, self.st, self.host, self.manifestation)
         louie.send('Coherence.UPnP.RootDevice.detection_completed', None, device=self)
+        if self.description_stale:
+            self.description_changed()
 
     def add_device(self, device):
         self.debug("RootDevice add_device %r", device)
@@ -484,7 +512,10 @@ class RootDevice(Device):
             self.warning("error getting device description from %r", url)
             self.info(failure)
 
-        utils.getPage(self.location).addCallbacks(gotPage, gotError, None, None, [self.location], None)
+        d = description_cache.getPage(self.location,
+                                      self.get_description_key(),
+                                      self.description_changed)
+        d.addCallbacks(gotPage, gotError, None, None, [self.location], None)
 
     def make_fullyqualified(self, url):
         if url.startswith('http://'):
@@ -374,7 +374,7 @@ class NotificationProtocol(Protocol, log.Loggable):
             self.timeout_checker.cancel()
         except:
             pass
-        cmd, headers = utils.parse_http_response(data)
+        cmd, headers, content = utils.parse_http_response(data)
         self.debug("notification response received %r %r", cmd, headers)
         if cmd[1] != '200':
             self.warning("response with error code %r received from %s "
@@ -5,39 +5,88 @@
 # Copyright 2006, Frank Scholz <coherence@beebits.net>
 
 import socket
-import time
 
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
-from twisted.internet import task
 
 from coherence.upnp.core import utils
 import coherence.extern.louie as louie
 from coherence import log
 from coherence.upnp.core.ssdp import SSDP_PORT, SSDP_ADDR
+from coherence.upnp.core.ssdp import InterfaceProtocol, listen_on_interface
 
 
 class MSearch(DatagramProtocol, log.Loggable):
+    """Searches the network for devices and services.
+
+    A search round sends one M-SEARCH per target ST. Searching starts
+    with a burst (each target searched twice, because it's worth it
+    with UDP's reliability) and repeats every `interval` seconds. As
+    long as a round brings up no new devices, the interval doubles up
+    to `max_interval`; a new device resets it. network_changed(),
+    called by Coherence when its addresses change, triggers an
+    immediate burst.
+
+    By default all devices and services are searched (ssdp:all).
+    set_targets() narrows this down to specific STs, e.g. the device
+    types a ControlPoint is interested in. Devices answering such a
+    targeted search get their root device registered via a single
+    upnp:rootdevice search, if it is not known yet.
+
+    If interfaces lists several addresses, the searches are sent out
+    on each of these network interfaces.
+    """
     logCategory = 'msearch'
 
-    def __init__(self, ssdp_server, test=False):
+    def __init__(self, ssdp_server, test=False, mx=5, interval=120,
+                 max_interval=1800, interfaces=None):
         log.Loggable.__init__(self)
         self.ssdp_server = ssdp_server
-        self._double_discover_loop = None
+        self.mx = mx
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.interval = interval
+        self.targets = ['ssdp:all']
+        self._found_new = False
+        self._discover_call = None
+        self._resolve_call = None
+        # UUIDs we already searched the root device for
+        self._resolving = set()
         self._port = None
+        self._interfaces = []
+        self._ports = []
+        if interfaces and len(interfaces) > 1:
+            self._interfaces = [InterfaceProtocol(self, address)
+                                for address in interfaces]
         if not test:
-            self._port = reactor.listenUDP(0, self)
-
-            self._double_discover_loop = task.LoopingCall(self.double_discover)
-            self._double_discover_loop.start(120.0)
+            if self._interfaces:
+                for protocol in self._interfaces:
+                    self._ports.append(listen_on_interface(
+                        0, protocol, protocol.address))
+            else:
+                self._port = reactor.listenUDP(0, self)
+            self.search_round(burst=True)
 
     def stopDiscovery(self):
-        if self._double_discover_loop:
-            self._double_discover_loop.stop()
+        for call in (self._discover_call, self._resolve_call):
+            if call and call.active():
+                call.cancel()
+        self._discover_call = self._resolve_call = None
         if self._port:
             self._port.stopListening()
+        for port in self._ports:
+            port.stopListening()
+        self._ports = []
+
+    def _transports(self):
+        if self._interfaces:
+            return [protocol.transport for protocol in self._interfaces
+                    if protocol.transport is not None]
+        if self.transport is not None:
+            return [self.transport]
+        return []
 
-    def datagramReceived(self, data, (host, port)):
+    def datagramReceived(self, data, (host, port), interface=None):
         cmd, headers, content = utils.parse_http_response(data)
         del content # we do not need the content
         self.info('datagramReceived from %s:%d, protocol %s code %s', host, port, cmd[0], cmd[1])
@@ -46,27 +95,90 @@ class MSearch(DatagramProtocol, log.Loggable):
             if self.ssdp_server.service_seen(host, headers['st'], headers):
                 self.info('register as remote %(usn)s, %(st)s, %(location)s',
                           headers)
+                self._found_new = True
+            if headers['st'] == 'upnp:rootdevice':
+                self._resolving.discard(headers['usn'].split('::', 1)[0])
+            elif headers['st'] in self.targets:
+                self._root_seen(host, headers)
 
         # make raw data available
         # send out the signal after we had a chance to register the device
         louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
 
+    def _root_seen(self, host, headers):
+        """A response to a targeted search proves the root device to
+        be alive, too."""
+        uuid = headers['usn'].split('::', 1)[0]
+        root_usn = uuid + '::upnp:rootdevice'
+        if self.ssdp_server.isKnown(root_usn):
+            headers = dict(headers, usn=root_usn)
+            self.ssdp_server.service_seen(host, 'upnp:rootdevice', headers)
+        elif uuid not in self._resolving:
+            self._resolving.add(uuid)
+            if self._resolve_call is None or not self._resolve_call.active():
+                # wait for the other responses to the current search
+                self._resolve_call = reactor.callLater(self.mx + 1,
+                                                       self._resolve_roots)
+
+    def _resolve_roots(self):
+        # a root device not answering, or expiring later on, is
+        # searched again with the next targeted response from it
+        self._resolving.clear()
+        self.discover('upnp:rootdevice')
+
+    def set_targets(self, targets):
+        """Set the STs to search for, searching the new ones at once."""
+        targets = list(targets) or ['ssdp:all']
+        new = [st for st in targets if st not in self.targets]
+        self.targets = targets
+        if self._transports():
+            for st in new:
+                self.discover(st)
+
+    def network_changed(self):
+        """Search again at once, restarting with the shortest
+        interval."""
+        self._resolving.clear()
+        self.interval = self.min_interval
+        if self._transports():
+            self.search_round(burst=True)
+
+    def search_round(self, burst=False):
+        if self._discover_call and self._discover_call.active():
+            self._discover_call.cancel()
+        if burst or self._found_new:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self._found_new = False
+        if burst:
+            self.double_discover()
+        else:
+            for st in self.targets:
+                self.discover(st)
+        self.debug('next search in %ds', self.interval)
+        self._discover_call = reactor.callLater(self.interval,
+                                                self.search_round)
+
     def double_discover(self):
         " Because it's worth it (with UDP's reliability) "
-        self.info('send out discovery for ssdp:all')
-        self.discover()
-        self.discover()
+        self.info('send out discovery for %s', ', '.join(self.targets))
+        for st in self.targets:
+            self.discover(st)
+            self.discover(st)
 
-    def discover(self):
+    def discover(self, st='ssdp:all'):
         req = ['M-SEARCH * HTTP/1.1',
                 'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
                 'MAN: "ssdp:discover"',
-                'MX: 5',
-                'ST: ssdp:all',
+                'MX: %d' % self.mx,
+                'ST: %s' % st,
                 '', '']
         req = '\r\n'.join(req)
 
-        try:
-            self.transport.write(req, (SSDP_ADDR, SSDP_PORT))
-        except socket.error, msg:
-            self.info("failure sending out the discovery message: %r", msg)
+        for transport in self._transports():
+            try:
+                transport.write(req, (SSDP_ADDR, SSDP_PORT))
+            except socket.error, msg:
+                self.info("failure sending out the discovery message: %r",
+                          msg)
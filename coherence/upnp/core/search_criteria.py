@@ -0,0 +1,340 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Parser and evaluator for the SearchCriteria of the ContentDirectory
+Search action
+
+    expression = parse('upnp:class derivedfrom "object.item.audioItem"'
+                       ' and dc:title contains "love"')
+    expression.matches(didl_object)
+
+The grammar is the one of the UPnP ContentDirectory:1 specification,
+plus startsWith from ContentDirectory:2. 'and' binds closer than 'or',
+string comparisons ignore the case.
+
+The parsed expressions are trees of And, Or, Relation and Exists nodes,
+or All for '*', which backends can inspect to run a search on their own.
+"""
+
+import re
+from datetime import datetime
+
+
+class SearchCriteriaError(ValueError):
+    pass
+
+
+def _text(value):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return value
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _attribute(name):
+    def get(obj):
+        value = getattr(obj, name, None)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple)):
+            return [v for v in value if v is not None]
+        return [value]
+    return get
+
+
+def _genres(obj):
+    genres = list(getattr(obj, 'genres', None) or [])
+    genre = getattr(obj, 'genre', None)
+    if genre is not None and genre not in genres:
+        genres.insert(0, genre)
+    return genres
+
+
+def _res(name):
+    def get(obj):
+        values = []
+        for res in getattr(obj, 'res', None) or []:
+            value = getattr(res, name, None)
+            if value is not None:
+                values.append(value)
+        return values
+    return get
+
+
+# the properties we can search for, and how to get their values
+# from a DIDLLite object, always as a list
+PROPERTIES = {
+    '@id': _attribute('id'),
+    '@parentID': _attribute('parentID'),
+    '@refID': _attribute('refID'),
+    '@childCount': _attribute('childCount'),
+    'dc:title': _attribute('title'),
+    'dc:creator': _attribute('creator'),
+    'dc:date': _attribute('date'),
+    'dc:description': _attribute('description'),
+    'dc:publisher': _attribute('publisher'),
+    'dc:language': _attribute('language'),
+    'upnp:class': _attribute('upnp_class'),
+    'upnp:artist': _attribute('artist'),
+    'upnp:album': _attribute('album'),
+    'upnp:genre': _genres,
+    'upnp:originalTrackNumber': _attribute('originalTrackNumber'),
+    'upnp:longDescription': _attribute('longDescription'),
+    'upnp:director': _attribute('director'),
+    'upnp:actor': _attribute('actors'),
+    'res': _res('data'),
+    'res@protocolInfo': _res('protocolInfo'),
+    'res@size': _res('size'),
+    'res@duration': _res('duration'),
+    'res@bitrate': _res('bitrate'),
+    'res@resolution': _res('resolution'),
+    'res@nrAudioChannels': _res('nrAudioChannels'),
+}
+
+
+def capabilities():
+    """ the value for the SearchCapabilities state variable """
+    return ','.join(sorted(PROPERTIES))
+
+
+class All(object):
+    """ '*', matches every object """
+
+    def matches(self, obj):
+        return True
+
+    def __repr__(self):
+        return 'All()'
+
+
+class And(object):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def matches(self, obj):
+        return self.left.matches(obj) and self.right.matches(obj)
+
+    def __repr__(self):
+        return 'And(%r, %r)' % (self.left, self.right)
+
+
+class Or(And):
+
+    def matches(self, obj):
+        return self.left.matches(obj) or self.right.matches(obj)
+
+    def __repr__(self):
+        return 'Or(%r, %r)' % (self.left, self.right)
+
+
+class Exists(object):
+
+    def __init__(self, property, exists):
+        self.property = property
+        self.exists = exists
+        self._get = PROPERTIES[property]
+
+    def matches(self, obj):
+        return bool(self._get(obj)) == self.exists
+
+    def __repr__(self):
+        return 'Exists(%r, %r)' % (self.property, self.exists)
+
+
+def _compare(op):
+    def compare(value, wanted, wanted_number):
+        if wanted_number is not None:
+            number = _number(value)
+            if number is not None:
+                return op(number, wanted_number)
+        return op(_text(value).lower(), wanted)
+    return compare
+
+
+def _derived_from(value, wanted, wanted_number):
+    value = _text(value).lower()
+    return value == wanted or value.startswith(wanted + '.')
+
+
+OPERATORS = {
+    '=': _compare(lambda a, b: a == b),
+    '!=': _compare(lambda a, b: a != b),
+    '<': _compare(lambda a, b: a < b),
+    '<=': _compare(lambda a, b: a <= b),
+    '>': _compare(lambda a, b: a > b),
+    '>=': _compare(lambda a, b: a >= b),
+    'contains': lambda value, wanted, n: wanted in _text(value).lower(),
+    'doesnotcontain': lambda value, wanted, n: wanted in _text(value).lower(),
+    'startswith': lambda value, wanted, n: _text(value).lower().startswith(wanted),
+    'derivedfrom': _derived_from,
+}
+
+
+class Relation(object):
+    """ property op "value"
+
+        Properties with several values, like res@protocolInfo, match
+        if any of them does, or for doesNotContain, if none contains
+        the value.
+    """
+
+    def __init__(self, property, op, value):
+        self.property = property
+        self.op = op
+        self.value = value
+        self._get = PROPERTIES[property]
+        self._compare = OPERATORS[op.lower()]
+        self._negated = op.lower() == 'doesnotcontain'
+        self._wanted = _text(value).lower()
+        self._wanted_number = _number(value)
+
+    def matches(self, obj):
+        compare = self._compare
+        wanted = self._wanted
+        wanted_number = self._wanted_number
+        for value in self._get(obj):
+            if compare(value, wanted, wanted_number):
+                return not self._negated
+        return self._negated
+
+    def __repr__(self):
+        return 'Relation(%r, %r, %r)' % (self.property, self.op, self.value)
+
+
+_TOKENS = re.compile(r'''\s*(?:
+    (?P<paren>[()])|
+    (?P<quoted>"(?:[^"\\]|\\.)*")|
+    (?P<relop>!=|<=|>=|=|<|>)|
+    (?P<word>[^\s()"=<>!]+))''', re.VERBOSE)
+
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+def _tokenize(criteria):
+    tokens = []
+    position = 0
+    criteria = criteria.rstrip()
+    while position < len(criteria):
+        match = _TOKENS.match(criteria, position)
+        if match is None:
+            raise SearchCriteriaError("invalid search criteria at %r" %
+                                      criteria[position:])
+        position = match.end()
+        for kind in ('paren', 'quoted', 'relop', 'word'):
+            value = match.group(kind)
+            if value is not None:
+                tokens.append((kind, value))
+                break
+    return tokens
+
+
+class _Parser(object):
+
+    def __init__(self, criteria):
+        self.tokens = _tokenize(criteria)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def next(self, description):
+        if self.position >= len(self.tokens):
+            raise SearchCriteriaError("%s expected, criteria ended" %
+                                      description)
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        expression = self.parse_or()
+        if self.position < len(self.tokens):
+            raise SearchCriteriaError("unexpected %r" %
+                                      self.tokens[self.position][1])
+        return expression
+
+    def parse_or(self):
+        expression = self.parse_and()
+        while self.peek()[0] == 'word' and self.peek()[1].lower() == 'or':
+            self.position += 1
+            expression = Or(expression, self.parse_and())
+        return expression
+
+    def parse_and(self):
+        expression = self.parse_primary()
+        while self.peek()[0] == 'word' and self.peek()[1].lower() == 'and':
+            self.position += 1
+            expression = And(expression, self.parse_primary())
+        return expression
+
+    def parse_primary(self):
+        kind, value = self.next('a search expression')
+        if (kind, value) == ('paren', '('):
+            expression = self.parse_or()
+            if self.next("')'") != ('paren', ')'):
+                raise SearchCriteriaError("')' expected")
+            return expression
+        if kind != 'word':
+            raise SearchCriteriaError("property expected, got %r" % value)
+        if value not in PROPERTIES:
+            raise SearchCriteriaError("unsupported property %r" % value)
+        property = value
+        kind, op = self.next('an operator')
+        if kind == 'word' and op.lower() == 'exists':
+            kind, value = self.next("'true' or 'false'")
+            if kind != 'word' or value.lower() not in ('true', 'false'):
+                raise SearchCriteriaError("'true' or 'false' expected, "
+                                          "got %r" % value)
+            return Exists(property, value.lower() == 'true')
+        if kind not in ('relop', 'word') or op.lower() not in OPERATORS:
+            raise SearchCriteriaError("unsupported operator %r" % op)
+        kind, value = self.next('a quoted value')
+        if kind != 'quoted':
+            raise SearchCriteriaError("quoted value expected, got %r" % value)
+        return Relation(property, op, _UNESCAPE.sub(r'\1', value[1:-1]))
+
+
+# clients keep sending the same few criteria
+_parsed = {}
+_PARSED_MAX = 128
+
+
+def parse(criteria):
+    """ parse a SearchCriteria string
+
+        Returns the expression, with a matches(didl_object) method,
+        raises SearchCriteriaError for invalid or unsupported criteria.
+    """
+    expression = _parsed.get(criteria)
+    if expression is not None:
+        return expression
+    text = criteria
+    if isinstance(text, str):
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            raise SearchCriteriaError("search criteria not in UTF-8")
+    if text.strip() == '*':
+        expression = All()
+    elif not text.strip():
+        raise SearchCriteriaError("empty search criteria")
+    else:
+        expression = _Parser(text).parse()
+    if len(_parsed) >= _PARSED_MAX:
+        _parsed.clear()
+    _parsed[criteria] = expression
+    return expression
@@ -9,13 +9,17 @@ import os
 
 import time
 import urlparse
+import weakref
+from hashlib import sha1
 from coherence.upnp.core import action
 from coherence.upnp.core import event
 from coherence.upnp.core import variable
 
 from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence.upnp.core.soap_proxy import SOAPProxy
 from coherence.upnp.core.soap_service import errorCode
+from coherence.upnp.core.soap_lite import StreamedText
 from coherence.upnp.core.event import EventSubscriptionServer
 
 from coherence.extern.et import ET, textElement, textElementIfNotNone
@@ -269,6 +273,8 @@ class Service(log.Loggable):
 
     def process_event(self, event):
         self.info("process event %r %r", self, event)
+        for action in self._actions.itervalues():
+            action.invalidate_cache()
         for var_name, var_value  in event.items():
             if var_name == 'LastChange':
                 self.info("we have a LastChange event")
@@ -320,54 +326,38 @@ class Service(log.Loggable):
     def parse_actions(self):
 
         def gotPage(x):
-            self.scpdXML, headers = x
-            try:
-                xml_doc = utils.parse_xml(self.scpdXML, 'utf-8')
-            except Exception as e:
-                self.warning("Invalid service description received from %r: e",
-                             self.get_scpd_url(), e)
-                return
-            tree = xml_doc.getroot()
-            ns = "urn:schemas-upnp-org:service-1-0"
-
-            for action_node in tree.findall('.//{%s}action' % ns):
-                name = action_node.findtext('{%s}name' % ns)
-                arguments = []
-                for argument in action_node.findall('.//{%s}argument' % ns):
-                    arg_name = argument.findtext('{%s}name' % ns)
-                    arg_direction = argument.findtext('{%s}direction' % ns)
-                    arg_state_var = argument.findtext('{%s}relatedStateVariable' % ns)
-                    arguments.append(action.Argument(arg_name, arg_direction,
-                                                     arg_state_var))
+            scpd, headers = x
+            key = (self.service_type, sha1(scpd).digest())
+            model = scpd_models.get(key)
+            if model is None:
+                try:
+                    model = SCPDModel(scpd)
+                except Exception as e:
+                    self.scpdXML = scpd
+                    self.warning("Invalid service description received from %r: %s",
+                                 self.get_scpd_url(), e)
+                    return
+                scpd_models[key] = model
+            else:
+                self.debug("sharing the description of %r", self.get_scpd_url())
+            # keep the model alive as long as we use it
+            self._scpd_model = model
+            self.scpdXML = model.scpd
+
+            for name, arguments in model.actions:
                 self._actions[name] = action.Action(self, name, 'n/a', arguments)
 
-            for var_node in tree.findall('.//{%s}stateVariable' % ns):
-                send_events = var_node.attrib.get('sendEvents', 'yes')
-                name = var_node.findtext('{%s}name' % ns)
-                data_type = var_node.findtext('{%s}dataType' % ns)
-                values = []
-                # we need to ignore this, as there we don't get there our
-                # {urn:schemas-beebits-net:service-1-0}X_withVendorDefines
-                # attribute there
-                for allowed in var_node.findall('.//{%s}allowedValue' % ns):
-                    values.append(allowed.text)
-                instance = 0
-                self._variables.get(instance)[name] = variable.StateVariable(self, name,
-                                                               'n/a',
-                                                               instance, send_events,
-                                                               data_type, values)
-                allowed_range = var_node.find('{%s}allowedValueRange' % ns)
-                if allowed_range:
-                    allowed_range_dict = {}
-                    for item in allowed_range:
-                        namespace_uri, tag = item.tag[1:].split("}", 1)
-                        if tag in ['maximum', 'minimum', 'step']:
-                            allowed_range_dict[tag] = item.text
-                    self._variables.get(instance)[name].set_allowed_value_range(**allowed_range_dict)
+            instance = 0
+            for name, send_events, data_type, values, allowed_range in model.variables:
+                var = variable.StateVariable(self, name, 'n/a', instance,
+                                             send_events, data_type, values)
+                if allowed_range is not None:
+                    var.set_allowed_value_range(**allowed_range)
                 # we need to do this here, as there we don't get there our
                 # {urn:schemas-beebits-net:service-1-0}X_withVendorDefines
                 # attibute there
-                self._variables.get(instance)[name].has_vendor_values = True
+                var.has_vendor_values = True
+                self._variables.get(instance)[name] = var
 
             self.detection_completed = True
             louie.send('Coherence.UPnP.Service.detection_completed', sender=self.device, device=self.device)
@@ -378,7 +368,63 @@ class Service(log.Loggable):
             self.info('failure %s', failure)
             louie.send('Coherence.UPnP.Service.detection_failed', self.device, device=self.device)
 
-        utils.getPage(self.get_scpd_url()).addCallbacks(gotPage, gotError, None, None, [self.get_scpd_url()], None)
+        d = description_cache.getPage(self.get_scpd_url(),
+                                      self.device.get_description_key(),
+                                      self.device.description_changed)
+        d.addCallbacks(gotPage, gotError, None, None, [self.get_scpd_url()], None)
+
+
+class SCPDModel(object):
+    """ the parsed actions and state variables of a SCPD
+
+        identical services of several devices share one model, only
+        the Action and StateVariable instances are their own
+    """
+
+    def __init__(self, scpd):
+        self.scpd = scpd
+        self.actions = []
+        self.variables = []
+
+        tree = utils.parse_xml(scpd, 'utf-8').getroot()
+        ns = "urn:schemas-upnp-org:service-1-0"
+
+        for action_node in tree.findall('.//{%s}action' % ns):
+            name = action_node.findtext('{%s}name' % ns)
+            arguments = []
+            for argument in action_node.findall('.//{%s}argument' % ns):
+                arg_name = argument.findtext('{%s}name' % ns)
+                arg_direction = argument.findtext('{%s}direction' % ns)
+                arg_state_var = argument.findtext('{%s}relatedStateVariable' % ns)
+                arguments.append(action.Argument(arg_name, arg_direction,
+                                                 arg_state_var))
+            self.actions.append((name, arguments))
+
+        for var_node in tree.findall('.//{%s}stateVariable' % ns):
+            send_events = var_node.attrib.get('sendEvents', 'yes')
+            name = var_node.findtext('{%s}name' % ns)
+            data_type = var_node.findtext('{%s}dataType' % ns)
+            values = []
+            # we need to ignore this, as there we don't get there our
+            # {urn:schemas-beebits-net:service-1-0}X_withVendorDefines
+            # attribute there
+            for allowed in var_node.findall('.//{%s}allowedValue' % ns):
+                values.append(allowed.text)
+            allowed_range_dict = None
+            allowed_range = var_node.find('{%s}allowedValueRange' % ns)
+            if allowed_range:
+                allowed_range_dict = {}
+                for item in allowed_range:
+                    namespace_uri, tag = item.tag[1:].split("}", 1)
+                    if tag in ['maximum', 'minimum', 'step']:
+                        allowed_range_dict[tag] = item.text
+            self.variables.append((name, send_events, data_type, values,
+                                   allowed_range_dict))
+
+
+# (service type, SHA-1 of the SCPD) -> SCPDModel, as long as in use
+scpd_models = weakref.WeakValueDictionary()
+
 
 moderated_variables = \
         {'urn:schemas-upnp-org:service:AVTransport:2':
@@ -987,9 +1033,16 @@ class ServiceControl(log.Loggable):
             if argument.name[0:11] != 'A_ARG_TYPE_':
                 if action.get_callback() != None:
                     variable = self.variables[instance][argument.get_state_variable()]
-                    variable.update(r[argument.name])
-                    if(variable.send_events == 'yes' and variable.moderated == False):
-                        notify.append(variable)
+                    value = r[argument.name]
+                    if isinstance(value, StreamedText):
+                        # produced while the response is written
+                        pass
+                    elif isinstance(value, defer.Deferred):
+                        value.addCallback(self._update_variable, variable)
+                    else:
+                        variable.update(value)
+                        if(variable.send_events == 'yes' and variable.moderated == False):
+                            notify.append(variable)
                 else:
                     variable = self.variables[instance][argument.get_state_variable()]
                     r[argument.name] = variable.value
@@ -1003,6 +1056,10 @@ class ServiceControl(log.Loggable):
         self.info('action_results sorted %s %s', action.name, ordered_result)
         return ordered_result
 
+    def _update_variable(self, value, variable):
+        variable.update(value)
+        return value
+
     def soap__generic(self, *args, **kwargs):
         """ generic UPnP service control method,
             which will be used if no soap_ACTIONNAME method
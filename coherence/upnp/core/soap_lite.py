@@ -12,8 +12,9 @@
     inspired by ElementSOAP.py
 """
 from twisted.python.util import OrderedDict
+from twisted.internet.defer import Deferred
 
-from coherence.extern.et import ET, textElement
+from coherence.extern.et import ET, textElement, elementtree
 
 NS_SOAP_ENV = "{http://schemas.xmlsoap.org/soap/envelope/}"
 NS_SOAP_ENC = "{http://schemas.xmlsoap.org/soap/encoding/}"
@@ -37,7 +38,11 @@ UPNPERRORS = {401: 'Invalid Action',
               609: 'Not Encrypted',
               610: 'Invalid Sequence',
               611: 'Invalid Control URL',
-              612: 'No Such Session', }
+              612: 'No Such Session',
+              701: 'No such object',
+              708: 'Unsupported or invalid search criteria',
+              709: 'Unsupported or invalid sort criteria',
+              800: 'Changes no longer available', }
 
 
 def build_soap_error(status, description='without words'):
@@ -119,6 +124,147 @@ def build_soap_call(method, arguments, is_response=False,
     preamble = """<?xml version="1.0" encoding="utf-8"?>"""
     return preamble + ET.tostring(envelope, 'utf-8')
 
+# (method, namespace prefix) -> (head, empty tail, tail)
+_response_templates = {}
+
+
+def _escape_cdata(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _response_template(method):
+    if method[:1] == '{':
+        uri, name = method[1:].rsplit('}', 1)
+        # the prefix ElementTree would choose for the namespace
+        prefix = elementtree.ElementTree._namespace_map.get(uri, 'ns0')
+    else:
+        uri, name, prefix = None, method, None
+    key = (method, prefix)
+    try:
+        return _response_templates[key]
+    except KeyError:
+        pass
+    if uri is None:
+        tag, xmlns = name, ''
+    elif prefix:
+        tag = '%s:%s' % (prefix, name)
+        xmlns = ' xmlns:%s="%s"' % (prefix, _escape_cdata(uri).replace('"', '&quot;'))
+    else:
+        tag = name
+        xmlns = ' xmlns="%s"' % _escape_cdata(uri).replace('"', '&quot;')
+    tag = tag.encode('utf-8') + 'Response'
+    head = ''.join((
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<s:Envelope', xmlns,
+        ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"',
+        ' xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">',
+        '<s:Body><', tag))
+    template = _response_templates[key] = (
+        head, ' /></s:Body></s:Envelope>',
+        '</%s></s:Body></s:Envelope>' % tag)
+    return template
+
+
+def _serialize_argument(arg_val, arg_name):
+    arg_type = type(arg_val)
+    if arg_type is str:
+        text = arg_val
+    elif arg_type is unicode:
+        text = arg_val.encode('utf-8')
+    elif arg_type is bool:
+        text = arg_val and '1' or '0'
+    elif arg_type is int or arg_type is float:
+        text = str(arg_val)
+    else:
+        raise KeyError(arg_type)
+    if text:
+        return '<%s>%s</%s>' % (arg_name, _escape_cdata(text), arg_name)
+    return '<%s />' % arg_name
+
+
+def build_soap_response(method, arguments):
+    """ serialize the response to a call of method, like
+        build_soap_call(method, arguments, is_response=True,
+        encoding=None) does, but from a template per method, instead
+        of building and serializing an ElementTree
+    """
+    if not isinstance(arguments, (dict, OrderedDict)):
+        return build_soap_call(method, arguments, is_response=True,
+                               encoding=None)
+    head, empty_tail, tail = _response_template(method)
+    if not arguments:
+        return head + empty_tail
+    out = [head, '>']
+    append = out.append
+    for arg_name, arg_val in arguments.iteritems():
+        append(_serialize_argument(arg_val, arg_name))
+    append(tail)
+    return ''.join(out)
+
+
+class StreamedText(object):
+    """ the value of an argument, produced while the response is
+        written, see iter_soap_response
+
+        chunks is an iterable of unicode or utf-8 encoded strings, or
+        of Deferreds firing with them.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __repr__(self):
+        return '<StreamedText>'
+
+
+def is_streamed(arguments):
+    """ whether the response arguments need iter_soap_response """
+    if not isinstance(arguments, (dict, OrderedDict)):
+        return False
+    for arg_val in arguments.itervalues():
+        if isinstance(arg_val, (StreamedText, Deferred)):
+            return True
+    return False
+
+
+def _escape_chunk(chunk):
+    if type(chunk) is unicode:
+        chunk = chunk.encode('utf-8')
+    return _escape_cdata(chunk)
+
+
+def iter_soap_response(method, arguments):
+    """ build_soap_response, as an iterator of strings and of
+        Deferreds firing with strings
+
+        The arguments may hold StreamedText values, whose chunks are
+        escaped on the way, and Deferreds, whose values get serialized
+        once they are reached and fired.
+    """
+    head, empty_tail, tail = _response_template(method)
+    yield head + '>'
+    for arg_name, arg_val in arguments.iteritems():
+        if isinstance(arg_val, StreamedText):
+            yield '<%s>' % arg_name
+            for chunk in arg_val.chunks:
+                if isinstance(chunk, Deferred):
+                    yield chunk.addCallback(_escape_chunk)
+                else:
+                    yield _escape_chunk(chunk)
+            yield '</%s>' % arg_name
+        elif isinstance(arg_val, Deferred):
+            yield arg_val.addCallback(_serialize_argument, arg_name)
+        else:
+            yield _serialize_argument(arg_val, arg_name)
+    yield tail
+
+
 def decode_result(element):
     type = element.get('{http://www.w3.org/1999/XMLSchema-instance}type')
     if type is not None:
@@ -137,3 +283,21 @@ def decode_result(element):
         return element.text == "true"
     else:
         return element.text or ""
+
+
+def decode_soap_call(data):
+    """ decode a SOAP request the way UPnP uses them
+
+        returns the namespace and name of the method called and its
+        arguments, a list of (name, value)
+    """
+    parser = ET.XMLParser(encoding='utf-8')
+    parser.feed(data.replace('\x00', ''))
+    body = parser.close().find(NS_SOAP_ENV + 'Body')
+    if body is None or len(body) == 0:
+        raise ValueError("no SOAP method call found")
+    method = body[0]
+    ns, name = None, method.tag
+    if name.startswith('{') and name.rfind('}') > 1:
+        ns, name = name[1:].split('}')
+    return ns, name, [(child.tag, decode_result(child)) for child in method]
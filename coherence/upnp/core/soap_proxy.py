@@ -3,7 +3,21 @@
 
 # Copyright 2007 - Frank Scholz <coherence@beebits.net>
 
+from StringIO import StringIO
+from urlparse import urlsplit
+
+from twisted.internet import reactor, defer
 from twisted.python import failure
+from twisted.web import error
+from twisted.web.http_headers import Headers
+
+try:
+    from twisted.web.client import Agent, HTTPConnectionPool, \
+         FileBodyProducer, readBody, PartialDownloadError, \
+         ResponseNeverReceived, RequestTransmissionFailed, RequestNotSent
+except ImportError:
+    # Twisted < 13.1, every call gets a connection of its own
+    HTTPConnectionPool = None
 
 from coherence import log
 
@@ -14,6 +28,180 @@ from coherence.upnp.core.utils import getPage, parse_xml
 from coherence.upnp.core import soap_lite
 
 
+class _SOAPHeaders(Headers):
+    """ some devices insist on getting the SOAPACTION header in capitals """
+
+    def getAllRawHeaders(self):
+        for name, values in Headers.getAllRawHeaders(self):
+            if name.lower() == 'soapaction':
+                name = 'SOAPACTION'
+            yield name, values
+
+
+if HTTPConnectionPool is not None:
+
+    class _CountingConnectionPool(HTTPConnectionPool):
+        """ notes whether the last connection handed out was a kept one """
+
+        reused = False
+
+        def getConnection(self, key, endpoint):
+            d = HTTPConnectionPool.getConnection(self, key, endpoint)
+            # a kept connection is handed out right away,
+            # a new one only once it is connected
+            self.reused = d.called
+            return d
+
+
+class ConnectionPool(log.Loggable):
+    """ Persistent HTTP/1.1 connections for the action calls of SOAPProxy
+
+        Up to max_per_host connections to the same host are kept open
+        for the next calls and closed after idle_timeout seconds
+        without one. With limit_per_host, at most max_per_host calls
+        to the same host are in flight at any time, further ones wait
+        for their turn. Leave that to the action.CallScheduler when
+        there is one, it orders the calls by priority.
+
+        Some devices close a kept-alive connection without answering
+        the request sent over it. A call that couldn't be sent over
+        such a connection is repeated once on a fresh one. One that
+        was sent isn't, the device may have run it already, and an
+        action like Seek or Next must not run twice. After
+        FALLBACK_AFTER of these drops the device gets a new connection
+        for each call, just like without a pool.
+
+        counters holds the number of calls served over an already open
+        connection (hits), over a new one (misses), the repeated calls
+        (retries) and the devices we stopped keeping connections to
+        (fallbacks).
+    """
+
+    logCategory = 'soap'
+
+    FALLBACK_AFTER = 3
+
+    def __init__(self, max_per_host=2, idle_timeout=30, limit_per_host=True):
+        if HTTPConnectionPool is None:
+            raise RuntimeError(
+                "persistent connections need Twisted 13.1 or newer")
+        log.Loggable.__init__(self)
+        self.max_per_host = max_per_host
+        self.limit_per_host = limit_per_host
+        self._pool = _CountingConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_per_host
+        self._pool.cachedConnectionTimeout = idle_timeout
+        # we retry on our own, Twisted would do so only for idempotent
+        # requests without a body
+        self._pool.retryAutomatically = False
+        self._agent = Agent(reactor, pool=self._pool)
+        self._semaphores = {}
+        self._drops = {}
+        self._non_persistent = set()
+        self.counters = {'hits': 0, 'misses': 0, 'retries': 0, 'fallbacks': 0}
+
+    def _key(self, url):
+        """ the key our HTTPConnectionPool files connections to url under """
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        host, _, port = netloc.rpartition(':')
+        if not host or not port.isdigit():
+            host, port = netloc, {'https': 443}.get(scheme, 80)
+        return scheme, host, int(port)
+
+    def request(self, url, payload, headers):
+        """ POST payload to url
+
+            Returns a Deferred firing with (page, headers) or failing
+            with a twisted.web.error.Error, just like utils.getPage.
+        """
+        key = self._key(url)
+        if key in self._non_persistent:
+            return getPage(url, postdata=payload, method="POST",
+                           headers=headers)
+        if not self.limit_per_host:
+            return self._request(key, url, payload, headers)
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = defer.DeferredSemaphore(self.max_per_host)
+            self._semaphores[key] = semaphore
+        return semaphore.run(self._request, key, url, payload, headers)
+
+    def _request(self, key, url, payload, headers):
+        raw_headers = {'user-agent': ["Coherence PageGetter"]}
+        for name, value in headers.items():
+            raw_headers[name.lower()] = [value]
+        self._pool.reused = False
+        d = self._agent.request('POST', url, _SOAPHeaders(raw_headers),
+                                FileBodyProducer(StringIO(payload)))
+        # the Agent asks the pool for a connection right away
+        reused = self._pool.reused
+        if reused:
+            self.counters['hits'] += 1
+        else:
+            self.counters['misses'] += 1
+        d.addCallback(self._got_response)
+        d.addErrback(self._failed, key, url, payload, headers, reused)
+        return d
+
+    def _got_response(self, response):
+
+        def got_body(page):
+            headers = {}
+            for name, values in response.headers.getAllRawHeaders():
+                headers[name.lower()] = values
+            if not 200 <= response.code < 300:
+                raise error.Error(str(response.code), response.phrase, page)
+            return page, headers
+
+        def partial_body(failure):
+            # no Content-Length, the body ends with the connection
+            failure.trap(PartialDownloadError)
+            return failure.value.response
+
+        d = readBody(response)
+        d.addErrback(partial_body)
+        d.addCallback(got_body)
+        return d
+
+    def _failed(self, failure, key, url, payload, headers, reused):
+        if not reused or not failure.check(ResponseNeverReceived,
+                                           RequestTransmissionFailed,
+                                           RequestNotSent):
+            return failure
+        self._drops[key] = self._drops.get(key, 0) + 1
+        if self._drops[key] >= self.FALLBACK_AFTER:
+            self.warning("%s:%d keeps closing connections, "
+                         "not keeping them open anymore", key[1], key[2])
+            self.counters['fallbacks'] += 1
+            self._non_persistent.add(key)
+        if failure.check(ResponseNeverReceived):
+            # the device got the request, it must not run twice
+            self.info("%s:%d closed a kept-alive connection without "
+                      "answering", key[1], key[2])
+            return failure
+        self.info("%s:%d closed a kept-alive connection, retrying",
+                  key[1], key[2])
+        self.counters['retries'] += 1
+        return getPage(url, postdata=payload, method="POST", headers=headers)
+
+    def close(self):
+        """ close all idle connections, returns a Deferred """
+        return self._pool.closeCachedConnections()
+
+
+_pool = None
+
+
+def get_pool():
+    return _pool
+
+
+def set_pool(pool):
+    """Set the ConnectionPool used by SOAPProxy, None disables it."""
+    global _pool
+    _pool = pool
+
+
 class SOAPProxy(log.Loggable):
     """ A Proxy for making remote SOAP calls.
 
@@ -71,9 +259,12 @@ class SOAPProxy(log.Loggable):
                 self.debug(traceback.format_exc())
             return error
 
-        return getPage(self.url, postdata=payload, method="POST",
-                        headers=headers
-                      ).addCallbacks(self._cbGotResult, gotError, None, None, [self.url], None)
+        if _pool is None:
+            d = getPage(self.url, postdata=payload, method="POST",
+                        headers=headers)
+        else:
+            d = _pool.request(self.url, payload, headers)
+        return d.addCallbacks(self._cbGotResult, gotError, None, None, [self.url], None)
 
     def _cbGotResult(self, result):
         #print "_cbGotResult 1", result
@@ -3,16 +3,17 @@
 
 # Copyright 2007 - Frank Scholz <coherence@beebits.net>
 
+from zope.interface import implements
+
 from twisted.web import server, resource
 from twisted.python import failure
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IPullProducer
 
 from coherence import log, SERVER_ID
 
 from coherence.extern.et import ET, namespace_map_update
 
-from coherence.upnp.core.utils import parse_xml
-
 from coherence.upnp.core import soap_lite
 
 import coherence.extern.louie as louie
@@ -24,6 +25,234 @@ class errorCode(Exception):
         self.status = status
 
 
+class StreamedResponse(log.Loggable):
+    """ writes the chunks of a streamed SOAP response, see
+        soap_lite.iter_soap_response, whenever the transport has
+        room for more
+
+        When a chunk is a Deferred, we wait for it to fire. As the
+        status and the headers are out already, an error while
+        producing the response can only close the connection.
+    """
+    implements(IPullProducer)
+    logCategory = 'soap'
+
+    # bytes written at once
+    buffer_size = 64 * 1024
+
+    def __init__(self, request, chunks):
+        log.Loggable.__init__(self)
+        self.request = request
+        self.chunks = iter(chunks)
+        self.waiting = False
+        self.stopped = False
+        self._pending = []
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.waiting or self.stopped:
+            return
+        out = self._pending
+        self._pending = []
+        size = sum(len(chunk) for chunk in out)
+        while size < self.buffer_size:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                self._write(out)
+                self._finish()
+                return
+            except:
+                self._abort(failure.Failure())
+                return
+            if isinstance(chunk, defer.Deferred):
+                result = []
+                chunk.addBoth(result.append)
+                if not result:
+                    self.waiting = True
+                    self._write(out)
+                    chunk.addCallback(lambda _: self._waited(result[0]))
+                    return
+                chunk = result[0]
+                if isinstance(chunk, failure.Failure):
+                    self._abort(chunk)
+                    return
+            out.append(chunk)
+            size += len(chunk)
+        self._write(out)
+
+    def _waited(self, chunk):
+        self.waiting = False
+        if self.stopped:
+            return
+        if isinstance(chunk, failure.Failure):
+            self._abort(chunk)
+            return
+        self._pending = [chunk]
+        self.resumeProducing()
+
+    def _write(self, out):
+        if out:
+            self.request.write(''.join(out))
+
+    def _finish(self):
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def _abort(self, reason):
+        self.warning('streamed response failed: %s', reason.getErrorMessage())
+        self.debug(reason.getTraceback())
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.request.transport.loseConnection()
+
+    def stopProducing(self):
+        self.stopped = True
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class _Client(object):
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.queue = []
+        self.active = 0
+        self.finish = 0.0
+        self.latency = 0.0
+        self.counters = {'requests': 0, 'rejected': 0, 'dropped': 0,
+                         'max_queued': 0, 'wait': 0.0, 'time': 0.0}
+
+
+class RequestScheduler(log.Loggable):
+    """ runs the actions of several clients fairly
+
+        Each client, keyed by its address and user agent, runs at
+        most max_per_client actions at once and has at most max_queued
+        waiting, further ones fail with 501. Up to max_active actions
+        run at once over all clients, a free slot goes to the waiting
+        action with the lowest finish tag. That is weighted fair
+        queuing, with the mean time of the client's actions as their
+        cost, so a client sending expensive requests gets fewer turns.
+        An action keeps its slot until its response is written.
+    """
+    logCategory = 'soap'
+
+    max_active = 8
+    max_per_client = 2
+    max_queued = 32
+    # weight of the mean time of an action against the ones before
+    smoothing = 0.2
+    # cost of an action of a client we haven't timed yet, in seconds
+    min_cost = 0.01
+
+    def __init__(self, max_per_client=None, max_queued=None, weights=None):
+        log.Loggable.__init__(self)
+        if max_per_client is not None:
+            self.max_per_client = max_per_client
+        if max_queued is not None:
+            self.max_queued = max_queued
+        # client addresses to their weight, 1.0 if missing
+        self.weights = weights or {}
+        self.clients = {}
+        self.active = 0
+        self.virtual_time = 0.0
+
+    def submit(self, key, request, call):
+        """ run call, returning a Deferred, for the client key once it
+            is its turn, the request being the one answered with its
+            result
+        """
+        client = self.clients.get(key)
+        if client is None:
+            client = self.clients[key] = _Client(self.weights.get(key[0], 1.0))
+        if len(client.queue) >= self.max_queued:
+            client.counters['rejected'] += 1
+            self.info('too many requests from %r', key)
+            return defer.fail(errorCode(501))
+        d = defer.Deferred()
+        cost = max(client.latency, self.min_cost)
+        client.finish = max(self.virtual_time, client.finish) + \
+                        cost / client.weight
+        # marked once the client goes away while waiting
+        gone = []
+        notify_finish = getattr(request, 'notifyFinish', None)
+        if notify_finish is not None:
+            notify_finish().addErrback(lambda _: gone.append(True))
+        client.queue.append((client.finish, request, call, d,
+                             reactor.seconds(), gone))
+        client.counters['max_queued'] = max(client.counters['max_queued'],
+                                            len(client.queue))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self.active < self.max_active:
+            chosen = None
+            for client in self.clients.itervalues():
+                if(client.queue and client.active < self.max_per_client and
+                   (chosen is None or
+                    client.queue[0][0] < chosen.queue[0][0])):
+                    chosen = client
+            if chosen is None:
+                return
+            tag, request, call, d, queued, gone = chosen.queue.pop(0)
+            self.virtual_time = tag
+            if gone:
+                chosen.counters['dropped'] += 1
+                continue
+            self._run(chosen, request, call, d, queued)
+
+    def _run(self, client, request, call, d, queued):
+        self.active += 1
+        client.active += 1
+        started = reactor.seconds()
+        client.counters['requests'] += 1
+        client.counters['wait'] += started - queued
+        result = defer.maybeDeferred(call)
+        notify_finish = getattr(request, 'notifyFinish', None)
+        if notify_finish is not None:
+            notify_finish().addBoth(lambda _: self._done(None, client, started))
+        else:
+            result.addBoth(self._done, client, started)
+        result.chainDeferred(d)
+
+    def _done(self, result, client, started):
+        took = reactor.seconds() - started
+        client.counters['time'] += took
+        client.latency += (took - client.latency) * self.smoothing
+        self.active -= 1
+        client.active -= 1
+        self._dispatch()
+        if client.active == 0 and not client.queue:
+            self._forget(client)
+        return result
+
+    def _forget(self, client):
+        # keep the statistics of the few last clients only
+        if len(self.clients) > 256:
+            for key, c in self.clients.items():
+                if c is client:
+                    del self.clients[key]
+
+    def statistics(self):
+        """ the queue and latency statistics per client key """
+        statistics = {}
+        for key, client in self.clients.iteritems():
+            stats = dict(client.counters)
+            stats['queued'] = len(client.queue)
+            stats['active'] = client.active
+            stats['latency'] = client.latency
+            if stats['requests']:
+                stats['mean_wait'] = stats['wait'] / stats['requests']
+            statistics[key] = stats
+        return statistics
+
+
 class UPnPPublisher(resource.Resource, log.Loggable):
     """ Based upon twisted.web.soap.SOAPPublisher and
         extracted to remove the SOAPpy dependency
@@ -36,9 +265,10 @@ class UPnPPublisher(resource.Resource, log.Loggable):
     isLeaf = 1
     encoding = "UTF-8"
     envelope_attrib = None
+    # a RequestScheduler to run the actions through, if any
+    scheduler = None
 
-    def _sendResponse(self, request, response, status=200):
-        self.debug('_sendResponse %s %s', status, response)
+    def _setHeaders(self, request, status):
         if status == 200:
             request.setResponseCode(200)
         else:
@@ -49,12 +279,24 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         else:
             mimeType = "text/xml"
         request.setHeader("Content-type", mimeType)
-        request.setHeader("Content-length", str(len(response)))
         request.setHeader("EXT", '')
         request.setHeader("SERVER", SERVER_ID)
+
+    def _sendResponse(self, request, response, status=200):
+        self.debug('_sendResponse %s %s', status, response)
+        self._setHeaders(request, status)
+        request.setHeader("Content-length", str(len(response)))
         request.write(response)
         request.finish()
 
+    def _streamResponse(self, request, chunks):
+        """ write the response while it is produced, chunked for
+            HTTP/1.1 clients, as we don't know its length
+        """
+        self.debug('_streamResponse')
+        self._setHeaders(request, 200)
+        StreamedResponse(request, chunks).start()
+
     def _methodNotFound(self, request, methodName):
         response = soap_lite.build_soap_error(401)
         self._sendResponse(request, response, status=401)
@@ -62,10 +304,13 @@ class UPnPPublisher(resource.Resource, log.Loggable):
     def _gotResult(self, result, request, methodName, ns):
         self.debug('_gotResult %s %s %s %s', result, request, methodName, ns)
 
-        response = soap_lite.build_soap_call("{%s}%s" % (ns, methodName), result,
-                                                is_response=True,
-                                                encoding=None)
-        #print "SOAP-lite response", response
+        if soap_lite.is_streamed(result):
+            self._streamResponse(request, soap_lite.iter_soap_response(
+                "{%s}%s" % (ns, methodName), result))
+            return
+
+        response = soap_lite.build_soap_response("{%s}%s" % (ns, methodName),
+                                                 result)
         self._sendResponse(request, response)
 
     def _gotError(self, failure, request, methodName, ns):
@@ -81,15 +326,46 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         response = soap_lite.build_soap_error(status)
         self._sendResponse(request, response, status=status)
 
+    def _dispatch_table(self):
+        """ map the names of the actions we implement to their
+            soap_ACTIONNAME methods and whether these want keywords
+        """
+        table = {}
+        for name in dir(self):
+            if name.startswith('soap_') and name != 'soap__generic':
+                function = getattr(self, name)
+                if callable(function):
+                    table[name[5:]] = \
+                        (function, getattr(function, "useKeywords", False))
+        return table
+
     def lookupFunction(self, functionName):
-        function = getattr(self, "soap_%s" % functionName, None)
-        if not function:
-            function = getattr(self, "soap__generic", None)
+        try:
+            table = self._soap_dispatch
+        except AttributeError:
+            table = self._soap_dispatch = self._dispatch_table()
+        try:
+            return table[functionName]
+        except KeyError:
+            pass
+        function = getattr(self, "soap__generic", None)
         if function:
             return function, getattr(function, "useKeywords", False)
         else:
             return None, None
 
+    def _client_keywords(self, headers):
+        """ identify clients needing special treatment """
+        keywords = {}
+        user_agent = headers.get('user-agent', '')
+        if user_agent.startswith('Xbox/'):
+            keywords['X_UPnPClient'] = 'XBox'
+        if headers.get('x-av-client-info', '').find('"PLAYSTATION3') > 0:
+            keywords['X_UPnPClient'] = 'PLAYSTATION3'
+        if user_agent.startswith('Philips-Software-WebClient/4.32'):
+            keywords['X_UPnPClient'] = 'Philips-TV'
+        return keywords
+
     def render(self, request):
         """Handle a SOAP command."""
         data = request.content.read()
@@ -99,69 +375,41 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         # allow external check of data
         louie.send('UPnPTest.Control.Client.CommandReceived', None, headers, data)
 
-        def print_c(e):
-            for c in e.getchildren():
-                print c, c.tag
-                print_c(c)
-
-        tree = parse_xml(data)
-        #root = tree.getroot()
-        #print_c(root)
-
-        body = tree.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        method = body.getchildren()[0]
-        methodName = method.tag
-        ns = None
-
-        if methodName.startswith('{') and methodName.rfind('}') > 1:
-            ns, methodName = methodName[1:].split('}')
-
-        args = []
-        kwargs = {}
-        for child in method.getchildren():
-            kwargs[child.tag] = soap_lite.decode_result(child)
-            args.append(kwargs[child.tag])
-
-        #p, header, body, attrs = SOAPpy.parseSOAPRPC(data, 1, 1, 1)
-        #methodName, args, kwargs, ns = p._name, p._aslist, p._asdict, p._ns
-
         try:
-            headers['content-type'].index('text/xml')
-        except:
-            self._gotError(failure.Failure(errorCode(415)), request, methodName)
+            ns, methodName, arguments = soap_lite.decode_soap_call(data)
+        except Exception as e:
+            self.warning('invalid SOAP request: %s', e)
+            self._gotError(failure.Failure(errorCode(401)), request, None, None)
+            return server.NOT_DONE_YET
+
+        if headers.get('content-type', '').find('text/xml') < 0:
+            self._gotError(failure.Failure(errorCode(415)), request, methodName, ns)
             return server.NOT_DONE_YET
 
         self.debug('headers: %r', headers)
 
         function, useKeywords = self.lookupFunction(methodName)
-        #print 'function', function, 'keywords', useKeywords, 'args', args, 'kwargs', kwargs
 
         if not function:
             self._methodNotFound(request, methodName)
             return server.NOT_DONE_YET
         else:
             keywords = {'soap_methodName': methodName}
-            if(headers.has_key('user-agent') and
-                    headers['user-agent'].find('Xbox/') == 0):
-                keywords['X_UPnPClient'] = 'XBox'
-            #if(headers.has_key('user-agent') and
-            #        headers['user-agent'].startswith("""Mozilla/4.0 (compatible; UPnP/1.0; Windows""")):
-            #    keywords['X_UPnPClient'] = 'XBox'
-            if(headers.has_key('x-av-client-info') and
-                    headers['x-av-client-info'].find('"PLAYSTATION3') > 0):
-                keywords['X_UPnPClient'] = 'PLAYSTATION3'
-            if(headers.has_key('user-agent') and
-                    headers['user-agent'].find('Philips-Software-WebClient/4.32') == 0):
-                keywords['X_UPnPClient'] = 'Philips-TV'
-            for k, v in kwargs.items():
+            keywords.update(self._client_keywords(headers))
+            for k, v in arguments:
                 keywords[str(k)] = v
             self.info('call %s %s', methodName, keywords)
             if hasattr(function, "useKeywords"):
-                d = defer.maybeDeferred(function, **keywords)
+                args = []
+            else:
+                args = [v for k, v in arguments]
+            if self.scheduler is not None:
+                key = (request.getClientIP(), headers.get('user-agent', ''))
+                d = self.scheduler.submit(key, request,
+                        lambda: function(*args, **keywords))
             else:
                 d = defer.maybeDeferred(function, *args, **keywords)
 
         d.addCallback(self._gotResult, request, methodName, ns)
         d.addErrback(self._gotError, request, methodName, ns)
         return server.NOT_DONE_YET
-
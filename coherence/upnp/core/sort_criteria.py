@@ -0,0 +1,71 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+SortCriteria of the ContentDirectory Browse and Search actions
+
+    sort = SortCriteria('+upnp:album,+upnp:originalTrackNumber,-dc:date')
+    didl_objects = sort.sort(didl_objects)
+
+A missing sign means ascending. The sortable properties are the ones
+we can search for, see search_criteria.PROPERTIES. Values that look
+like numbers are compared as numbers, others as strings ignoring the
+case. Objects without a value come first in ascending order, and
+last in descending order.
+"""
+
+from coherence.upnp.core.search_criteria import PROPERTIES, _text, _number
+
+
+class SortCriteriaError(ValueError):
+    pass
+
+
+def capabilities():
+    """ the value for the SortCapabilities state variable """
+    return ','.join(sorted(PROPERTIES))
+
+
+class SortCriteria(object):
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.keys = []
+        for part in criteria.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            descending = part[0] == '-'
+            if part[0] in '+-':
+                part = part[1:].strip()
+            if part not in PROPERTIES:
+                raise SortCriteriaError("can't sort by %r" % part)
+            self.keys.append((PROPERTIES[part], descending))
+
+    def __nonzero__(self):
+        return len(self.keys) > 0
+
+    def permutation(self, objects):
+        """ the indexes of objects in sort order, None entries last """
+        order = [i for i, o in enumerate(objects) if o is not None]
+        # a stable sort per key, starting with the least significant one
+        for get, descending in reversed(self.keys):
+            keys = dict((i, _sort_key(get(objects[i]))) for i in order)
+            order.sort(key=keys.__getitem__, reverse=descending)
+        order.extend(i for i, o in enumerate(objects) if o is None)
+        return order
+
+    def sort(self, objects):
+        return [objects[i] for i in self.permutation(objects)]
+
+    def __repr__(self):
+        return 'SortCriteria(%r)' % self.criteria
+
+
+def _sort_key(values):
+    if not values:
+        return (0, None)
+    number = _number(values[0])
+    if number is not None:
+        return (1, number)
+    return (2, _text(values[0]).lower())
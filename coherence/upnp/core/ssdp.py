@@ -10,11 +10,13 @@
 # Implementation of a SSDP server under Twisted Python.
 #
 
+import heapq
 import random
 import string
 import sys
 import time
 import socket
+import urlparse
 
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor, error
@@ -28,29 +30,312 @@ import coherence.extern.louie as louie
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
 
+# default lease, if a CACHE-CONTROL header lacks a usable max-age
+DEFAULT_MAX_AGE = 1800
+# grace period granted to remote entries beyond their max-age
+EXPIRY_GRACE = 30
+# default budget of M-SEARCH responses sent per second
+DEFAULT_RESPONSE_RATE = 100
+# default window to spread NOTIFY packets over, in seconds, and the
+# default budget of NOTIFY packets sent per 100ms
+DEFAULT_ANNOUNCE_WINDOW = 10
+DEFAULT_ANNOUNCE_BUDGET = 10
+# rounding slack of the token bucket, a refill landing just below a
+# whole token must not reschedule at the same instant over and over
+TOKEN_EPSILON = 1e-9
+# Linux socket option, not exported by the socket module
+IP_MULTICAST_ALL = 49
+
+
+def parse_max_age(cache_control):
+    """Return the max-age in seconds of a CACHE-CONTROL header value."""
+    for directive in cache_control.split(','):
+        name, _, value = directive.partition('=')
+        if name.strip().lower() == 'max-age':
+            try:
+                return int(value.strip().strip('"'))
+            except ValueError:
+                break
+    return DEFAULT_MAX_AGE
+
+
+def rewrite_location(location, host, address):
+    """Return LOCATION with the host part replaced by address, if it
+    is host."""
+    if not address or not host:
+        return location
+    parts = urlparse.urlsplit(location)
+    if parts.hostname != host:
+        return location
+    netloc = address
+    if parts.port:
+        netloc = '%s:%d' % (address, parts.port)
+    return urlparse.urlunsplit((parts[0], netloc) + parts[2:])
+
+
+def listen_on_interface(port, protocol, address, group=None):
+    """Listen for (multicast) datagrams on the network interface with
+    address, sending multicast datagrams out on this interface, too.
+
+    On Linux the socket gets only the multicast datagrams of the
+    groups it joined on this interface, not those joined by other
+    sockets or on other interfaces.
+    """
+    port = reactor.listenMulticast(port, protocol, listenMultiple=True)
+    if sys.platform.startswith('linux'):
+        try:
+            port.socket.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+        except socket.error:
+            pass
+    port.setOutgoingInterface(address)
+    if group:
+        port.joinGroup(group, interface=address)
+    return port
+
+
+class InterfaceProtocol(DatagramProtocol):
+    """The socket bound to one of several network interfaces, passing
+    the datagrams received on to receiver, along with the address of
+    the interface."""
+
+    def __init__(self, receiver, address):
+        self.receiver = receiver
+        self.address = address
+
+    def datagramReceived(self, data, addr):
+        self.receiver.datagramReceived(data, addr, self.address)
+
+
+class PacketScheduler(log.Loggable):
+    """Sends queued packets when they are due, within a budget of
+    `budget` packets per `interval` seconds (a budget of 0 means
+    unlimited). Packets held back by the budget are sent as soon as
+    the budget allows.
+
+    Subclasses queue items with _push() and send them in _deliver().
+    """
+    logCategory = 'ssdp'
+
+    def __init__(self, budget, interval=1.0):
+        log.Loggable.__init__(self)
+        self.budget = budget
+        self.interval = interval
+        # heap of (due, item)
+        self._queue = []
+        self._tokens = float(budget)
+        self._refilled = None
+        self._call = None
+        self.counters = dict.fromkeys(('sent', 'throttled'), 0)
+
+    def stop(self):
+        """Cancel all pending packets."""
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._queue = []
+
+    def _push(self, due, item):
+        heapq.heappush(self._queue, (due, item))
+
+    def _deliver(self, item):
+        raise NotImplementedError
+
+    def _refill(self, now):
+        if self._refilled is not None:
+            self._tokens = min(self.budget, self._tokens +
+                               (now - self._refilled) *
+                               self.budget / self.interval)
+        self._refilled = now
+
+    def _run(self):
+        self._call = None
+        now = reactor.seconds()
+        if self.budget:
+            self._refill(now)
+        queue = self._queue
+        while queue and queue[0][0] <= now:
+            if self.budget:
+                if self._tokens < 1 - TOKEN_EPSILON:
+                    self.counters['throttled'] += 1
+                    break
+                self._tokens -= 1
+            due, item = heapq.heappop(queue)
+            self.counters['sent'] += 1
+            self._deliver(item)
+        self._reschedule(now)
+
+    def _reschedule(self, now):
+        if not self._queue:
+            return
+        due = self._queue[0][0]
+        if self.budget:
+            self._refill(now)
+            if self._tokens < 1 - TOKEN_EPSILON:
+                due = max(due, now + (1 - self._tokens) *
+                          self.interval / self.budget)
+        if self._call and self._call.active():
+            if self._call.getTime() <= due:
+                return
+            self._call.cancel()
+        self._call = reactor.callLater(max(0, due - now), self._run)
+
+
+class DiscoveryResponder(PacketScheduler):
+    """Schedules the responses to M-SEARCH requests.
+
+    Identical requests (same requester and ST) arriving within the MX
+    window of the first one are coalesced, and each USN is answered
+    only once per requester while a response to it is pending. All
+    responses share a budget of `rate` packets per second (0 means
+    unlimited), and at most `max_pending` responses are queued.
+
+    `counters` holds the number of requests seen, coalesced requests,
+    duplicate responses suppressed, responses sent, responses dropped
+    due to a full queue, and the times the budget held back responses
+    being due.
+    """
+
+    def __init__(self, send, rate=DEFAULT_RESPONSE_RATE, max_pending=1024):
+        PacketScheduler.__init__(self, rate)
+        self.send = send
+        self.max_pending = max_pending
+        # (host, port, ST) -> end of the MX window of the request
+        self._searches = {}
+        # the ((host, port), USN) pairs queued
+        self._pending = set()
+        self.counters.update(dict.fromkeys(('requests', 'coalesced',
+                                            'duplicates', 'dropped'), 0))
+
+    def schedule(self, destination, st, usns, mx, interface=None):
+        """Schedule responses for the USNs to a search for ST received
+        on interface, randomly delayed within MX seconds."""
+        now = reactor.seconds()
+        self.counters['requests'] += 1
+        key = destination + (st,)
+        if self._searches.get(key, 0) > now:
+            self.counters['coalesced'] += 1
+            self.debug('coalescing search for %s from %r', st, destination)
+            return
+        if len(self._searches) > 256:
+            self._searches = dict((k, end) for k, end
+                                  in self._searches.iteritems() if end > now)
+        self._searches[key] = now + mx
+        for usn in usns:
+            if (destination, usn) in self._pending:
+                self.counters['duplicates'] += 1
+                continue
+            if len(self._pending) >= self.max_pending:
+                self.counters['dropped'] += 1
+                continue
+            self._pending.add((destination, usn))
+            self._push(now + random.uniform(0, mx),
+                       (destination, usn, interface))
+        self._reschedule(now)
+
+    def stop(self):
+        """Cancel all pending responses."""
+        PacketScheduler.stop(self)
+        self._searches = {}
+        self._pending = set()
+
+    def _deliver(self, (destination, usn, interface)):
+        self._pending.discard((destination, usn))
+        self.send(usn, destination, interface)
+
+
+class AnnouncementPacer(PacketScheduler):
+    """Spreads NOTIFY packets randomly over a window of `window`
+    seconds, sending at most `budget` of them per `interval` seconds,
+    to not overrun the multicast buffers of switches and access points.
+    """
+
+    def __init__(self, send, window=DEFAULT_ANNOUNCE_WINDOW,
+                 budget=DEFAULT_ANNOUNCE_BUDGET, interval=0.1):
+        PacketScheduler.__init__(self, budget, interval)
+        self.send = send
+        self.window = window
+
+    def schedule(self, usn, nts):
+        """Schedule a notification of type NTS for USN."""
+        now = reactor.seconds()
+        self._push(now + random.uniform(0, self.window), (usn, nts))
+        self._reschedule(now)
+
+    def cancel(self, usn):
+        """Cancel all notifications pending for USN."""
+        queue = [x for x in self._queue if x[1][0] != usn]
+        if len(queue) != len(self._queue):
+            heapq.heapify(queue)
+            self._queue = queue
+
+    def _deliver(self, (usn, nts)):
+        self.send(usn, nts)
+
 
 class SSDPServer(DatagramProtocol, log.Loggable):
     """A class implementing a SSDP server.  The notifyReceived and
     searchReceived methods are called when the appropriate type of
-    datagram is received by the server."""
+    datagram is received by the server.
+
+    interface may be a list of addresses, to serve several network
+    interfaces. Each one gets its own multicast socket then, and the
+    LOCATION of local entries is rewritten to the address of the
+    interface a packet is sent out on."""
     logCategory = 'ssdp'
 
-    def __init__(self, test=False, interface=''):
+    def __init__(self, test=False, interface='',
+                 response_rate=DEFAULT_RESPONSE_RATE,
+                 announce_window=DEFAULT_ANNOUNCE_WINDOW,
+                 announce_budget=DEFAULT_ANNOUNCE_BUDGET):
         # Create SSDP server
         log.Loggable.__init__(self)
         self._known = {}
+        # index of the local entries answering M-SEARCH requests:
+        # ST -> list of USNs, plus the USNs answering 'ssdp:all'
+        self._local_by_st = {}
+        self._local_all = []
+        # USN -> {interface: pre-serialized M-SEARCH response, lacking
+        # the DATE header}
+        self._responses = {}
+        # leases of the remote entries: USN -> (max-age, deadline), and
+        # a heap of (deadline, USN) pairs. Refreshing a lease pushes a
+        # new pair, outdated ones are skipped when they come up.
+        self._leases = {}
+        self._lease_heap = []
+        self._expire_call = None
+        self._responder = DiscoveryResponder(self._send_discovery_response,
+                                             rate=response_rate)
+        # USN -> {(NTS, interface): pre-serialized NOTIFY packet}
+        self._notifications = {}
+        self._pacer = AnnouncementPacer(self._send_notification,
+                                        window=announce_window,
+                                        budget=announce_budget)
         self._callbacks = {}
         self.__test = test
         self.active_calls = []
         self._resend_notify_loop = None
-        self._expire_loop = None
         self._port = None
+        # interface address -> InterfaceProtocol, if serving several
+        self._interfaces = {}
+        self._ports = []
+        if isinstance(interface, (list, tuple)):
+            if len(interface) == 1:
+                interface = interface[0]
+            else:
+                for address in interface:
+                    self._interfaces[address] = InterfaceProtocol(self,
+                                                                  address)
         if not self.__test:
             try:
-                self._port = reactor.listenMulticast(SSDP_PORT, self,
-                                                    listenMultiple=True)
-                #self.port.setLoopbackMode(1)
-                self._port.joinGroup(SSDP_ADDR, interface=interface)
+                if self._interfaces:
+                    for address, protocol in self._interfaces.iteritems():
+                        self._ports.append(listen_on_interface(
+                            SSDP_PORT, protocol, address, SSDP_ADDR))
+                else:
+                    self._port = reactor.listenMulticast(SSDP_PORT, self,
+                                                        listenMultiple=True)
+                    #self.port.setLoopbackMode(1)
+                    self._port.joinGroup(SSDP_ADDR, interface=interface)
             except error.CannotListenError, err:
                 self.error("Error starting the SSDP-server: %s", err)
                 self.error("There seems to already be a SSDP server "
@@ -61,30 +346,37 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             # notify every 777 seconds (~ 13 Minutes)
             self._resend_notify_loop.start(777.0, now=False)
 
-            self._expire_loop = task.LoopingCall(self._expire)
-            # expire every 333 seconds (~ 5.5 Minutes)
-            self._expire_loop.start(333.0, now=False)
-
     def stopNotifying(self):
         if self._resend_notify_loop and self._resend_notify_loop.running:
             self._resend_notify_loop.stop()
         if self._port:
             self._port.stopListening()
+        for port in self._ports:
+            port.stopListening()
+        self._ports = []
+
+    def _transports(self):
+        """Return the (transport, interface address) pairs to send
+        multicast packets on."""
+        if self._interfaces:
+            return [(protocol.transport, address) for address, protocol
+                    in self._interfaces.iteritems()]
+        return [(self.transport, None)]
 
     def shutdown(self):
-        for call in reactor.getDelayedCalls():
-            if call.func == self.__send__discovery_request:
-                call.cancel()
+        self._responder.stop()
+        self._pacer.stop()
         if not self.__test:
             self.stopNotifying()
-            if self._expire_loop.running:
-                self._expire_loop.stop()
+            if self._expire_call and self._expire_call.active():
+                self._expire_call.cancel()
+            self._expire_call = None
             # Make sure we send out the byebye notifications.
             for st in self._known:
                 if self._known[st]['MANIFESTATION'] == 'local':
                     self.doByebye(st)
 
-    def datagramReceived(self, data, (host, port)):
+    def datagramReceived(self, data, (host, port), interface=None):
         """Handle a received multicast datagram."""
         cmd, headers, content = utils.parse_http_response(data)
         cmd = cmd[:2] # we are interested in only the first two elements
@@ -93,7 +385,7 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         self.debug('with headers: %s', headers)
         if cmd == ['M-SEARCH', '*']:
             # SSDP discovery
-            self._discoveryRequest(headers, (host, port))
+            self._discoveryRequest(headers, (host, port), interface)
         elif cmd == ['NOTIFY', '*']:
             # SSDP presence
             self._notifyReceived(headers, (host, port))
@@ -108,12 +400,17 @@ class SSDPServer(DatagramProtocol, log.Loggable):
                         server=SERVER_ID,
                         cache_control='max-age=1800',
                         silent=False,
-                        host=None):
+                        host=None,
+                        boot_id=None,
+                        config_id=None):
         """Register a service or device that this SSDP server will
         respond to."""
 
         self.info('Registering %s (%s)', st, location)
 
+        self._unindex(usn)
+        self._leases.pop(usn, None)
+        self._notifications.pop(usn, None)
         self._known[usn] = {
             'USN': usn, # Unique Service Name
             'LOCATION': location,
@@ -126,10 +423,16 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             'HOST': host,
             'last-seen': time.time(),
             }
+        if boot_id is not None:
+            self._known[usn]['BOOTID.UPNP.ORG'] = boot_id
+        if config_id is not None:
+            self._known[usn]['CONFIGID.UPNP.ORG'] = config_id
         self.debug('%r', self._known[usn])
-
         if manifestation == 'local':
+            self._index(usn)
             self.doNotify(usn)
+        else:
+            self._lease(usn, parse_max_age(cache_control))
 
         if st == 'upnp:rootdevice':
             louie.send('Coherence.UPnP.SSDP.new_device', None,
@@ -137,7 +440,7 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             #self.callback("new_device", st, self._known[usn])
 
     def unRegister(self, usn):
-        if not self._isKnown(usn):
+        if not self.isKnown(usn):
             return
         self.info("Un-registering %s", usn)
         st = self._known[usn]['ST']
@@ -145,8 +448,53 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             louie.send('Coherence.UPnP.SSDP.removed_device', None,
                        device_type=st, infos=self._known[usn])
             #self.callback("removed_device", st, self._known[usn])
+        self._unindex(usn)
+        self._leases.pop(usn, None)
+        self._notifications.pop(usn, None)
         del self._known[usn]
 
+    def _index(self, usn):
+        """Add a local entry to the M-SEARCH index and pre-serialize
+        its discovery response."""
+        entry = self._known[usn]
+        self._local_by_st.setdefault(entry['ST'], []).append(usn)
+        if not entry['SILENT']:
+            self._local_all.append(usn)
+        self._responses[usn] = {}
+        for transport, address in self._transports():
+            self._response(usn, address)
+
+    def _response(self, usn, interface):
+        """Return the M-SEARCH response for USN to send out on
+        interface, serialized once per entry and interface."""
+        responses = self._responses[usn]
+        try:
+            return responses[interface]
+        except KeyError:
+            pass
+        entry = self._known[usn]
+        response = ['HTTP/1.1 200 OK']
+        for k, v in entry.iteritems():
+            if k == 'LOCATION':
+                v = rewrite_location(v, entry['HOST'], interface)
+            if k not in ('MANIFESTATION', 'SILENT', 'HOST', 'last-seen'):
+                response.append('%s: %s' % (k, v))
+        response.append('DATE: ')
+        response = responses[interface] = '\r\n'.join(response)
+        return response
+
+    def _unindex(self, usn):
+        """Remove an entry from the M-SEARCH index, if it is in."""
+        if self._responses.pop(usn, None) is None:
+            return
+        st = self._known[usn]['ST']
+        usns = self._local_by_st[st]
+        usns.remove(usn)
+        if not usns:
+            del self._local_by_st[st]
+        if usn in self._local_all:
+            self._local_all.remove(usn)
+
     def isKnown(self, usn):
         return self._known.has_key(usn)
 
@@ -157,15 +505,28 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
         Returns True, if the service was unknown.
         """
+        usn = headers['usn']
         try:
-            self._known[headers['usn']]['last-seen'] = time.time()
+            self._known[usn]['last-seen'] = time.time()
+            max_age = self._leases[usn][0]
         except KeyError:
+            if self.isKnown(usn):
+                # a local entry, never expires
+                return False
             self.register('remote', headers['usn'], service_type,
                           headers['location'], headers['server'],
-                          headers['cache-control'], host=host)
+                          headers['cache-control'], host=host,
+                          boot_id=headers.get('bootid.upnp.org'),
+                          config_id=headers.get('configid.upnp.org'))
             return True
         else:
-            self.debug('updating last-seen for %r', headers['usn'])
+            self.debug('updating last-seen for %r', usn)
+            # the device may announce a different lease this time
+            cache_control = headers.get('cache-control')
+            if cache_control:
+                self._known[usn]['CACHE-CONTROL'] = cache_control
+                max_age = parse_max_age(cache_control)
+            self._lease(usn, max_age)
             return False
 
     def _notifyReceived(self, headers, (host, port)):
@@ -185,115 +546,162 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host,
                    'Notify %s for %s' % (headers['nts'], headers['usn']))
 
-    def __send__discovery_request(self, response, destination, delay, usn):
-        self.info('send discovery response delayed by %ds for %s to %r',
-                  delay, usn, destination)
+    def _send_discovery_response(self, usn, destination, interface=None):
+        try:
+            response = self._response(usn, interface)
+        except KeyError:
+            # un-registered meanwhile
+            return
+        if interface is None:
+            transport = self.transport
+        else:
+            transport = self._interfaces[interface].transport
+        self.info('send discovery response for %s to %r', usn, destination)
         try:
-            self.transport.write(response, destination)
+            transport.write(
+                response + datetimeToString() + '\r\n\r\n', destination)
         except (AttributeError, socket.error), msg:
-            self.info("failure sending out byebye notification: %r", msg)
+            self.info("failure sending out discovery response: %r", msg)
 
-    def _discoveryRequest(self, headers, (host, port)):
+    def _discoveryRequest(self, headers, (host, port), interface=None):
         """Process a discovery request.  The response must be sent to
-        the address specified by (host, port)."""
+        the address specified by (host, port), on the interface the
+        request came in."""
 
         self.info('Discovery request from (%s,%d) for %s',
                   host, port, headers['st'])
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host,
                    'M-Search for %s' % headers['st'])
         # Do we know about this service?
-        for known in self._known.values():
-            if known['MANIFESTATION'] == 'remote':
-                continue
-            elif known['SILENT'] and headers['st'] == 'ssdp:all':
-                continue
-            elif (headers['st'] == known['ST'] or
-                  headers['st'] == 'ssdp:all'):
-                response = []
-                response.append('HTTP/1.1 200 OK')
-                for k, v in known.iteritems():
-                    if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
-                        response.append('%s: %s' % (k, v))
-                response.append('DATE: %s' % datetimeToString())
-                response.extend(('', ''))
-                response = '\r\n'.join(response)
-
-                delay = random.randint(0, int(headers['mx']))
-                reactor.callLater(delay, self.__send__discovery_request,
-                                  response, (host, port), delay, known['USN'])
-
-    def __build_response(self, cmd, usn):
+        st = headers['st']
+        if st == 'ssdp:all':
+            usns = self._local_all
+        else:
+            usns = self._local_by_st.get(st, ())
+        if not usns:
+            return
+        try:
+            mx = min(max(int(headers['mx']), 0), 120)
+        except (KeyError, ValueError):
+            mx = 1
+        self._responder.schedule((host, port), st, usns, mx, interface)
+
+    def _notification(self, usn, nts, interface=None):
+        """Return the NOTIFY packet of type NTS for USN to send out on
+        interface, serialized once per entry and interface."""
+        try:
+            return self._notifications[usn][(nts, interface)]
+        except KeyError:
+            pass
         resp = ['NOTIFY * HTTP/1.1',
             'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
-            'NTS: %s' % cmd,
+            'NTS: %s' % nts,
             ]
-        stcpy = self._known[usn].copy()
-        stcpy['NT'] = stcpy['ST']
-        for k in ('ST', 'MANIFESTATION', 'SILENT', 'HOST', 'last-seen'):
-            try:
-                # :fixme: this keys should always exist as we build the entry
-                del stcpy[k]
-            except:
-                pass
-        resp.extend(': '.join(x) for x in stcpy.iteritems())
+        entry = self._known[usn]
+        for k, v in entry.iteritems():
+            if k == 'ST':
+                resp.append('NT: %s' % v)
+            elif k == 'LOCATION':
+                resp.append('LOCATION: %s' %
+                            rewrite_location(v, entry['HOST'], interface))
+            elif k not in ('MANIFESTATION', 'SILENT', 'HOST', 'last-seen'):
+                resp.append('%s: %s' % (k, v))
         resp.extend(('', ''))
-        return '\r\n'.join(resp)
+        resp = '\r\n'.join(resp)
+        self._notifications.setdefault(usn, {})[(nts, interface)] = resp
+        return resp
+
+    def _send_notification(self, usn, nts):
+        if not self.isKnown(usn):
+            # un-registered meanwhile
+            return
+        self.debug('sending %s notification for %s', nts, usn)
+        for transport, interface in self._transports():
+            resp = self._notification(usn, nts, interface)
+            try:
+                transport.write(resp, (SSDP_ADDR, SSDP_PORT))
+            except (AttributeError, socket.error), msg:
+                self.info("failure sending out %s notification: %r",
+                          nts, msg)
+
+    def announce(self, usns, nts='ssdp:alive'):
+        """Send notifications of type NTS for the USNs, spread over the
+        announcement window."""
+        for usn in usns:
+            self._pacer.schedule(usn, nts)
 
     def doNotify(self, usn):
         """Do notification"""
         if self._known[usn]['SILENT']:
             return
         self.info('Sending alive notification for %s', usn)
-        resp = self.__build_response('ssdp:alive', usn)
-        self.debug('doNotify content %s', resp)
-        try:
-            # :fixme: why is this sent twice?
-            self.transport.write(resp, (SSDP_ADDR, SSDP_PORT))
-            self.transport.write(resp, (SSDP_ADDR, SSDP_PORT))
-        except (AttributeError, socket.error), msg:
-            self.info("failure sending out alive notification: %r", msg)
+        self._send_notification(usn, 'ssdp:alive')
+        # repeat it, because UDP is unreliable
+        self._pacer.schedule(usn, 'ssdp:alive')
 
     def doByebye(self, usn):
         """Do byebye"""
-        # :todo: unite with doNotify(). Why are there differences at all?
         self.info('Sending byebye notification for %s', usn)
-        resp = self.__build_response('ssdp:byebye', usn)
-        self.debug('doByebye content %s', resp)
-        if self.transport:
-            try:
-                self.transport.write(resp, (SSDP_ADDR, SSDP_PORT))
-            except (AttributeError, socket.error), msg:
-                self.info("failure sending out byebye notification: %r",
-                          msg)
+        # an alive still pending would bring the entry back to life
+        self._pacer.cancel(usn)
+        self._send_notification(usn, 'ssdp:byebye')
 
     def _resendNotify(self):
-        for usn, entry in self._known.iteritems():
-            if entry['MANIFESTATION'] == 'local':
-                self.doNotify(usn)
+        usns = [usn for usn, entry in self._known.iteritems()
+                if entry['MANIFESTATION'] == 'local' and not entry['SILENT']]
+        # twice, because UDP is unreliable
+        self.announce(usns)
+        self.announce(usns)
+
+    def _lease(self, usn, max_age):
+        """(Re-)start the lease of a remote entry."""
+        deadline = reactor.seconds() + max_age + EXPIRY_GRACE
+        self._leases[usn] = (max_age, deadline)
+        heapq.heappush(self._lease_heap, (deadline, usn))
+        if len(self._lease_heap) > 2 * len(self._leases) + 64:
+            # drop the outdated pairs piling up by refreshed leases
+            self._lease_heap = [(d, u) for u, (m, d) in
+                                self._leases.iteritems()]
+            heapq.heapify(self._lease_heap)
+        self._schedule_expire()
+
+    def _schedule_expire(self):
+        """Make sure _expire is called at the next lease deadline."""
+        if self.__test:
+            return
+        if not self._lease_heap:
+            if self._expire_call and self._expire_call.active():
+                self._expire_call.cancel()
+            return
+        deadline = self._lease_heap[0][0]
+        if self._expire_call and self._expire_call.active():
+            if self._expire_call.getTime() <= deadline:
+                return
+            self._expire_call.cancel()
+        delay = max(0, deadline - reactor.seconds())
+        self._expire_call = reactor.callLater(delay, self._expire)
 
     def _expire(self):
-        """ check if the discovered devices are still ok, or
-            if we haven't received a new discovery response
+        """ expire the discovered devices and services we haven't
+            received a new announcement or discovery response from
+            within their max-age
         """
-        self.debug("Checking devices/services are still valid")
-        removable = []
-        for usn, entry in self._known.iteritems():
-            if entry['MANIFESTATION'] == 'local':
+        now = reactor.seconds()
+        heap = self._lease_heap
+        while heap and heap[0][0] <= now:
+            deadline, usn = heapq.heappop(heap)
+            lease = self._leases.get(usn)
+            if lease is None or lease[1] != deadline:
+                # unregistered or refreshed meanwhile
                 continue
-            expiry = int(entry['CACHE-CONTROL'].split('=')[1])
-            now = time.time()
-            last_seen = entry['last-seen']
-            self.debug("Checking if %r is still valid - "
-                       "last seen %d (+%d), now %d",
-                       entry['USN'], last_seen, expiry, now)
-            if last_seen + expiry + 30 < now:
-                self.debug("Expiring: %r", entry)
-                if entry['ST'] == 'upnp:rootdevice':
-                    louie.send('Coherence.UPnP.SSDP.removed_device', None,
-                               device_type=entry['ST'], infos=entry)
-                removable.append(usn)
-        for usn in removable:
-            del self._known[usn]
+            del self._leases[usn]
+            self._notifications.pop(usn, None)
+            entry = self._known.pop(usn)
+            self.debug("Expiring: %r", entry)
+            if entry['ST'] == 'upnp:rootdevice':
+                louie.send('Coherence.UPnP.SSDP.removed_device', None,
+                           device_type=entry['ST'], infos=entry)
+        self._schedule_expire()
 
     def subscribe(self, name, callback):
         self._callbacks.setdefault(name, []).append(callback)
@@ -12,8 +12,9 @@ Test cases for L{upnp.core.action}
 import time
 
 from twisted.trial import unittest
-from twisted.internet import protocol
+from twisted.internet import protocol, task
 from twisted.internet.defer import Deferred, DeferredList
+from twisted.python import failure
 from twisted.test import proto_helpers
 
 from coherence.upnp.core import action
@@ -256,3 +257,225 @@ class TestAction2(unittest.TestCase):
         result = self.action.call(InstanceID=23, Color='red')
         result.addCallback(check_result)
         return result
+
+
+class PendingClient:
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, action_name, arguments):
+        d = Deferred()
+        self.calls.append((action_name, dict(arguments), d))
+        return d
+
+
+class TestActionCallPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(action, 'reactor', self.clock)
+        self.patch(action, 'call_policies', {})
+        self.patch(action, 'scheduler', None)
+        self.service = DummyServiceWithStateVariables('Brightness')
+        self.service.service_type = 'urn:schemas-upnp-org:service:Dimming:1'
+        self.action = action.Action(self.service, 'SomeTestAction',
+                                    NoImplementation,
+                                    _build_action_arguments())
+        self.client = PendingClient()
+        self.service._set_client(self.client)
+
+    def call(self, **kwargs):
+        result = []
+        self.action.call(InstanceID=23, Color='red', **kwargs).addBoth(
+            result.append)
+        return result
+
+    def test_without_policy(self):
+        self.call()
+        self.call()
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_policy_lookup(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 1)
+        self.assertEqual(action.get_call_policy(
+            'urn:schemas-upnp-org:service:Dimming:1', 'SomeTestAction'), 1)
+        action.set_call_policy('urn:schemas-upnp-org:service:Dimming:1',
+                               'SomeTestAction', 0)
+        self.assertEqual(action.get_call_policy(
+            'urn:schemas-upnp-org:service:Dimming:1', 'SomeTestAction'), 0)
+        self.assertEqual(action.get_call_policy(
+            'urn:schemas-upnp-org:service:Dimming:1', 'Other'), None)
+        action.set_call_policy('Dimming', 'SomeTestAction', None)
+        self.assertEqual(action.get_call_policy('Dimming', 'SomeTestAction'),
+                         None)
+
+    def test_identical_calls_are_merged(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 0)
+        first, second = self.call(), self.call()
+        self.assertEqual(len(self.client.calls), 1)
+        self.client.calls[0][2].callback({'CurrentBrightness': 12})
+        self.assertEqual(first, [{'CurrentBrightness': 12}])
+        self.assertEqual(second, first)
+        self.assertIsNot(second[0], first[0])
+        # no ttl, no caching
+        self.call()
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_other_arguments_are_not_merged(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 0)
+        self.call()
+        result = []
+        self.action.call(InstanceID=0, Color='red').addBoth(result.append)
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_errors_reach_all_callers(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 5)
+        first, second = self.call(), self.call()
+        self.client.calls[0][2].errback(Exception('401 - Invalid Action'))
+        self.assertEqual(first[0].getErrorMessage(), '401 - Invalid Action')
+        self.assertEqual(second[0].getErrorMessage(), '401 - Invalid Action')
+        self.call()
+        self.assertEqual(len(self.client.calls), 2)
+        self.flushLoggedErrors()
+
+    def test_results_are_cached(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 5)
+        self.call()
+        self.client.calls[0][2].callback({'CurrentBrightness': 12})
+        self.clock.advance(4)
+        self.assertEqual(self.call(), [{'CurrentBrightness': 12}])
+        self.assertEqual(len(self.client.calls), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.call(), [])
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_cached_results_are_copies(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 5)
+        first = self.call()
+        self.client.calls[0][2].callback({'CurrentBrightness': 12})
+        first[0]['CurrentBrightness'] = 0
+        self.assertEqual(self.call(), [{'CurrentBrightness': 12}])
+
+    def test_invalidation(self):
+        action.set_call_policy('Dimming', 'SomeTestAction', 5)
+        self.call()
+        self.client.calls[0][2].callback({'CurrentBrightness': 12})
+        self.action.invalidate_cache()
+        self.call()
+        self.assertEqual(len(self.client.calls), 2)
+        # an event arriving while in flight keeps the result out of the cache
+        self.action.invalidate_cache()
+        self.client.calls[1][2].callback({'CurrentBrightness': 13})
+        self.call()
+        self.assertEqual(len(self.client.calls), 3)
+
+
+class TestCallScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(action, 'reactor', self.clock)
+        self.scheduler = action.CallScheduler(max_limit=4, initial_limit=2,
+                                              latency_target=1.0)
+        self.pending = []
+        self.results = []
+
+    def _call(self, name):
+        d = Deferred()
+        self.pending.append((name, d))
+        return d
+
+    def schedule(self, name, priority=action.PRIORITY_INTERACTIVE, key='host'):
+        d = self.scheduler.run(key, priority, self._call, name)
+        d.addBoth(self.results.append)
+        return d
+
+    def finish(self, index=0, result=None, error=None):
+        name, d = self.pending.pop(index)
+        if error is not None:
+            d.errback(error)
+        else:
+            d.callback(result or name)
+
+    def test_limit(self):
+        for name in 'abcd':
+            self.schedule(name)
+        self.assertEqual([name for name, d in self.pending], ['a', 'b'])
+        self.finish()
+        self.assertEqual([name for name, d in self.pending], ['b', 'c'])
+        self.assertEqual(self.results, ['a'])
+
+    def test_devices_are_independent(self):
+        for name in 'abc':
+            self.schedule(name, key='one')
+        self.schedule('x', key='other')
+        self.assertEqual([name for name, d in self.pending], ['a', 'b', 'x'])
+
+    def test_priorities(self):
+        self.schedule('a')
+        self.schedule('b')
+        self.schedule('crawl', action.PRIORITY_BACKGROUND)
+        self.schedule('click')
+        self.finish()
+        self.assertEqual(self.pending[-1][0], 'click')
+        self.finish()
+        self.assertEqual(self.pending[-1][0], 'crawl')
+
+    def test_grows_while_fast(self):
+        for i in range(20):
+            self.schedule(i)
+            self.clock.advance(0.1)
+            self.finish()
+        self.assertEqual(self.scheduler.get_limit('host'), 4)
+
+    def test_halved_on_error(self):
+        for i in range(20):
+            self.schedule(i)
+            self.finish()
+        for i in range(4):
+            self.schedule(i)
+        self.assertEqual(len(self.pending), 4)
+        self.finish(error=Exception('timeout'))
+        self.assertEqual(self.scheduler.get_limit('host'), 2)
+        # the other calls in flight at that time don't lower it again
+        self.clock.advance(1)
+        self.finish(error=Exception('timeout'))
+        self.assertEqual(self.scheduler.get_limit('host'), 2)
+        self.assertIsInstance(self.results[-1], failure.Failure)
+        self.flushLoggedErrors()
+
+    def test_lowered_when_slow(self):
+        self.schedule('a')
+        self.clock.advance(1.5)
+        self.finish()
+        self.assertEqual(self.scheduler.get_limit('host'), 1)
+        self.schedule('b')
+        self.schedule('c')
+        self.assertEqual(len(self.pending), 1)
+
+    def test_timeout_frees_the_place(self):
+        self.schedule('a')
+        self.schedule('b')
+        self.schedule('c')
+        self.clock.advance(30)
+        self.assertEqual([name for name, d in self.pending], ['a', 'b', 'c'])
+        self.assertEqual(self.scheduler.get_limit('host'), 1)
+        # answering late changes nothing anymore
+        self.finish()
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(self.results, ['a'])
+
+    def test_action_call_priority(self):
+        self.patch(action, 'scheduler', self.scheduler)
+        service = DummyServiceWithStateVariables('Brightness')
+        client = PendingClient()
+        service._set_client(client)
+        act = action.Action(service, 'SomeTestAction', NoImplementation,
+                            _build_action_arguments())
+        for i in range(3):
+            act.call(InstanceID=i, Color='red',
+                     priority=action.PRIORITY_BACKGROUND)
+        act.call(InstanceID=9, Color='red')
+        self.assertEqual(len(client.calls), 2)
+        client.calls[0][2].callback({})
+        self.assertEqual(client.calls[2][1]['InstanceID'], 9)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.description_cache}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from coherence.upnp.core import description_cache, device
+
+URL = 'http://192.168.1.10:49152/description.xml'
+
+
+class TestDescriptionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(description_cache, 'reactor', self.clock)
+        self.pages = {URL: '<root>one</root>'}
+        self.fetched = []
+        self.patch(description_cache.utils, 'getPage', self._getPage)
+        self.cache = description_cache.DescriptionCache(self.mktemp())
+
+    def _getPage(self, url):
+        self.fetched.append(url)
+        return defer.succeed((self.pages[url], {}))
+
+    def _get(self, key=None, changed=None):
+        result = []
+        self.cache.getPage(URL, key, changed).addCallback(result.append)
+        self.clock.advance(0)
+        return result[0][0]
+
+    def test_miss_fetches_and_stores(self):
+        self.assertEqual(self._get(), '<root>one</root>')
+        self.assertEqual(self.fetched, [URL])
+        self.assertEqual(self.cache.get(URL)[0], '<root>one</root>')
+        self.assertEqual(self.cache.counters['misses'], 1)
+
+    def test_hit_never_calls_back_synchronously(self):
+        self.cache.put(URL, '<root>one</root>', '1/7')
+        result = []
+        self.cache.getPage(URL, '1/7').addCallback(result.append)
+        self.assertEqual(result, [])
+        self.clock.advance(0)
+        self.assertEqual(result, [('<root>one</root>', {})])
+
+    def test_matching_configid_is_not_refetched(self):
+        self._get('1/7')
+        self.pages[URL] = '<root>two</root>'
+        self.assertEqual(self._get('1/7'), '<root>one</root>')
+        self.assertEqual(self.fetched, [URL])
+        self.assertEqual(self.cache.counters['hits'], 1)
+
+    def test_other_configid_is_a_miss(self):
+        self._get('1/7')
+        self.pages[URL] = '<root>two</root>'
+        self.assertEqual(self._get('2/8'), '<root>two</root>')
+        self.assertEqual(self.cache.get(URL, '2/8')[0], '<root>two</root>')
+        self.assertEqual(self.cache.get(URL, '1/7'), None)
+
+    def test_revalidation_by_content(self):
+        changed = []
+        self._get()
+        self.assertEqual(self._get(changed=changed.append), '<root>one</root>')
+        self.assertEqual(changed, [])
+        self.pages[URL] = '<root>two</root>'
+        self.assertEqual(self._get(changed=changed.append), '<root>one</root>')
+        self.assertEqual(changed, [URL])
+        self.assertEqual(self.cache.counters['changed'], 1)
+        self.assertEqual(self._get(changed=changed.append), '<root>two</root>')
+        self.assertEqual(len(self.fetched), 4)
+
+    def test_failed_revalidation_keeps_entry(self):
+        self._get()
+        self.patch(description_cache.utils, 'getPage',
+                   lambda url: defer.fail(IOError('unreachable')))
+        self.assertEqual(self._get(), '<root>one</root>')
+        self.assertEqual(self.cache.get(URL)[0], '<root>one</root>')
+
+    def test_corrupt_entry_is_ignored(self):
+        self.cache.put(URL, '<root>one</root>')
+        f = open(self.cache._filename(URL), 'ab')
+        f.write('garbage')
+        f.close()
+        self.assertEqual(self.cache.get(URL), None)
+
+    def test_module_getPage_without_cache(self):
+        self.patch(description_cache, '_cache', None)
+        result = []
+        description_cache.getPage(URL, '1/7').addCallback(result.append)
+        self.assertEqual(result, [('<root>one</root>', {})])
+
+    def test_description_key(self):
+        self.assertEqual(description_cache.description_key('1', '7'), '1/7')
+        self.assertEqual(description_cache.description_key('1', None), None)
+        self.assertEqual(description_cache.description_key(None, None), None)
+
+
+class TestRootDeviceDescriptionChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(description_cache.utils, 'getPage',
+                   lambda url: defer.Deferred())
+        self.device = device.RootDevice({
+            'USN': 'uuid:1234::upnp:rootdevice',
+            'SERVER': 'some server',
+            'ST': 'upnp:rootdevice',
+            'LOCATION': URL,
+            'MANIFESTATION': 'remote',
+            'HOST': '192.168.1.10',
+            'BOOTID.UPNP.ORG': '1',
+            'CONFIGID.UPNP.ORG': '7',
+            })
+        self.changed = []
+        self.patch(device.louie, 'send', self._send)
+
+    def _send(self, signal, sender=None, *args, **kwargs):
+        if signal == 'Coherence.UPnP.RootDevice.description_changed':
+            self.changed.append(kwargs['device'])
+
+    def test_description_key(self):
+        self.assertEqual(self.device.get_description_key(), '1/7')
+
+    def test_changed_waits_for_detection(self):
+        self.device.description_changed(URL)
+        self.assertEqual(self.changed, [])
+        self.assertTrue(self.device.description_stale)
+        self.device.detection_completed = True
+        self.device.device_detect()
+        self.assertEqual(self.changed, [self.device])
+
+    def test_embedded_device_reports_to_root(self):
+        embedded = device.Device(self.device)
+        self.assertEqual(embedded.get_description_key(), '1/7')
+        self.device.root_detection_completed = True
+        embedded.description_changed(URL)
+        self.assertEqual(self.changed, [self.device])
@@ -85,3 +85,129 @@ class TestDIDLLite(unittest.TestCase):
             'object.wrongcontainer.wrongalbum.videoAlbum')
         self.assertRaises(AttributeError,
                           DIDLLite.DIDLElement.fromString, wrong_didl_fragment)
+
+
+class TestFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.track = DIDLLite.MusicTrack('1', '0', 'Help!')
+        self.track.artist = 'The Beatles'
+        self.track.album = 'Help!'
+        res = DIDLLite.Resource('http://host/1.mp3', 'http-get:*:audio/mpeg:*')
+        res.size = 4200
+        res.duration = '0:02:18'
+        self.track.res.append(res)
+
+    def serialize(self, filter):
+        didl = DIDLLite.DIDLElement(filter=filter)
+        didl.addItem(self.track)
+        return didl.getchildren()[0]
+
+    def tags(self, element):
+        return [child.tag.split('}')[-1] for child in element]
+
+    def test_all(self):
+        for filter in (None, '*', 'dc:title,*', ''):
+            self.assertIdentical(DIDLLite.get_filter(filter), None)
+            element = self.serialize(filter)
+            self.assertIn('artist', self.tags(element))
+            self.assertIn('size', element.find('res').attrib)
+
+    def test_required_only(self):
+        element = self.serialize('upnp:artist')
+        self.assertEqual(sorted(self.tags(element)),
+                         ['artist', 'class', 'title'])
+        self.assertEqual(sorted(element.attrib),
+                         ['id', 'parentID', 'restricted'])
+
+    def test_res_attributes(self):
+        element = self.serialize('res@duration')
+        res = element.find('res')
+        self.assertEqual(res.text, 'http://host/1.mp3')
+        self.assertEqual(sorted(res.attrib), ['duration', 'protocolInfo'])
+        self.assertNotIn('album', self.tags(element))
+
+        element = self.serialize('res,upnp:album')
+        self.assertEqual(sorted(element.find('res').attrib),
+                         ['protocolInfo'])
+        self.assertIn('album', self.tags(element))
+
+    def test_container_attributes(self):
+        container = DIDLLite.Container('2', '0', 'Music')
+        container.childCount = 3
+        didl = DIDLLite.DIDLElement(filter='dc:title')
+        didl.addItem(container)
+        self.assertNotIn('childCount', didl.getchildren()[0].attrib)
+        didl = DIDLLite.DIDLElement(filter='@childCount')
+        didl.addItem(container)
+        self.assertEqual(didl.getchildren()[0].attrib['childCount'], '3')
+
+    def test_compiled_once(self):
+        filter = 'dc:title, upnp:artist'
+        compiled = DIDLLite.get_filter(filter)
+        self.assertIdentical(DIDLLite.get_filter(filter), compiled)
+        self.assertEqual(compiled.names,
+                         frozenset(['dc:title', 'upnp:artist']))
+
+
+class TestFragments(unittest.TestCase):
+
+    def setUp(self):
+        self.track = DIDLLite.MusicTrack('1', '0', u'Caf\xe9 & Bar')
+        self.track.artist = 'Someone'
+        self.track.date = '2008-01-01'
+        self.res = DIDLLite.Resource('http://host/1.mp3',
+                                     'http-get:*:audio/mpeg:*')
+        self.res.size = 4200
+        self.track.res.append(self.res)
+        self.album = DIDLLite.MusicAlbum('2', '0', 'Album')
+        self.album.date = '2008-01-01'
+
+    def didl(self, **kwargs):
+        didl = DIDLLite.DIDLElement(**kwargs)
+        didl.addItem(self.track)
+        didl.addItem(self.album)
+        return didl
+
+    def test_same_as_tree(self):
+        didl = self.didl()
+        self.assertEqual(didl.toString(),
+                         DIDLLite.ET.tostring(didl, encoding='utf-8'))
+        # and again from the kept fragments
+        self.assertEqual(self.didl().toString(), didl.toString())
+
+    def test_kept_until_changed(self):
+        element = self.didl().getchildren()[0]
+        self.assertIdentical(self.didl().getchildren()[0], element)
+        self.track.artist = 'Someone Else'
+        changed = self.didl().getchildren()[0]
+        self.assertNotIdentical(changed, element)
+        self.assertIn('Someone Else', self.didl().toString())
+        self.res.size = 4201
+        self.assertIn('size="4201"', self.didl().toString())
+        self.track.res.append(DIDLLite.Resource('http://host/1.ogg',
+                                                'http-get:*:audio/ogg:*'))
+        self.assertIn('http://host/1.ogg', self.didl().toString())
+
+    def test_changed_in_place(self):
+        self.didl().toString()
+        self.track.genres = ['Jazz']
+        self.didl().toString()
+        self.track.genres.append('Blues')
+        self.track.changed()
+        self.assertIn('Blues', self.didl().toString())
+
+    def test_per_options(self):
+        plain = self.didl().toString()
+        filtered = self.didl(filter='dc:title').toString()
+        self.assertNotIn('Someone', filtered)
+        moved = self.didl(parent_container='5').toString()
+        self.assertIn('parentID="5"', moved)
+        self.assertEqual(self.didl().toString(), plain)
+
+    def test_added_container(self):
+        didl = self.didl()
+        didl.addContainer('3', '0', 'More')
+        self.assertEqual(didl.toString(),
+                         DIDLLite.ET.tostring(didl, encoding='utf-8'))
+        self.assertIn('More', didl.toString())
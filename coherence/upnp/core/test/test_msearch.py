@@ -12,10 +12,10 @@ Test cases for L{upnp.core.msearch}
 import time
 
 from twisted.trial import unittest
-from twisted.internet import protocol
+from twisted.internet import protocol, task
 from twisted.test import proto_helpers
 
-from coherence.upnp.core import msearch, ssdp
+from coherence.upnp.core import msearch, ssdp, utils
 
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
@@ -96,3 +96,137 @@ class TestMSearch(unittest.TestCase):
         self.assertEqual((host, port), (SSDP_ADDR, SSDP_PORT))
         recieved = data.splitlines(True)
         self.assertEqual(sorted(recieved), sorted(expected))
+
+
+USN_2 = 'uuid:7076436f::urn:schemas-upnp-org:device:MediaServer:1'
+MSEARCH_RESPONSE_2 = (
+    'HTTP/1.1 200 OK',
+    'Cache-Control: max-age=1800',
+    'Ext: ',
+    'Location: http://192.168.1.5:49152/description.xml',
+    'Server: Linux/3.2 UPnP/1.0 MiniDLNA/1.1',
+    'ST: urn:schemas-upnp-org:device:MediaServer:1',
+    'USN: ' + USN_2,
+    )
+
+
+class TestMSearchPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(msearch, 'reactor', self.clock)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.ssdp_server = ssdp.SSDPServer(test=True)
+        self.ssdp_server.makeConnection(self.tr)
+        self.proto = msearch.MSearch(self.ssdp_server, test=True, mx=3,
+                                     interval=10, max_interval=40)
+        self.proto.makeConnection(self.tr)
+
+    def tearDown(self):
+        self.proto.stopDiscovery()
+
+    def searched(self):
+        sts = [utils.parse_http_response(data)[1]['st']
+               for data, addr in self.tr.written]
+        del self.tr.written[:]
+        return sts
+
+    def test_discover_mx(self):
+        self.proto.discover('upnp:rootdevice')
+        cmd, headers, content = utils.parse_http_response(
+            self.tr.written[0][0])
+        self.assertEqual(headers['mx'], '3')
+        self.assertEqual(headers['st'], 'upnp:rootdevice')
+
+    def test_set_targets(self):
+        self.proto.set_targets(['urn:schemas-upnp-org:device:MediaServer:1',
+                                'ssdp:all'])
+        self.assertEqual(self.searched(),
+                         ['urn:schemas-upnp-org:device:MediaServer:1'])
+        self.proto.set_targets([])
+        self.assertEqual(self.proto.targets, ['ssdp:all'])
+
+    def test_backoff_while_stable(self):
+        self.proto.search_round(burst=True)
+        self.assertEqual(self.searched(), ['ssdp:all', 'ssdp:all'])
+        intervals = []
+        for i in range(4):
+            self.clock.advance(self.proto.interval)
+            self.assertEqual(self.searched(), ['ssdp:all'])
+            intervals.append(self.proto.interval)
+        self.assertEqual(intervals, [20, 40, 40, 40])
+
+    def test_new_device_resets_interval(self):
+        self.proto.search_round(burst=True)
+        self.clock.advance(10)
+        self.assertEqual(self.proto.interval, 20)
+        data = '\r\n'.join(MSEARCH_RESPONSE_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.clock.advance(20)
+        self.assertEqual(self.proto.interval, 10)
+
+    def test_network_changed(self):
+        self.proto.search_round(burst=True)
+        self.clock.advance(10)
+        del self.tr.written[:]
+        self.proto.network_changed()
+        self.assertEqual(self.proto.interval, 10)
+        self.assertEqual(self.searched(), ['ssdp:all', 'ssdp:all'])
+
+    def test_targeted_response_resolves_root(self):
+        self.proto.set_targets(['urn:schemas-upnp-org:device:MediaServer:1'])
+        self.searched()
+        data = '\r\n'.join(MSEARCH_RESPONSE_2) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('192.168.1.5', 1900))
+        self.proto.datagramReceived(data, ('192.168.1.5', 1900))
+        self.clock.advance(4)
+        self.assertEqual(self.searched(), ['upnp:rootdevice'])
+
+    def test_unanswered_root_is_searched_again(self):
+        self.proto.set_targets(['urn:schemas-upnp-org:device:MediaServer:1'])
+        self.searched()
+        data = '\r\n'.join(MSEARCH_RESPONSE_2) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('192.168.1.5', 1900))
+        self.clock.advance(6)
+        self.assertEqual(self.searched(), ['upnp:rootdevice'])
+        # the root device didn't answer, the next response tries again
+        self.proto.datagramReceived(data, ('192.168.1.5', 1900))
+        self.clock.advance(6)
+        self.assertEqual(self.searched(), ['upnp:rootdevice'])
+
+    def test_targeted_response_refreshes_root(self):
+        root_usn = 'uuid:7076436f::upnp:rootdevice'
+        self.ssdp_server.register('remote', root_usn, 'upnp:rootdevice',
+                                  'http://192.168.1.5:49152/description.xml')
+        self.ssdp_server._known[root_usn]['last-seen'] = 0
+        self.proto.set_targets(['urn:schemas-upnp-org:device:MediaServer:1'])
+        self.searched()
+        data = '\r\n'.join(MSEARCH_RESPONSE_2) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('192.168.1.5', 1900))
+        self.assertNotEqual(self.ssdp_server._known[root_usn]['last-seen'], 0)
+        self.clock.advance(4)
+        self.assertEqual(self.searched(), [])
+
+
+class TestMSearchInterfaces(unittest.TestCase):
+
+    def test_discover_on_each_interface(self):
+        ssdp_server = ssdp.SSDPServer(test=True)
+        proto = msearch.MSearch(ssdp_server, test=True,
+                                interfaces=['10.20.30.1', '192.168.5.1'])
+        trs = []
+        for protocol in proto._interfaces:
+            trs.append(proto_helpers.FakeDatagramTransport())
+            protocol.makeConnection(trs[-1])
+        proto.discover()
+        for tr in trs:
+            self.assertEqual(len(tr.written), 1)
+            self.assertEqual(tr.written[0][1], (SSDP_ADDR, SSDP_PORT))
+
+    def test_response_on_interface(self):
+        ssdp_server = ssdp.SSDPServer(test=True)
+        proto = msearch.MSearch(ssdp_server, test=True,
+                                interfaces=['10.20.30.1', '192.168.5.1'])
+        data = '\r\n'.join(MSEARCH_RESPONSE_1) + '\r\n\r\n'
+        proto._interfaces[1].datagramReceived(data, ('192.168.1.4', 1900))
+        self.assertTrue(ssdp_server.isKnown(USN_1))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.search_criteria}
+"""
+
+from twisted.trial import unittest
+
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.core.search_criteria import parse, capabilities, \
+     SearchCriteriaError, All, And, Or, Relation, Exists
+
+
+def track(title, artist=None, size=None):
+    item = DIDLLite.MusicTrack('1', '0', title)
+    item.artist = artist
+    res = DIDLLite.Resource('http://host/1.mp3', 'http-get:*:audio/mpeg:*')
+    res.size = size
+    item.res.append(res)
+    return item
+
+
+class TestParser(unittest.TestCase):
+
+    def test_all(self):
+        self.assertIsInstance(parse('*'), All)
+        self.assertIsInstance(parse(' * '), All)
+
+    def test_relation(self):
+        e = parse('dc:title contains "Love"')
+        self.assertIsInstance(e, Relation)
+        self.assertEqual((e.property, e.op, e.value),
+                         ('dc:title', 'contains', u'Love'))
+
+    def test_precedence(self):
+        e = parse('@id = "1" or @id = "2" and dc:title exists true')
+        self.assertIsInstance(e, Or)
+        self.assertIsInstance(e.right, And)
+        self.assertIsInstance(e.right.right, Exists)
+        e = parse('(@id = "1" or @id = "2") and dc:title exists true')
+        self.assertIsInstance(e, And)
+        self.assertIsInstance(e.left, Or)
+
+    def test_escaped_quotes(self):
+        e = parse(r'dc:title = "say \"hi\" \\ bye"')
+        self.assertEqual(e.value, u'say "hi" \\ bye')
+
+    def test_operators_without_blanks(self):
+        e = parse('res@size>="100"')
+        self.assertEqual((e.property, e.op, e.value),
+                         ('res@size', '>=', u'100'))
+
+    def test_invalid(self):
+        for criteria in ('', 'dc:title', 'dc:title contains',
+                         'dc:title contains love', 'dc:title like "x"',
+                         'foo:bar = "x"', '(dc:title = "x"',
+                         'dc:title = "x" and', 'dc:title = "x" "y"',
+                         'dc:title exists maybe', 'dc:title = "x',
+                         'dc:title = "\xff"'):
+            self.assertRaises(SearchCriteriaError, parse, criteria)
+
+    def test_parsed_once(self):
+        criteria = 'upnp:class derivedfrom "object.item"'
+        self.assertIdentical(parse(criteria), parse(criteria))
+
+    def test_capabilities(self):
+        caps = capabilities().split(',')
+        self.assertIn('upnp:class', caps)
+        self.assertIn('dc:title', caps)
+        self.assertIn('res@protocolInfo', caps)
+
+
+class TestEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.track = track(u'All You Need Is Love', artist='The Beatles',
+                           size=4200)
+        self.album = DIDLLite.MusicAlbum('2', '0', 'Help!')
+
+    def assertMatches(self, criteria, obj=None):
+        self.assertTrue(parse(criteria).matches(obj or self.track), criteria)
+
+    def assertNotMatches(self, criteria, obj=None):
+        self.assertFalse(parse(criteria).matches(obj or self.track), criteria)
+
+    def test_derivedfrom(self):
+        self.assertMatches('upnp:class derivedfrom "object.item.audioItem"')
+        self.assertMatches('upnp:class derivedfrom "object.item.audioItem.musicTrack"')
+        self.assertNotMatches('upnp:class derivedfrom "object.item.audio"')
+        self.assertNotMatches('upnp:class derivedfrom "object.container"')
+        self.assertMatches('upnp:class derivedfrom "object.container"',
+                           self.album)
+
+    def test_strings_ignore_case(self):
+        self.assertMatches('dc:title contains "LOVE"')
+        self.assertMatches('upnp:artist = "the beatles"')
+        self.assertMatches('dc:title startsWith "all you"')
+        self.assertNotMatches('dc:title doesNotContain "love"')
+        self.assertMatches('dc:title doesNotContain "hate"')
+
+    def test_numbers(self):
+        self.assertMatches('res@size > "1000"')
+        self.assertMatches('res@size <= "4200"')
+        self.assertNotMatches('res@size < "1000"')
+        self.assertMatches('@id = "1"')
+
+    def test_multiple_values(self):
+        self.assertMatches('res@protocolInfo contains "audio/mpeg"')
+        self.track.res.append(DIDLLite.Resource('http://host/1.ogg',
+                                                'http-get:*:audio/ogg:*'))
+        self.assertMatches('res@protocolInfo contains "audio/ogg"')
+        self.assertNotMatches('res@protocolInfo doesNotContain "audio/ogg"')
+
+    def test_exists(self):
+        self.assertMatches('upnp:artist exists true')
+        self.assertMatches('upnp:album exists false')
+        self.assertNotMatches('upnp:album = "Help!"')
+        self.assertMatches('upnp:album doesNotContain "Help!"')
+
+    def test_unicode(self):
+        self.track.title = u'Caf\xe9 del Mar'
+        self.assertMatches('dc:title contains "caf\xc3\xa9"')
+        self.assertMatches(u'dc:title contains "CAF\xc9"')
+
+    def test_logic(self):
+        self.assertMatches('upnp:class derivedfrom "object.item.audioItem"'
+                           ' and (dc:title contains "love" or'
+                           ' dc:title contains "help")')
+        self.assertNotMatches('upnp:class derivedfrom "object.item.audioItem"'
+                              ' and dc:title contains "help"')
@@ -27,6 +27,8 @@ class DummyDevice:
     def get_location(self): return "DummyDevice's Location"
     def get_urlbase(self): return "DummyDevice's URL base"
     def get_id(self):return "DummyDevice's ID"
+    def get_description_key(self): return None
+    def description_changed(self, url=None): pass
     def make_fullyqualified(self, url):
         return "DummyDevice's FQ-URL/" + url
 
@@ -418,6 +420,61 @@ class DescriptionWithWrongNamespace(CompleteDescription):
     _expected_variables = []
 
 
+class SharedDescription(CompleteDescription):
+    """
+    Same as CompleteDescription, but with a second service getting
+    the same description, which shares the parsed model.
+    """
+
+    def setUp(self):
+        CompleteDescription.setUp(self)
+        with mock.patch('coherence.upnp.core.utils.getPage',
+                        fakeGetPage(self._scpdXML)):
+            self.other = service.Service(
+                'urn:schemas-upnp-org:service:RenderingControl:1',
+                'urn:upnp-org:serviceId:RenderingControl',
+                self.device.get_location(),
+                '/other-service/control',
+                '/other-service/subscribe',
+                '/other-service/view',
+                '/other-service/scpd',
+                self.device)
+
+    def tearDown(self):
+        CompleteDescription.tearDown(self)
+        try:
+            self.other.renew_subscription_call.cancel()
+        except AttributeError:
+            pass
+
+    def test_model_is_shared(self):
+        self.assertIs(self.other._scpd_model, self.service._scpd_model)
+        self.assertIs(self.other.scpdXML, self.service.scpdXML)
+        action, other_action = [svc.get_action('GetCurrentConnectionIDs')
+                                for svc in (self.service, self.other)]
+        self.assertIs(other_action.get_arguments_list(),
+                      action.get_arguments_list())
+        self.assertIs(other_action.get_service(), self.other)
+
+    def test_variables_are_not_shared(self):
+        variable = self.service.get_state_variable('SourceProtocolInfo')
+        other_variable = self.other.get_state_variable('SourceProtocolInfo')
+        self.assertIsNot(other_variable, variable)
+        variable.update('http-get:*:*:*')
+        self.assertEqual(other_variable.value, '')
+
+    def test_other_service_type_is_not_shared(self):
+        with mock.patch('coherence.upnp.core.utils.getPage',
+                        fakeGetPage(self._scpdXML)):
+            svc = service.Service(
+                'urn:schemas-upnp-org:service:ConnectionManager:1',
+                'urn:upnp-org:serviceId:ConnectionManager',
+                self.device.get_location(),
+                '/cm/control', '/cm/subscribe', '/cm/view', '/cm/scpd',
+                self.device)
+        self.assertIsNot(svc._scpd_model, self.service._scpd_model)
+
+
 # :todo: test-cases for subscribe/unsubscribe, subscribe_for_variable
 # :todo: test-cases for process_event()
 # :todo: test-cases for ServiceServer
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for decoding SOAP requests in L{upnp.core.soap_lite} and
+dispatching them in L{upnp.core.soap_service}
+"""
+
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python.util import OrderedDict
+
+from coherence.upnp.core import soap_lite, soap_service
+from coherence.upnp.core.soap_service import UPnPPublisher, errorCode, \
+     StreamedResponse, RequestScheduler
+from coherence.upnp.core.utils import parse_xml
+
+CDS_NS = 'urn:schemas-upnp-org:service:ContentDirectory:1'
+
+BROWSE_REQUEST = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+  s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<u:Browse xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">
+<ObjectID>0</ObjectID>
+<BrowseFlag>BrowseDirectChildren</BrowseFlag>
+<Filter>*</Filter>
+<StartingIndex>0</StartingIndex>
+<RequestedCount>100</RequestedCount>
+<SortCriteria></SortCriteria>
+</u:Browse>
+</s:Body>
+</s:Envelope>'''
+
+TYPED_REQUEST = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+  xmlns:xsi="http://www.w3.org/1999/XMLSchema-instance">
+<s:Header><Ignored>x</Ignored></s:Header>
+<s:Body>
+<u:SetVolume xmlns:u="urn:schemas-upnp-org:service:RenderingControl:1">
+<InstanceID xsi:type="xsd:int">0</InstanceID>
+<Channel>Master&amp;Slave</Channel>
+<DesiredVolume xsi:type="xsd:float">0.5</DesiredVolume>
+<Mute xsi:type="xsd:boolean">true</Mute>
+<Title>Caf\xc3\xa9</Title>
+<Nested>before<Inner>inside</Inner>after</Nested>
+</u:SetVolume>
+<u:Second xmlns:u="urn:x"><A>1</A></u:Second>
+</s:Body>
+</s:Envelope>'''
+
+
+def decode_with_tree(data):
+    """ how requests used to be decoded, via a full ElementTree """
+    tree = parse_xml(data)
+    body = tree.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
+    method = body.getchildren()[0]
+    ns, name = method.tag[1:].split('}')
+    return ns, name, [(child.tag, soap_lite.decode_result(child))
+                      for child in method.getchildren()]
+
+
+class TestDecodeSOAPCall(unittest.TestCase):
+
+    def test_browse(self):
+        ns, method, arguments = soap_lite.decode_soap_call(BROWSE_REQUEST)
+        self.assertEqual(ns, CDS_NS)
+        self.assertEqual(method, 'Browse')
+        self.assertEqual(arguments, [
+            ('ObjectID', '0'),
+            ('BrowseFlag', 'BrowseDirectChildren'),
+            ('Filter', '*'),
+            ('StartingIndex', '0'),
+            ('RequestedCount', '100'),
+            ('SortCriteria', ''),
+            ])
+        self.assertEqual(type(arguments[0][1]), str)
+
+    def test_same_as_tree(self):
+        for data in (BROWSE_REQUEST, TYPED_REQUEST):
+            result = soap_lite.decode_soap_call(data)
+            expected = decode_with_tree(data)
+            self.assertEqual(result, expected)
+            self.assertEqual([type(v) for k, v in result[2]],
+                             [type(v) for k, v in expected[2]])
+
+    def test_typed_arguments(self):
+        ns, method, arguments = soap_lite.decode_soap_call(TYPED_REQUEST)
+        arguments = dict(arguments)
+        self.assertEqual(arguments['InstanceID'], 0)
+        self.assertEqual(arguments['DesiredVolume'], 0.5)
+        self.assertEqual(arguments['Mute'], True)
+        self.assertEqual(arguments['Channel'], 'Master&Slave')
+        self.assertEqual(arguments['Title'], u'Caf\xe9')
+        self.assertEqual(arguments['Nested'], 'before')
+
+    def test_no_body(self):
+        self.assertRaises(ValueError, soap_lite.decode_soap_call,
+                          '<s:Envelope xmlns:s="http://schemas.xmlsoap.org'
+                          '/soap/envelope/"/>')
+
+    def test_invalid_xml(self):
+        self.assertRaises(Exception, soap_lite.decode_soap_call, '<x>')
+
+
+class FakeRequest(object):
+
+    def __init__(self, data, headers):
+        self.content = StringIO(data)
+        self.headers = headers
+        self.code = None
+        self.written = []
+        self.finished = False
+        self.producer = None
+        self.transport = self
+        self.connected = True
+        self.notifications = []
+
+    def getClientIP(self):
+        return '10.0.0.1'
+
+    def notifyFinish(self):
+        d = defer.Deferred()
+        self.notifications.append(d)
+        return d
+
+    def getAllHeaders(self):
+        return self.headers
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def setHeader(self, name, value):
+        pass
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+        for d in self.notifications:
+            d.callback(None)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.connected = False
+
+
+class Publisher(UPnPPublisher):
+
+    def __init__(self):
+        UPnPPublisher.__init__(self)
+        self.calls = []
+
+    def soap_Browse(self, *args, **kwargs):
+        self.calls.append(('Browse', kwargs))
+        return {'Result': '', 'NumberReturned': 0,
+                'TotalMatches': 0, 'UpdateID': 0}
+
+    def soap_Stream(self, *args, **kwargs):
+        self.calls.append(('Stream', kwargs))
+        return OrderedDict([('Result', soap_lite.StreamedText(['<a>', u'\xe9'])),
+                            ('Count', defer.succeed(2))])
+
+    def soap__generic(self, *args, **kwargs):
+        self.calls.append(('generic', kwargs))
+        raise errorCode(401)
+
+
+class TestUPnPPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher()
+
+    def render(self, data, **headers):
+        headers.setdefault('content-type', 'text/xml; charset="utf-8"')
+        request = FakeRequest(data, headers)
+        self.publisher.render(request)
+        return request
+
+    def test_dispatch_table(self):
+        function, useKeywords = self.publisher.lookupFunction('Browse')
+        self.assertEqual(function, self.publisher.soap_Browse)
+        self.assertFalse(useKeywords)
+        self.assertIn('Browse', self.publisher._soap_dispatch)
+        self.assertNotIn('_generic', self.publisher._soap_dispatch)
+        function, useKeywords = self.publisher.lookupFunction('Search')
+        self.assertEqual(function, self.publisher.soap__generic)
+
+    def test_browse(self):
+        request = self.render(BROWSE_REQUEST, **{'user-agent': 'Xbox/2.0'})
+        self.assertEqual(request.code, 200)
+        self.assertTrue(request.finished)
+        name, kwargs = self.publisher.calls[0]
+        self.assertEqual(name, 'Browse')
+        self.assertEqual(kwargs['ObjectID'], '0')
+        self.assertEqual(kwargs['soap_methodName'], 'Browse')
+        self.assertEqual(kwargs['X_UPnPClient'], 'XBox')
+        self.assertIn('BrowseResponse', request.written[0])
+
+    def test_streamed(self):
+        request = self.render(BROWSE_REQUEST.replace('Browse', 'Stream'))
+        self.assertEqual(request.code, 200)
+        self.assertTrue(request.finished)
+        self.assertIn('<Result>&lt;a&gt;\xc3\xa9</Result><Count>2</Count>',
+                      ''.join(request.written))
+
+    def test_generic_error(self):
+        request = self.render(TYPED_REQUEST)
+        self.assertEqual(self.publisher.calls[0][0], 'generic')
+        self.assertEqual(request.code, 500)
+        self.assertIn('<errorCode>401</errorCode>', request.written[0])
+
+    def test_wrong_content_type(self):
+        request = self.render(BROWSE_REQUEST, **{'content-type': 'text/plain'})
+        self.assertEqual(self.publisher.calls, [])
+        self.assertIn('<errorCode>415</errorCode>', request.written[0])
+
+    def test_invalid_request(self):
+        request = self.render('<x>')
+        self.assertEqual(self.publisher.calls, [])
+        self.assertIn('<errorCode>401</errorCode>', request.written[0])
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(soap_service, 'reactor', self.clock)
+        self.scheduler = RequestScheduler(max_per_client=1, max_queued=2,
+                                          weights={'b': 2.0})
+        self.started = []
+
+    def submit(self, key, name):
+        request = FakeRequest('', {})
+        d = defer.Deferred()
+
+        def call():
+            self.started.append(name)
+            return d
+        self.scheduler.submit((key, 'TV'), request, call)
+        return request, d
+
+    def answer(self, request, d):
+        d.callback(None)
+        request.finish()
+
+    def test_per_client_concurrency(self):
+        first = self.submit('a', 'a1')
+        self.submit('a', 'a2')
+        self.assertEqual(self.started, ['a1'])
+        self.clock.advance(2)
+        self.answer(*first)
+        self.assertEqual(self.started, ['a1', 'a2'])
+        stats = self.scheduler.statistics()[('a', 'TV')]
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['active'], 1)
+        self.assertEqual(stats['mean_wait'], 1.0)
+        self.assertEqual(stats['latency'], 2 * RequestScheduler.smoothing)
+
+    def test_queue_depth(self):
+        self.submit('a', 'a1')
+        self.submit('a', 'a2')
+        self.submit('a', 'a3')
+        request = FakeRequest('', {})
+        d = self.scheduler.submit(('a', 'TV'), request, lambda: None)
+        self.assertFailure(d, errorCode)
+        self.assertEqual(self.scheduler.statistics()[('a', 'TV')]['rejected'],
+                         1)
+        return d
+
+    def test_gone_while_queued(self):
+        first = self.submit('a', 'a1')
+        request, d = self.submit('a', 'a2')
+        self.submit('a', 'a3')
+        for notification in request.notifications:
+            notification.errback(Exception('connection lost'))
+        self.answer(*first)
+        self.assertEqual(self.started, ['a1', 'a3'])
+        self.assertEqual(self.scheduler.statistics()[('a', 'TV')]['dropped'],
+                         1)
+
+    def test_fair_between_clients(self):
+        self.scheduler.max_active = 1
+        requests = {'a1': self.submit('a', 'a1'),
+                    'a2': self.submit('a', 'a2'),
+                    'b1': self.submit('b', 'b1')}
+        while len(self.started) < 3:
+            self.answer(*requests[self.started[-1]])
+        self.assertEqual(self.started, ['a1', 'b1', 'a2'])
+
+    def test_publisher(self):
+        publisher = Publisher()
+        publisher.scheduler = self.scheduler
+        request = FakeRequest(BROWSE_REQUEST,
+                              {'content-type': 'text/xml; charset="utf-8"'})
+        publisher.render(request)
+        self.assertTrue(request.finished)
+        self.assertEqual(publisher.calls[0][0], 'Browse')
+        stats = self.scheduler.statistics()[('10.0.0.1', '')]
+        self.assertEqual((stats['requests'], stats['active']), (1, 0))
+
+
+class TestBuildSOAPResponse(unittest.TestCase):
+
+    def assertSameAsTree(self, method, arguments):
+        self.assertEqual(
+            soap_lite.build_soap_response(method, arguments),
+            soap_lite.build_soap_call(method, arguments, is_response=True,
+                                      encoding=None))
+
+    def test_browse(self):
+        from twisted.python.util import OrderedDict
+        from coherence.upnp.core import DIDLLite
+        didl = DIDLLite.DIDLElement()
+        for i in range(3):
+            item = DIDLLite.MusicTrack(i, 0, 'Track "%d" <&>' % i)
+            item.res.append(DIDLLite.Resource(
+                'http://host/%d?a=1&b=2' % i, 'http-get:*:audio/mpeg:*'))
+            didl.addItem(item)
+        arguments = OrderedDict([('Result', didl.toString()),
+                                 ('NumberReturned', 3),
+                                 ('TotalMatches', 3),
+                                 ('UpdateID', 0)])
+        self.assertSameAsTree('{%s}Browse' % CDS_NS, arguments)
+
+    def test_types(self):
+        self.assertSameAsTree('{urn:foo}Get', {
+            'S': 'a\r\n\tb > c', 'U': u'unicode', 'I': 42, 'F': 0.25,
+            'T': True, 'N': False, 'Z': 0, 'E': '', 'EU': u''})
+
+    def test_no_arguments(self):
+        self.assertSameAsTree('{urn:foo}Get', {})
+
+    def test_namespaces(self):
+        # registered ones get their prefix, others ns0
+        self.assertSameAsTree('{urn:schemas-upnp-org:event-1-0}Get', {'A': 'b'})
+        self.assertSameAsTree('Get', {'A': 'b'})
+        self.assertSameAsTree('{None}Get', {'A': 'b'})
+
+    def test_unsupported_type(self):
+        self.assertRaises(KeyError, soap_lite.build_soap_response,
+                          '{urn:foo}Get', {'A': None})
+
+    def test_non_ascii(self):
+        response = soap_lite.build_soap_response('{urn:foo}Get',
+                                                 {'A': u'caf\xe9 &'})
+        self.assertIn('<A>caf\xc3\xa9 &amp;</A>', response)
+
+
+class TestStreamedResponse(unittest.TestCase):
+
+    method = '{%s}Browse' % CDS_NS
+
+    def stream(self, arguments, buffer_size=None):
+        request = FakeRequest('', {})
+        response = StreamedResponse(
+            request, soap_lite.iter_soap_response(self.method, arguments))
+        if buffer_size is not None:
+            response.buffer_size = buffer_size
+        response.start()
+        return request
+
+    def pull(self, request):
+        """ like a transport with an empty buffer """
+        while request.producer is not None:
+            written = len(request.written)
+            request.producer.resumeProducing()
+            if len(request.written) == written:
+                break
+
+    def test_same_as_built(self):
+        arguments = {'Result': u'<a href="x">caf\xe9</a>', 'Count': 1,
+                     'Empty': ''}
+        request = self.stream(arguments)
+        self.assertTrue(request.finished)
+        self.assertEqual(''.join(request.written),
+                         soap_lite.build_soap_response(self.method, arguments))
+
+    def test_streamed_text(self):
+        count = defer.Deferred()
+        chunks = ['<a>', defer.succeed(u'\xe9 & '), '</a>']
+        request = self.stream(OrderedDict([
+            ('Result', soap_lite.StreamedText(chunks)), ('Count', count)]),
+            buffer_size=1)
+        # one chunk per write, as they all exceed the buffer size
+        self.assertEqual(len(request.written), 1)
+        self.pull(request)
+        self.assertEqual(len(request.written), 6)
+        self.assertFalse(request.finished)
+        count.callback(3)
+        self.pull(request)
+        self.assertTrue(request.finished)
+        self.assertEqual(
+            ''.join(request.written),
+            soap_lite.build_soap_response(self.method, OrderedDict([
+                ('Result', u'<a>\xe9 & </a>'), ('Count', 3)])))
+
+    def test_waits_for_chunks(self):
+        later = defer.Deferred()
+        request = self.stream({'Result': soap_lite.StreamedText(
+            ['<a>', later, '</a>'])})
+        written = ''.join(request.written)
+        self.assertTrue(written.endswith('<Result>&lt;a&gt;'))
+        self.assertFalse(request.finished)
+        later.callback('b')
+        self.assertTrue(request.finished)
+        self.assertIn('<Result>&lt;a&gt;b&lt;/a&gt;</Result>',
+                      ''.join(request.written))
+
+    def test_failure_closes_connection(self):
+        later = defer.Deferred()
+        request = self.stream({'Result': soap_lite.StreamedText(
+            ['<a>', later])})
+        later.errback(ValueError('gone'))
+        self.assertFalse(request.finished)
+        self.assertFalse(request.connected)
+        self.assertIdentical(request.producer, None)
+        self.flushLoggedErrors(ValueError)
+
+    def test_stopped(self):
+        later = defer.Deferred()
+        request = self.stream({'Result': soap_lite.StreamedText(
+            ['<a>', later, '</a>'])})
+        request.producer.stopProducing()
+        later.callback('b')
+        self.assertFalse(request.finished)
+        self.assertNotIn('b', ''.join(request.written))
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the persistent connections of L{upnp.core.soap_proxy}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import resource, server
+
+from coherence.upnp.core import soap_proxy
+
+RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+  s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<u:GetVolumeResponse xmlns:u="urn:schemas-upnp-org:service:RenderingControl:1">
+<CurrentVolume>42</CurrentVolume>
+</u:GetVolumeResponse>
+</s:Body>
+</s:Envelope>'''
+
+FAULT = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+  s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<s:Fault>
+<faultcode>s:Client</faultcode>
+<faultstring>UPnPError</faultstring>
+<detail>
+<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">
+<errorCode>402</errorCode>
+<errorDescription>Invalid Args</errorDescription>
+</UPnPError>
+</detail>
+</s:Fault>
+</s:Body>
+</s:Envelope>'''
+
+NAMESPACE = ('u', 'urn:schemas-upnp-org:service:RenderingControl:1')
+
+if soap_proxy.HTTPConnectionPool is None:
+    skip = "persistent connections need Twisted 13.1 or newer"
+
+
+class Control(resource.Resource):
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+        self.fault = False
+
+    def render_POST(self, request):
+        self.requests.append(request)
+        request.setHeader('content-type', 'text/xml; charset="utf-8"')
+        if self.fault:
+            request.setResponseCode(500)
+            return FAULT
+        return RESPONSE
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.control = Control()
+        self.port = reactor.listenTCP(0, server.Site(self.control),
+                                      interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/control' % self.port.getHost().port
+        self.pool = soap_proxy.ConnectionPool(max_per_host=2, idle_timeout=30)
+        self.patch(soap_proxy, '_pool', self.pool)
+        self.proxy = soap_proxy.SOAPProxy(self.url, namespace=NAMESPACE)
+
+    def tearDown(self):
+        d = self.pool.close()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def call(self):
+        return self.proxy.callRemote('GetVolume', {'InstanceID': 0,
+                                                   'Channel': 'Master'})
+
+    def transports(self):
+        return set(id(request.transport) for request in self.control.requests)
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        result = yield self.call()
+        self.assertEqual(result, {'CurrentVolume': '42'})
+        result = yield self.call()
+        self.assertEqual(result, {'CurrentVolume': '42'})
+        self.assertEqual(len(self.transports()), 1)
+        self.assertEqual(self.pool.counters['misses'], 1)
+        self.assertEqual(self.pool.counters['hits'], 1)
+
+    def test_soapaction_header(self):
+        d = self.call()
+
+        def check(_):
+            request = self.control.requests[0]
+            self.assertEqual(request.getHeader('soapaction'),
+                             '"urn:schemas-upnp-org:service:'
+                             'RenderingControl:1#GetVolume"')
+        headers = soap_proxy._SOAPHeaders({'soapaction': ['"x#y"']})
+        self.assertEqual(list(headers.getAllRawHeaders()),
+                         [('SOAPACTION', ['"x#y"'])])
+        return d.addCallback(check)
+
+    def test_bounded_per_host(self):
+        d = defer.gatherResults([self.call() for i in range(5)])
+
+        def check(_):
+            self.assertEqual(len(self.control.requests), 5)
+            self.assertTrue(len(self.transports()) <= 2)
+            self.assertEqual(self.pool.counters['hits'] +
+                             self.pool.counters['misses'], 5)
+        return d.addCallback(check)
+
+    def test_not_limited_per_host(self):
+        self.pool.limit_per_host = False
+        d = defer.gatherResults([self.call() for i in range(5)])
+
+        def check(_):
+            self.assertEqual(len(self.transports()), 5)
+            self.assertEqual(self.pool.counters['misses'], 5)
+        return d.addCallback(check)
+
+    def test_upnp_error(self):
+        self.control.fault = True
+        d = self.call()
+        return self.assertFailure(d, Exception).addCallback(
+            lambda e: self.assertEqual(str(e), '402 - Invalid Args'))
+
+    def test_key(self):
+        self.assertEqual(self.pool._key('http://10.0.0.1:1234/ctrl'),
+                         ('http', '10.0.0.1', 1234))
+        self.assertEqual(self.pool._key('http://10.0.0.1/ctrl'),
+                         ('http', '10.0.0.1', 80))
+
+
+class DroppingAgent(object):
+    """ fails every request, like a device closing kept-alive connections """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.requests = 0
+        self.reused = False
+        self.error = soap_proxy.RequestNotSent
+
+    def request(self, method, url, headers, body):
+        self.requests += 1
+        self.pool.reused = self.reused
+        return defer.fail(self.error())
+
+
+class TestFallback(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = soap_proxy.ConnectionPool()
+        self.agent = self.pool._agent = DroppingAgent(self.pool._pool)
+        self.fetched = []
+        self.patch(soap_proxy, 'getPage', self._getPage)
+        self.url = 'http://10.0.0.1:1234/ctrl'
+        self.key = self.pool._key(self.url)
+
+    def tearDown(self):
+        return self.pool.close()
+
+    def _getPage(self, url, **kwargs):
+        self.fetched.append(url)
+        return defer.succeed(('page', {}))
+
+    def test_fresh_connection_is_not_retried(self):
+        d = self.pool.request(self.url, 'payload', {})
+        self.assertFailure(d, soap_proxy.RequestNotSent)
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(self.pool.counters['misses'], 1)
+        return d
+
+    def test_sent_request_is_not_retried(self):
+        self.agent.reused = True
+        self.agent.error = lambda: soap_proxy.ResponseNeverReceived([])
+        d = self.pool.request(self.url, 'payload', {})
+        self.assertFailure(d, soap_proxy.ResponseNeverReceived)
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(self.pool.counters['retries'], 0)
+        self.assertEqual(self.agent.requests, 1)
+        return d
+
+    def test_dropped_connection_falls_back(self):
+        self.agent.reused = True
+        for i in range(soap_proxy.ConnectionPool.FALLBACK_AFTER):
+            result = []
+            self.pool.request(self.url, 'payload', {}).addCallback(
+                result.append)
+            self.assertEqual(result, [('page', {})])
+        self.assertEqual(self.pool.counters['retries'],
+                         soap_proxy.ConnectionPool.FALLBACK_AFTER)
+        self.assertEqual(self.pool.counters['fallbacks'], 1)
+        self.assertEqual(self.agent.requests,
+                         soap_proxy.ConnectionPool.FALLBACK_AFTER)
+        # from now on without the pool
+        self.pool.request(self.url, 'payload', {})
+        self.assertEqual(self.agent.requests,
+                         soap_proxy.ConnectionPool.FALLBACK_AFTER)
+        self.assertEqual(len(self.fetched),
+                         soap_proxy.ConnectionPool.FALLBACK_AFTER + 1)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.sort_criteria}
+"""
+
+from twisted.trial import unittest
+
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.core.sort_criteria import SortCriteria, \
+     SortCriteriaError, capabilities
+
+
+def track(id, title, album=None, number=None):
+    item = DIDLLite.MusicTrack(id, '0', title)
+    item.album = album
+    item.originalTrackNumber = number
+    return item
+
+
+class TestSortCriteria(unittest.TestCase):
+
+    def setUp(self):
+        self.tracks = [track('1', u'b', 'Two', 10),
+                       track('2', u'A', 'One', 2),
+                       track('3', u'c', 'One', 1),
+                       track('4', u'a', None, None)]
+
+    def ids(self, criteria, objects=None):
+        return [o.id for o in SortCriteria(criteria).sort(objects or self.tracks)]
+
+    def test_empty(self):
+        self.assertFalse(SortCriteria(''))
+        self.assertEqual(self.ids(''), ['1', '2', '3', '4'])
+
+    def test_ascending_ignores_case(self):
+        self.assertEqual(self.ids('+dc:title'), ['2', '4', '1', '3'])
+        self.assertEqual(self.ids('dc:title'), ['2', '4', '1', '3'])
+
+    def test_descending_is_stable(self):
+        self.assertEqual(self.ids('-dc:title'), ['3', '1', '2', '4'])
+
+    def test_several_keys(self):
+        self.assertEqual(self.ids('+upnp:album,+upnp:originalTrackNumber'),
+                         ['4', '3', '2', '1'])
+        self.assertEqual(self.ids('+upnp:album, -upnp:originalTrackNumber'),
+                         ['4', '2', '3', '1'])
+
+    def test_numbers(self):
+        # 10 after 2, not before it
+        self.assertEqual(self.ids('-upnp:originalTrackNumber'),
+                         ['1', '2', '3', '4'])
+
+    def test_permutation_puts_missing_objects_last(self):
+        objects = [self.tracks[0], None, self.tracks[1]]
+        self.assertEqual(SortCriteria('+dc:title').permutation(objects),
+                         [2, 0, 1])
+
+    def test_invalid(self):
+        self.assertRaises(SortCriteriaError, SortCriteria, '+dc:foo')
+        self.assertRaises(SortCriteriaError, SortCriteria, '+')
+
+    def test_capabilities(self):
+        self.assertIn('dc:title', capabilities().split(','))
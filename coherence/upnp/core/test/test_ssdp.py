@@ -12,10 +12,10 @@ Test cases for L{upnp.core.sspd}
 import time
 
 from twisted.trial import unittest
-from twisted.internet import protocol
+from twisted.internet import protocol, task
 from twisted.test import proto_helpers
 
-from coherence.upnp.core import ssdp
+from coherence.upnp.core import ssdp, utils
 
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
@@ -39,6 +39,8 @@ class TestSSDP(unittest.TestCase):
         self.proto = ssdp.SSDPServer(test=True)
         self.tr = proto_helpers.FakeDatagramTransport()
         self.proto.makeConnection(self.tr)
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
 
     def test_ssdp_notify(self):
         self.assertEqual(self.proto._known, {})
@@ -60,6 +62,14 @@ class TestSSDP(unittest.TestCase):
             'EXT': '',
             })
 
+    def test_ssdp_notify_keeps_upnp_ids(self):
+        data = '\r\n'.join(SSDP_NOTIFY_1 + ('BOOTID.UPNP.ORG: 3',
+                                             'CONFIGID.UPNP.ORG: 1207')) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        service = self.proto._known[USN_1]
+        self.assertEqual(service['BOOTID.UPNP.ORG'], '3')
+        self.assertEqual(service['CONFIGID.UPNP.ORG'], '1207')
+
     def test_ssdp_notify_does_not_send_reply(self):
         data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
         self.proto.datagramReceived(data, ('127.0.0.1', 1234))
@@ -94,7 +104,9 @@ class TestSSDP(unittest.TestCase):
             'SERVER: Microsoft-Windows-NT/5.1 UPnP/1.0 UPnP-Device-Host/1.0',
             ''
             ]]
-        # :fixme: What is the reason the notification is send twice?
+        self.assertEqual(len(self.tr.written), 1)
+        # the notification is repeated later on, as UDP is unreliable
+        self.clock.advance(ssdp.DEFAULT_ANNOUNCE_WINDOW)
         self.assertEqual(len(self.tr.written), 2)
         self.assertEqual(self.tr.written[0], self.tr.written[1])
         data, (host, port) = self.tr.written[0]
@@ -124,3 +136,335 @@ class TestSSDP(unittest.TestCase):
         self.assertEqual((host, port), (SSDP_ADDR, SSDP_PORT))
         recieved = data.splitlines(True)
         self.assertEqual(sorted(recieved), sorted(expected))
+
+
+LOCAL_LOCATION = 'http://10.20.30.1:8080/description-1.xml'
+LOCAL_UUID = 'uuid:b2d5c8a0'
+LOCAL_ST = 'urn:schemas-upnp-org:device:MediaServer:1'
+
+SSDP_MSEARCH = (
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 0',
+    )
+
+
+class TestSSDPDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = ssdp.SSDPServer(test=True)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto.register('local', LOCAL_UUID + '::upnp:rootdevice',
+                            'upnp:rootdevice', LOCAL_LOCATION)
+        self.proto.register('local', LOCAL_UUID + '::' + LOCAL_ST,
+                            LOCAL_ST, LOCAL_LOCATION)
+        self.proto.register('local', LOCAL_UUID + '::' + LOCAL_ST[:-1] + '0',
+                            LOCAL_ST[:-1] + '0', LOCAL_LOCATION,
+                            silent=True)
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.proto._pacer.stop()
+        del self.tr.written[:]
+
+    def search(self, st):
+        data = '\r\n'.join(SSDP_MSEARCH + ('ST: ' + st,)) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.50', 4321))
+        self.clock.advance(0)
+        return self.tr.written
+
+    def test_search_st(self):
+        written = self.search(LOCAL_ST)
+        self.assertEqual(len(written), 1)
+        data, (host, port) = written[0]
+        self.assertEqual((host, port), ('10.20.30.50', 4321))
+        lines = data.split('\r\n')
+        self.assertEqual(lines[0], 'HTTP/1.1 200 OK')
+        self.assertEqual(lines[-2:], ['', ''])
+        self.assertIn('ST: ' + LOCAL_ST, lines)
+        self.assertIn('USN: %s::%s' % (LOCAL_UUID, LOCAL_ST), lines)
+        self.assertIn('LOCATION: ' + LOCAL_LOCATION, lines)
+        self.assertTrue([l for l in lines if l.startswith('DATE: ')])
+        self.assertFalse([l for l in lines if l.startswith('last-seen')])
+
+    def test_search_all_skips_silent_and_remote(self):
+        written = self.search('ssdp:all')
+        usns = sorted(utils.parse_http_response(data)[1]['usn']
+                      for data, addr in written)
+        self.assertEqual(usns, [LOCAL_UUID + '::upnp:rootdevice',
+                                LOCAL_UUID + '::' + LOCAL_ST])
+
+    def test_search_silent_st(self):
+        written = self.search(LOCAL_ST[:-1] + '0')
+        self.assertEqual(len(written), 1)
+
+    def test_search_unknown_st(self):
+        self.assertEqual(self.search('urn:schemas-upnp-org:device:Foo:1'),
+                         [])
+
+    def test_search_after_unregister(self):
+        self.proto.unRegister(LOCAL_UUID + '::' + LOCAL_ST)
+        self.assertEqual(self.search(LOCAL_ST), [])
+        self.assertEqual(len(self.search('ssdp:all')), 1)
+
+    def test_search_after_reregister(self):
+        location = 'http://10.20.30.1:8081/description-1.xml'
+        self.proto.register('local', LOCAL_UUID + '::' + LOCAL_ST,
+                            LOCAL_ST, location)
+        del self.tr.written[:]
+        written = self.search(LOCAL_ST)
+        self.assertEqual(len(written), 1)
+        self.assertIn('LOCATION: ' + location, written[0][0].split('\r\n'))
+
+
+class TestSSDPExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = ssdp.SSDPServer(test=True)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+
+    def test_parse_max_age(self):
+        self.assertEqual(ssdp.parse_max_age('max-age=1842'), 1842)
+        self.assertEqual(ssdp.parse_max_age('no-cache, Max-Age = 60'), 60)
+        self.assertEqual(ssdp.parse_max_age('max-age="120"'), 120)
+        self.assertEqual(ssdp.parse_max_age('max-age=soon'),
+                         ssdp.DEFAULT_MAX_AGE)
+        self.assertEqual(ssdp.parse_max_age(''), ssdp.DEFAULT_MAX_AGE)
+
+    def test_expire_at_deadline(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.clock.advance(1842 + ssdp.EXPIRY_GRACE - 1)
+        self.proto._expire()
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.clock.advance(1)
+        self.proto._expire()
+        self.assertFalse(self.proto.isKnown(USN_1))
+        self.assertEqual(self.proto._leases, {})
+
+    def test_refresh_extends_lease(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.clock.advance(1000)
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.clock.advance(1842 + ssdp.EXPIRY_GRACE - 1)
+        self.proto._expire()
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.clock.advance(1)
+        self.proto._expire()
+        self.assertFalse(self.proto.isKnown(USN_1))
+
+    def test_refresh_takes_new_max_age(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.proto.datagramReceived(
+            self.data.replace('max-age=1842', 'max-age=60'),
+            ('10.20.30.40', 1234))
+        self.assertEqual(self.proto._known[USN_1]['CACHE-CONTROL'],
+                         'max-age=60')
+        self.clock.advance(60 + ssdp.EXPIRY_GRACE)
+        self.proto._expire()
+        self.assertFalse(self.proto.isKnown(USN_1))
+
+    def test_expire_skips_unregistered(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.proto.unRegister(USN_1)
+        self.clock.advance(1842 + ssdp.EXPIRY_GRACE)
+        self.proto._expire()
+        self.assertEqual(self.proto._lease_heap, [])
+
+    def test_local_entries_never_expire(self):
+        self.proto.register('local', 'uuid:b2d5c8a0::upnp:rootdevice',
+                            'upnp:rootdevice', 'http://10.20.30.1/d.xml',
+                            cache_control='max-age=10')
+        self.clock.advance(3600)
+        self.proto._expire()
+        self.assertTrue(
+            self.proto.isKnown('uuid:b2d5c8a0::upnp:rootdevice'))
+
+    def test_heap_is_compacted(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        for i in range(200):
+            self.clock.advance(1)
+            self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.assertTrue(len(self.proto._lease_heap) <= 2 + 64)
+
+
+class TestDiscoveryResponder(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.sent = []
+        self.responder = ssdp.DiscoveryResponder(
+            lambda usn, dest, interface: self.sent.append((usn, dest)), rate=10)
+
+    def test_coalesce_identical_searches(self):
+        for i in range(4):
+            self.responder.schedule(('10.0.0.1', 1900), 'ssdp:all',
+                                    ['a', 'b'], 3)
+        self.clock.advance(3)
+        self.assertEqual(sorted(self.sent), [('a', ('10.0.0.1', 1900)),
+                                             ('b', ('10.0.0.1', 1900))])
+        self.assertEqual(self.responder.counters['requests'], 4)
+        self.assertEqual(self.responder.counters['coalesced'], 3)
+        self.assertEqual(self.responder.counters['sent'], 2)
+
+    def test_search_after_mx_window(self):
+        self.responder.schedule(('10.0.0.1', 1900), 'st', ['a'], 3)
+        self.clock.advance(3)
+        self.responder.schedule(('10.0.0.1', 1900), 'st', ['a'], 3)
+        self.clock.advance(3)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_usn_answered_once_per_requester(self):
+        self.responder.schedule(('10.0.0.1', 1900), 'ssdp:all',
+                                ['a', 'b'], 3)
+        self.responder.schedule(('10.0.0.1', 1900), 'st', ['a'], 3)
+        self.responder.schedule(('10.0.0.2', 1900), 'st', ['a'], 3)
+        self.clock.advance(3)
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.responder.counters['duplicates'], 1)
+
+    def test_rate_budget(self):
+        usns = ['usn-%d' % i for i in range(25)]
+        self.responder.schedule(('10.0.0.1', 1900), 'ssdp:all', usns, 0)
+        self.clock.advance(0)
+        self.assertEqual(len(self.sent), 10)
+        self.clock.advance(1)
+        self.assertEqual(len(self.sent), 20)
+        self.clock.advance(1)
+        self.assertEqual(len(self.sent), 25)
+        self.assertTrue(self.responder.counters['throttled'] > 0)
+
+    def test_max_pending(self):
+        self.responder.max_pending = 3
+        self.responder.schedule(('10.0.0.1', 1900), 'ssdp:all',
+                                ['a', 'b', 'c', 'd'], 1)
+        self.assertEqual(self.responder.counters['dropped'], 1)
+
+    def test_stop(self):
+        self.responder.schedule(('10.0.0.1', 1900), 'st', ['a'], 3)
+        self.responder.stop()
+        self.clock.advance(3)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestSSDPAnnouncements(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto = ssdp.SSDPServer(test=True, announce_window=5,
+                                     announce_budget=2)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        self.usns = []
+        for i in range(10):
+            usn = '%s::urn:schemas-upnp-org:service:S%d:1' % (LOCAL_UUID, i)
+            self.proto.register('local', usn, usn.split('::')[1],
+                                LOCAL_LOCATION)
+            self.usns.append(usn)
+        self.proto._pacer.stop()
+        del self.tr.written[:]
+
+    def test_notification_is_cached(self):
+        packet = self.proto._notification(self.usns[0], 'ssdp:alive')
+        self.assertIs(self.proto._notification(self.usns[0], 'ssdp:alive'),
+                      packet)
+        self.assertNotEqual(
+            self.proto._notification(self.usns[0], 'ssdp:byebye'), packet)
+        self.proto.register('local', self.usns[0], 'urn:foo:1',
+                            LOCAL_LOCATION)
+        self.assertIn('NT: urn:foo:1\r\n',
+                      self.proto._notification(self.usns[0], 'ssdp:alive'))
+
+    def test_resend_is_paced(self):
+        self.proto._resendNotify()
+        self.assertEqual(self.tr.written, [])
+        sent = []
+        for i in range(60):
+            self.clock.advance(0.1)
+            sent.append(len(self.tr.written))
+            del self.tr.written[:]
+        self.assertEqual(sum(sent), 20)
+        self.assertTrue(max(sent) <= 2)
+
+    def test_rounding_does_not_spin(self):
+        pacer = self.proto._pacer
+        pacer._tokens = 1 - 1e-12
+        pacer._refilled = self.clock.seconds()
+        pacer._push(self.clock.seconds(), (self.usns[0], 'ssdp:alive'))
+        pacer._run()
+        self.assertEqual(len(self.tr.written), 1)
+        self.assertEqual(pacer._queue, [])
+
+    def test_byebye_cancels_pending_alive(self):
+        self.proto.announce(self.usns[:2])
+        self.proto.doByebye(self.usns[0])
+        self.assertEqual(len(self.tr.written), 1)
+        self.assertIn('NTS: ssdp:byebye', self.tr.written[0][0])
+        self.clock.advance(10)
+        self.assertEqual(len(self.tr.written), 2)
+        self.assertIn('USN: %s\r\n' % self.usns[1], self.tr.written[1][0])
+
+    def test_unregistered_not_announced(self):
+        self.proto.announce(self.usns[:1])
+        self.proto.unRegister(self.usns[0])
+        self.clock.advance(10)
+        self.assertEqual(self.tr.written, [])
+
+
+class TestSSDPInterfaces(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto = ssdp.SSDPServer(test=True,
+                                     interface=['10.20.30.1', '192.168.5.1'])
+        self.tr = {}
+        for address, protocol in self.proto._interfaces.items():
+            self.tr[address] = proto_helpers.FakeDatagramTransport()
+            protocol.makeConnection(self.tr[address])
+        self.proto.register('local', LOCAL_UUID + '::' + LOCAL_ST,
+                            LOCAL_ST, LOCAL_LOCATION, host='10.20.30.1')
+        self.proto._pacer.stop()
+
+    def test_rewrite_location(self):
+        self.assertEqual(ssdp.rewrite_location(LOCAL_LOCATION, '10.20.30.1',
+                                               '192.168.5.1'),
+                         'http://192.168.5.1:8080/description-1.xml')
+        self.assertEqual(ssdp.rewrite_location(LOCAL_LOCATION, '10.20.30.2',
+                                               '192.168.5.1'),
+                         LOCAL_LOCATION)
+        self.assertEqual(ssdp.rewrite_location(LOCAL_LOCATION, '10.20.30.1',
+                                               None),
+                         LOCAL_LOCATION)
+
+    def test_notify_on_each_interface(self):
+        for address, tr in self.tr.items():
+            self.assertEqual(len(tr.written), 1)
+            data, dest = tr.written[0]
+            self.assertEqual(dest, (SSDP_ADDR, SSDP_PORT))
+            self.assertIn('LOCATION: http://%s:8080/description-1.xml\r\n'
+                          % address, data)
+
+    def test_search_answered_on_interface(self):
+        for tr in self.tr.values():
+            del tr.written[:]
+        data = '\r\n'.join(SSDP_MSEARCH + ('ST: ' + LOCAL_ST,)) + '\r\n\r\n'
+        self.proto._interfaces['192.168.5.1'].datagramReceived(
+            data, ('192.168.5.20', 4321))
+        self.clock.advance(0)
+        self.assertEqual(self.tr['10.20.30.1'].written, [])
+        written = self.tr['192.168.5.1'].written
+        self.assertEqual(len(written), 1)
+        data, dest = written[0]
+        self.assertEqual(dest, ('192.168.5.20', 4321))
+        self.assertIn(
+            'LOCATION: http://192.168.5.1:8080/description-1.xml\r\n', data)
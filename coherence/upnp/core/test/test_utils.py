@@ -194,6 +194,36 @@ class TestClient(unittest.TestCase):
         self.assertEqual(content, '')
         self.assertEqual(headers, {})
 
+    def test_parse_http_response_content(self):
+        response = ('HTTP/1.1 200 OK\r\n'
+                    'SID: uuid:1234\r\n'
+                    'X-Custom-Header : Foo \r\n'
+                    'TIMEOUT:Second-1800\r\n\r\n'
+                    '<body>\r\n\r\n</body>')
+        cmd, headers, content = utils.parse_http_response(response)
+        self.assertEqual(cmd, ['HTTP/1.1', '200', 'OK'])
+        self.assertEqual(content, '<body>\r\n\r\n</body>')
+        self.assertEqual(headers, {
+            'sid': 'uuid:1234',
+            'x-custom-header': 'Foo',
+            'timeout': 'Second-1800',
+            })
+
+    def test_parse_http_response_bare_newlines(self):
+        request = ('NOTIFY * HTTP/1.1\n'
+                   'HOST: 239.255.255.250:1900\n'
+                   'nts: ssdp:alive\n'
+                   'bogus line\n\n')
+        cmd, headers, content = utils.parse_http_response(request)
+        self.assertEqual(cmd, ['NOTIFY', '*', 'HTTP/1.1'])
+        self.assertEqual(headers, {'host': '239.255.255.250:1900',
+                                   'nts': 'ssdp:alive'})
+
+    def test_parse_http_response_interns_ssdp_headers(self):
+        cmd, headers, content = utils.parse_http_response(msearch_response1)
+        for name in headers:
+            self.assertIs(name, intern(name))
+
     def test_getPage(self):
         content = '0123456789'
         headers = {'accept-ranges': ['bytes'],
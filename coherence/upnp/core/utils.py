@@ -56,17 +56,43 @@ def parse_xml(data, encoding="utf-8"):
     return et_parse_xml(data, encoding)
 
 
+# header names used by SSDP and GENA, mapped from their common
+# spellings to their interned lower-case form
+_http_header_names = {}
+for _name in ('host', 'cache-control', 'location', 'nt', 'nts', 'server',
+              'usn', 'st', 'man', 'mx', 'ext', 'date', 'user-agent',
+              'sid', 'timeout', 'seq', 'callback', 'content-type',
+              'content-length', 'connection', 'transfer-encoding',
+              'bootid.upnp.org', 'configid.upnp.org',
+              'searchport.upnp.org', 'opt', '01-nls'):
+    _name = intern(_name)
+    for _spelling in (_name, _name.upper(), _name.title(),
+                      _name.capitalize()):
+        _http_header_names[_spelling] = _name
+del _name, _spelling
+
+
 def parse_http_response(data):
-    try:
-        header, content = data.split('\r\n\r\n')[0]
-    except ValueError:
-        header = data.strip()
-        content = ''
+    """ split a HTTP request or response into the request or status
+        line, split into its (up to three) parts, the header fields
+        with lower-cased names, and the content
+    """
+    header, sep, content = data.partition('\r\n\r\n')
+    if not sep:
+        header = header.strip()
     lines = header.splitlines()
-    cmd = lines.pop(0).split(None, 2)
-    lines = (l.split(':', 1) for l in lines if l)
-    headers = dict((h.strip().lower(), d.strip())
-                   for (h, d) in lines)
+    cmd = lines[0].split(None, 2)
+    headers = {}
+    names = _http_header_names
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            continue
+        try:
+            name = names[name]
+        except KeyError:
+            name = name.strip().lower()
+        headers[name] = value.strip()
     return cmd, headers, content
 
 
@@ -26,6 +26,13 @@ from coherence import log
 
 class DeviceQuery(object):
 
+    # how to get the value a query of each type matches from a device
+    attributes = {
+        'host': lambda device: getattr(device, 'host', None),
+        'friendly_name': lambda device: device.friendly_name,
+        'uuid': lambda device: device.get_uuid(),
+        }
+
     def __init__(self, type, pattern, callback, timeout=0, oneshot=True):
         self.type = type
         self.pattern = pattern
@@ -71,7 +78,9 @@ class ControlPoint(log.Loggable):
                                         XMLRPC(self))
 
         self.auto_client = auto_client
-        self.queries = []
+        # pending queries, type -> pattern -> list of queries
+        self.queries = {}
+        self.update_search_targets()
 
         for device in self.get_devices():
             self.check_device(device)
@@ -90,9 +99,25 @@ class ControlPoint(log.Loggable):
         if device_type in self.auto_client:
             return
         self.auto_client.append(device_type)
+        self.update_search_targets()
         for device in self.get_devices():
             self.check_device(device)
 
+    def update_search_targets(self):
+        """ let the M-SEARCHes target the device types we are
+            interested in, instead of everything on the network
+        """
+        msearch = getattr(self.coherence, 'msearch', None)
+        if msearch is None:
+            # Coherence setup not completed yet
+            return
+        if self.auto_client:
+            targets = ['urn:schemas-upnp-org:device:%s:1' % device_type
+                       for device_type in self.auto_client]
+        else:
+            targets = ['upnp:rootdevice']
+        msearch.set_targets(targets)
+
     def browse(self, device):
         device = self.coherence.get_device_with_usn(infos['USN'])
         if not device:
@@ -100,16 +125,32 @@ class ControlPoint(log.Loggable):
         self.check_device(device)
 
     def process_queries(self, device):
-        for query in self.queries:
-            query.check(device)
+        for type, by_pattern in self.queries.items():
+            try:
+                value = DeviceQuery.attributes[type](device)
+            except (KeyError, TypeError):
+                # unknown query type or device not fully detected
+                continue
+            queries = by_pattern.get(value)
+            if not queries:
+                continue
+            for query in queries[:]:
+                query.check(device)
+                if query.fired and query.oneshot:
+                    queries.remove(query)
+            if not queries:
+                del by_pattern[value]
+                if not by_pattern:
+                    del self.queries[type]
 
     def add_query(self, query):
         for device in self.get_devices():
             query.check(device)
         if query.fired == False and query.timeout == 0:
             query.callback(None)
-        else:
-            self.queries.append(query)
+        elif not (query.fired and query.oneshot):
+            self.queries.setdefault(query.type, {}).setdefault(
+                query.pattern, []).append(query)
 
     def connect(self, receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True):
         """ wrapper method around louie.connect
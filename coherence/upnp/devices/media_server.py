@@ -518,7 +518,17 @@ class MediaServer(log.Loggable, BasicDeviceMixin):
             transcoding = False
             if self.coherence.config.get('transcoding', 'no') == 'yes':
                 transcoding = True
-            self.content_directory_server = ContentDirectoryServer(self, transcoding=transcoding)
+            browse_cache_size = int(self.coherence.config.get('browse_cache_size',
+                                                              1024 * 1024))
+            change_journal_size = int(self.coherence.config.get('change_journal_size',
+                                                                1000))
+            client_concurrency = int(self.coherence.config.get('client_concurrency', 2))
+            client_queue_depth = int(self.coherence.config.get('client_queue_depth', 32))
+            self.content_directory_server = ContentDirectoryServer(self, transcoding=transcoding,
+                                                                   browse_cache_size=browse_cache_size,
+                                                                   change_journal_size=change_journal_size,
+                                                                   client_concurrency=client_concurrency,
+                                                                   client_queue_depth=client_queue_depth)
             self._services.append(self.content_directory_server)
         except LookupError, msg:
             self.warning('ContentDirectoryServer %s', msg)
@@ -12,6 +12,7 @@ from twisted.python import log
 
 from coherence.upnp.core import DIDLLite
 from coherence.upnp.core import utils
+from coherence.upnp.core.action import PRIORITY_INTERACTIVE
 
 global work, pending
 work = []
@@ -62,7 +63,8 @@ class ContentDirectoryClient:
                filter='*', sort_criteria='',
                starting_index=0, requested_count=0,
                process_result=True,
-               backward_compatibility=False):
+               backward_compatibility=False,
+               priority=PRIORITY_INTERACTIVE):
 
         def got_result(results):
             items = []
@@ -111,7 +113,8 @@ class ContentDirectoryClient:
                             BrowseFlag=browse_flag,
                             Filter=filter, SortCriteria=sort_criteria,
                             StartingIndex=str(starting_index),
-                            RequestedCount=str(requested_count))
+                            RequestedCount=str(requested_count),
+                            priority=priority)
         if process_result in [True, 1, '1', 'true', 'True', 'yes', 'Yes']:
             d.addCallback(got_process_result)
         #else:
@@ -120,7 +123,7 @@ class ContentDirectoryClient:
         return d
 
     def search(self, container_id, criteria, starting_index=0,
-               requested_count=0):
+               requested_count=0, priority=PRIORITY_INTERACTIVE):
         #print "search:", criteria
         starting_index = str(starting_index)
         requested_count = str(requested_count)
@@ -132,7 +135,8 @@ class ContentDirectoryClient:
                             Filter="*",
                             StartingIndex=starting_index,
                             RequestedCount=requested_count,
-                            SortCriteria="")
+                            SortCriteria="",
+                            priority=priority)
         d.addErrback(self._failure)
 
         def gotResults(results):
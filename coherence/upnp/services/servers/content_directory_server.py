@@ -7,18 +7,30 @@
 
 # Content Directory service
 
+from collections import deque
+
 from twisted.python import failure
+from twisted.python.util import OrderedDict
 from twisted.web import resource
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from coherence.upnp.core.soap_service import UPnPPublisher
 from coherence.upnp.core.soap_service import errorCode
-from coherence.upnp.core.DIDLLite import DIDLElement
+from coherence.upnp.core.soap_service import RequestScheduler
+from coherence.upnp.core.soap_lite import StreamedText
+from coherence.upnp.core.DIDLLite import DIDLElement, Container
 
 from coherence.upnp.core import service
+from coherence.upnp.core import search_criteria
+from coherence.upnp.core import sort_criteria
+
+from coherence.extern.et import ET
 
 from coherence import log
 
+# the namespace of the LastChange events of a ContentDirectory:3
+CDS_EVENT_NS = 'urn:schemas-upnp-org:av:cds-event'
+
 
 class ContentDirectoryControl(service.ServiceControl, UPnPPublisher):
 
@@ -28,12 +40,169 @@ class ContentDirectoryControl(service.ServiceControl, UPnPPublisher):
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
+        self.scheduler = server.scheduler
+
+
+class ResponseCache(log.Loggable):
+    """ a LRU cache for action responses, bounded by the bytes of
+        their Result
+
+        Every entry carries a version, a lookup with another version
+        is a miss and drops the entry.
+    """
+    logCategory = 'content_directory_server'
+
+    def __init__(self, max_bytes):
+        log.Loggable.__init__(self)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is not None:
+            del self._entries[key]
+            if entry[0] == version:
+                self._entries[key] = entry
+                self.counters['hits'] += 1
+                return dict(entry[1])
+            self.size -= entry[2]
+        self.counters['misses'] += 1
+        return None
+
+    def put(self, response, key, version):
+        """ keep response, returns it to be usable as a callback """
+        result = response.get('Result', '')
+        if not isinstance(result, basestring):
+            # streamed, it can't be written twice
+            return response
+        size = len(result)
+        if size > self.max_bytes:
+            return response
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and self.size + size > self.max_bytes:
+            self._remove(self._entries.keys()[0])
+            self.counters['evictions'] += 1
+        self._entries[key] = (version, dict(response), size)
+        self.size += size
+        return response
+
+    def _remove(self, key):
+        # twisted's OrderedDict doesn't keep its order on pop() or clear()
+        self.size -= self._entries[key][2]
+        del self._entries[key]
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self.size = 0
+
+    def hit_rate(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        if lookups == 0:
+            return 0.0
+        return float(self.counters['hits']) / lookups
+
+
+class ChangeJournal(log.Loggable):
+    """ the last max_entries changes of the content, as
+        (update id, change, object id, parent id, upnp class) tuples,
+        change being 'add', 'modify' or 'remove'
+
+        start is the update id from which on all changes are in
+        the journal, None as long as nothing was recorded.
+    """
+    logCategory = 'content_directory_server'
+
+    def __init__(self, max_entries):
+        log.Loggable.__init__(self)
+        self.max_entries = max_entries
+        self.start = None
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, start, update_id, change, object_id,
+               parent_id=None, upnp_class=None):
+        """ start is the update id before this change, for the
+            first one recorded
+        """
+        if self.start is None:
+            self.start = start
+        while len(self._entries) >= self.max_entries:
+            self.start = self._entries.popleft()[0]
+        entry = (update_id, change, object_id, parent_id, upnp_class)
+        self._entries.append(entry)
+        return entry
+
+    def reset(self, update_id):
+        """ forget all changes up to update_id, after one that
+            wasn't recorded
+        """
+        self.start = update_id
+        self._entries.clear()
+
+    def since(self, update_id):
+        """ the changes after update_id, oldest first, None if the
+            journal doesn't reach back that far
+        """
+        if self.start is None or update_id < self.start:
+            return None
+        entries = []
+        for entry in reversed(self._entries):
+            if entry[0] <= update_id:
+                break
+            entries.append(entry)
+        entries.reverse()
+        return entries
+
+
+def state_event(entries):
+    """ the ContentDirectory:3 StateEvent document of
+        ChangeJournal entries
+    """
+    root = ET.Element('StateEvent')
+    root.attrib['xmlns'] = CDS_EVENT_NS
+    tags = {'add': 'objAdd', 'modify': 'objMod', 'remove': 'objDel'}
+    for update_id, change, object_id, parent_id, upnp_class in entries:
+        e = ET.SubElement(root, tags[change])
+        e.attrib['objID'] = str(object_id)
+        e.attrib['updateID'] = str(update_id)
+        e.attrib['stUpdate'] = '0'
+        if change == 'add':
+            if parent_id is not None:
+                e.attrib['objParentID'] = str(parent_id)
+            if upnp_class is not None:
+                e.attrib['objClass'] = upnp_class
+    return ET.tostring(root, encoding='utf-8')
 
 
 class ContentDirectoryServer(service.ServiceServer, resource.Resource):
     logCategory = 'content_directory_server'
 
-    def __init__(self, device, backend=None, transcoding=False):
+    # number of sorted containers to keep
+    sorted_children_max = 32
+
+    # number of Search results to keep for paging through them
+    search_matches_max = 32
+
+    # number of children from which on a Browse response is
+    # written while it is produced, 0 to never do that
+    stream_threshold = 500
+
+    # seconds the content changes of the backend are collected before
+    # SystemUpdateID and ContainerUpdateIDs are updated with them,
+    # 0 to update them right away
+    update_interval = 2.0
+
+    def __init__(self, device, backend=None, transcoding=False,
+                 browse_cache_size=1024 * 1024, change_journal_size=1000,
+                 client_concurrency=2, client_queue_depth=32):
         self.device = device
         self.transcoding = transcoding
         if backend == None:
@@ -41,12 +210,141 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
         resource.Resource.__init__(self)
         service.ServiceServer.__init__(self, 'ContentDirectory', self.device.version, backend)
 
+        self.scheduler = None
+        if client_concurrency > 0:
+            self.scheduler = RequestScheduler(client_concurrency,
+                                              client_queue_depth)
         self.control = ContentDirectoryControl(self)
         self.putChild('scpd.xml', service.scpdXML(self, self.control))
         self.putChild('control', self.control)
 
         self.set_variable(0, 'SystemUpdateID', 0)
         self.set_variable(0, 'ContainerUpdateIDs', '')
+        self.set_variable(0, 'SearchCapabilities',
+                          search_criteria.capabilities())
+        self.set_variable(0, 'SortCapabilities',
+                          sort_criteria.capabilities())
+        self._sorted_children = OrderedDict()
+        self._search_matches = OrderedDict()
+        self.browse_cache = None
+        if browse_cache_size > 0:
+            self.browse_cache = ResponseCache(browse_cache_size)
+        self._pending_system_update_id = None
+        self._pending_containers = {}
+        self._pending_changes = []
+        self._batches = 0
+        self._update_call = None
+
+        self.journal = None
+        if change_journal_size > 0:
+            self.journal = ChangeJournal(change_journal_size)
+            self.register_vendor_variable('LastChange', evented='yes')
+            self.register_vendor_action('X_GetChangesSince', 'optional',
+                (('SinceUpdateID', 'in', 'A_ARG_TYPE_UpdateID'),
+                 ('Result', 'out', 'A_ARG_TYPE_Result'),
+                 ('UpdateID', 'out', 'A_ARG_TYPE_UpdateID')))
+
+    def release(self):
+        if self._update_call is not None and self._update_call.active():
+            self._update_call.cancel()
+        self._update_call = None
+
+    def content_changed(self, system_update_id, container=None):
+        """ note a change of the backend content
+
+            system_update_id is the new SystemUpdateID, container the
+            (id, update id) tuple of the container that changed, if any.
+            The changes are collected, SystemUpdateID and
+            ContainerUpdateIDs are updated once per update_interval,
+            with the last update id of every changed container.
+        """
+        self._pending_system_update_id = system_update_id
+        if container is not None:
+            self._pending_containers[str(container[0])] = str(container[1])
+        if self._batches == 0:
+            self._schedule_changes()
+
+    def record_change(self, change, item, update_id):
+        """ add the change of the BackendItem item, 'add', 'modify' or
+            'remove', to the journal, update_id being the SystemUpdateID
+            after it
+
+            It is evented with the next update of SystemUpdateID, call
+            this before the content_changed for it.
+        """
+        if self.journal is None:
+            return
+        didl = getattr(item, 'item', None)
+        entry = self.journal.record(self.get_system_update_id(), update_id,
+                                    change, item.get_id(),
+                                    getattr(didl, 'parentID', None),
+                                    getattr(didl, 'upnp_class', None))
+        self._pending_changes.append(entry)
+
+    def record_unknown_change(self, update_id):
+        """ note a change we can't tell clients about, update_id
+            being the SystemUpdateID after it
+
+            Clients asking for the changes before it have to browse
+            the content again.
+        """
+        if self.journal is not None:
+            self.journal.reset(update_id)
+
+    def begin_changes(self):
+        """ hold back the changes passed to content_changed until the
+            matching end_changes, for changes in bulk
+        """
+        self._batches += 1
+
+    def end_changes(self):
+        self._batches = max(0, self._batches - 1)
+        if(self._batches == 0 and
+           (self._pending_system_update_id is not None or
+            self._pending_containers or self._pending_changes)):
+            self._schedule_changes()
+
+    def _schedule_changes(self):
+        if self._update_call is not None:
+            return
+        if self.update_interval <= 0:
+            self.publish_changes()
+        else:
+            self._update_call = reactor.callLater(self.update_interval,
+                                                  self.publish_changes)
+
+    def publish_changes(self):
+        """ update SystemUpdateID and ContainerUpdateIDs with the
+            changes collected so far
+        """
+        if self._update_call is not None and self._update_call.active():
+            self._update_call.cancel()
+        self._update_call = None
+        if self._pending_changes:
+            changes = self._pending_changes
+            self._pending_changes = []
+            self.set_variable(0, 'LastChange', state_event(changes))
+        if self._pending_system_update_id is not None:
+            self.set_variable(0, 'SystemUpdateID',
+                              self._pending_system_update_id)
+            self._pending_system_update_id = None
+        if not self._pending_containers:
+            return
+        containers = self._pending_containers
+        self._pending_containers = {}
+        variable = self.get_variable('ContainerUpdateIDs')
+        if variable is None:
+            return
+        if variable.updated == True and variable.value:
+            # the last value wasn't evented yet, keep its containers
+            values = str(variable.value).split(',')
+            merged = dict(zip(values[::2], values[1::2]))
+            merged.update(containers)
+            containers = merged
+        variable.updated = False
+        self.set_variable(0, 'ContainerUpdateIDs',
+                          ','.join(['%s,%s' % c
+                                    for c in containers.iteritems()]))
 
     def listchilds(self, uri):
         cl = ''
@@ -74,7 +372,8 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
         didl = DIDLElement(upnp_client=kwargs.get('X_UPnPClient', ''),
                            parent_container=parent_container,
-                           transcoding=self.transcoding)
+                           transcoding=self.transcoding,
+                           filter=Filter)
 
         def build_response(tm):
             r = {'Result': didl.toString(), 'TotalMatches': tm,
@@ -177,15 +476,270 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
                 else:
                     return proceed(item)
 
-        item = self.backend.get_by_id(root_id)
-        if item == None:
-            return failure.Failure(errorCode(701))
+        criteria = SearchCriteria.strip() or '*'
+        try:
+            expression = search_criteria.parse(criteria)
+        except search_criteria.SearchCriteriaError as e:
+            self.info("can't search for %r: %s", SearchCriteria, e)
+            return failure.Failure(errorCode(708))
+        try:
+            sort = sort_criteria.SortCriteria(SortCriteria)
+        except sort_criteria.SortCriteriaError as e:
+            self.info("can't sort by %r: %s", SortCriteria, e)
+            return failure.Failure(errorCode(709))
+
+        key = (str(ContainerID), criteria, SortCriteria)
+
+        def sorted_matches(matches, version):
+            if sort:
+                matches = sort.sort(matches)
+            if key in self._search_matches:
+                del self._search_matches[key]
+            elif len(self._search_matches) >= self.search_matches_max:
+                del self._search_matches[self._search_matches.keys()[0]]
+            self._search_matches[key] = (version, matches)
+            return matches
+
+        def got_matches(matches):
+            total = len(matches)
+            if RequestedCount == 0:
+                matches = matches[StartingIndex:]
+            else:
+                matches = matches[StartingIndex:StartingIndex + RequestedCount]
+            for match in matches:
+                didl.addItem(match)
+            return build_response(total)
+
+        def search(result):
+            if result == None:
+                return failure.Failure(errorCode(701))
+            # the matches are kept until the content changes, so paging
+            # through them needs to search only once
+            version = (getattr(result, 'update_id', None),
+                       self.get_system_update_id())
+            cached = self._search_matches.get(key)
+            if cached is not None and cached[0] == version:
+                del self._search_matches[key]
+                self._search_matches[key] = cached
+                return got_matches(cached[1])
+            d = self.search_items(result, expression)
+            d.addCallback(sorted_matches, version)
+            d.addCallback(got_matches)
+            return d
 
+        item = self.backend.get_by_id(root_id)
         if isinstance(item, defer.Deferred):
-            item.addCallback(proceed)
+            item.addCallback(search)
             return item
         else:
-            return proceed(item)
+            return search(item)
+
+    def search_items(self, container, expression):
+        """ find the DIDLLite objects below the BackendItem container
+            matching the parsed SearchCriteria expression, depth first
+
+            A backend can run the search on its own, with a search_items
+            method taking the same arguments and returning a list of
+            BackendItems, or None to leave it to us.
+        """
+        search = getattr(self.backend, 'search_items', None)
+        if search is not None:
+            d = defer.maybeDeferred(search, container, expression)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(self._got_backend_matches, container, expression)
+        return d
+
+    def _got_backend_matches(self, result, container, expression):
+        if result is None:
+            return self._search_subtree(container, expression)
+        dl = defer.DeferredList([defer.maybeDeferred(i.get_item)
+                                 for i in result])
+        dl.addCallback(lambda results: [r[1] for r in results
+                                        if r[0] and r[1] is not None])
+        return dl
+
+    def _search_subtree(self, container, expression):
+        matches = []
+        visited = set()
+
+        def visit(item):
+            if item is None:
+                return
+            if hasattr(item, 'get_children_items'):
+                d = defer.maybeDeferred(item.get_children_items, 0, 0)
+                d.addCallback(visit_items)
+                return d
+            d = defer.maybeDeferred(item.get_children, 0, 0)
+            d.addCallback(visit_children)
+            return d
+
+        def visit_items(result):
+            d = defer.succeed(None)
+            for didl_object in result[0]:
+                if didl_object is None:
+                    continue
+                if expression.matches(didl_object):
+                    matches.append(didl_object)
+                if(isinstance(didl_object, Container) and
+                   didl_object.id not in visited):
+                    visited.add(didl_object.id)
+                    d.addCallback(lambda _, id=didl_object.id:
+                                  self.backend.get_by_id(id))
+                    d.addCallback(visit)
+            return d
+
+        def visit_children(children):
+            d = defer.succeed(None)
+            for child in children or []:
+                d.addCallback(lambda _, child=child:
+                              defer.maybeDeferred(child.get_item))
+                d.addCallback(check, child)
+            return d
+
+        def check(didl_object, child):
+            if didl_object is None:
+                return
+            if expression.matches(didl_object):
+                matches.append(didl_object)
+            if(isinstance(didl_object, Container) and
+               didl_object.id not in visited):
+                visited.add(didl_object.id)
+                return visit(child)
+
+        d = visit(container)
+        d.addCallback(lambda _: matches)
+        return d
+
+    def get_sorted_children(self, object_id, container, sort):
+        """ the children of the BackendItem container, sorted by the
+            SortCriteria sort, as a Deferred
+
+            The sorted lists are kept until the update_id of their
+            container, the SystemUpdateID or the number of children
+            changes, so paging through them needs to sort only once.
+            Containers without an update_id are sorted every time.
+        """
+        key = (object_id, sort.criteria)
+        update_id = getattr(container, 'update_id', None)
+
+        def got_child_count(count):
+            if update_id is None:
+                version = None
+            else:
+                version = (update_id, self.get_system_update_id(), count)
+            cached = self._sorted_children.get(key)
+            if cached is not None and cached[0] == version:
+                # keep the recently used ones
+                del self._sorted_children[key]
+                self._sorted_children[key] = cached
+                return cached[1]
+            d = defer.maybeDeferred(container.get_children, 0, 0)
+            d.addCallback(got_children, version)
+            return d
+
+        def got_children(children, version):
+            children = list(children or [])
+            dl = defer.DeferredList([defer.maybeDeferred(c.get_item)
+                                     for c in children])
+            dl.addCallback(got_items, children, version)
+            return dl
+
+        def got_items(results, children, version):
+            objects = [r[1] if r[0] else None for r in results]
+            children = [children[i] for i in sort.permutation(objects)]
+            if version is None:
+                return children
+            if key in self._sorted_children:
+                del self._sorted_children[key]
+            elif len(self._sorted_children) >= self.sorted_children_max:
+                del self._sorted_children[self._sorted_children.keys()[0]]
+            self._sorted_children[key] = (version, children)
+            return children
+
+        d = defer.maybeDeferred(container.get_child_count)
+        d.addCallback(got_child_count)
+        return d
+
+    def browse_cache_version(self, item):
+        """ what a cached Browse response of the BackendItem item
+            depends on, None if we can't tell when it changes
+        """
+        update_id = getattr(item, 'update_id', None)
+        if update_id is None:
+            return None
+        return (update_id, self.get_system_update_id())
+
+    def get_system_update_id(self):
+        """ the SystemUpdateID, including the changes not yet
+            published
+        """
+        if self._pending_system_update_id is not None:
+            return self._pending_system_update_id
+        variable = self.get_variable('SystemUpdateID')
+        if variable is None:
+            return None
+        return variable.value
+
+    def build_last_change_event(self, instance=0, force=False):
+        # our LastChange carries the changes of the content,
+        # a new subscriber gets the last ones
+        variable = self.get_variable('LastChange', instance)
+        if variable is None or not variable.value:
+            return None
+        return variable.value
+
+    def upnp_X_GetChangesSince(self, *args, **kwargs):
+        """ the changes after SinceUpdateID as a StateEvent
+            document, to mirror the content without browsing it again
+        """
+        try:
+            since = int(kwargs['SinceUpdateID'])
+        except (KeyError, ValueError):
+            return failure.Failure(errorCode(402))
+        update_id = self.get_system_update_id()
+        entries = None
+        if since <= update_id:
+            entries = self.journal.since(since)
+            if entries is None and since == update_id:
+                entries = []
+        if entries is None:
+            return failure.Failure(errorCode(800))
+        return {'Result': state_event(entries), 'UpdateID': update_id}
+
+    def stream_didl(self, didl, didl_objects):
+        """ the DIDL-Lite document of didl_objects, DIDLLite objects or
+            Deferreds firing with them, to be produced while the
+            response is written
+
+            Returns a StreamedText and a Deferred firing with the
+            number of items in it, once they are all through.
+        """
+        returned = defer.Deferred()
+        count = [0]
+
+        def fragment(didl_object):
+            if didl_object is None:
+                return ''
+            count[0] += 1
+            return didl.itemToString(didl_object)
+
+        def failed(f):
+            self.warning("can't get item for Browse: %s", f.getErrorMessage())
+            return ''
+
+        def chunks():
+            yield didl.startTag()
+            for didl_object in didl_objects:
+                if isinstance(didl_object, defer.Deferred):
+                    didl_object.addCallbacks(fragment, failed)
+                    yield didl_object
+                else:
+                    yield fragment(didl_object)
+            yield didl.endTag()
+            returned.callback(count[0])
+
+        return StreamedText(chunks()), returned
 
     def upnp_Browse(self, *args, **kwargs):
         try:
@@ -219,14 +773,50 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
         didl = DIDLElement(upnp_client=kwargs.get('X_UPnPClient', ''),
                            requested_id=requested_id,
                            parent_container=parent_container,
-                           transcoding=self.transcoding)
+                           transcoding=self.transcoding,
+                           filter=Filter)
+
+        try:
+            sort = sort_criteria.SortCriteria(SortCriteria)
+        except sort_criteria.SortCriteriaError as e:
+            self.info("can't sort by %r: %s", SortCriteria, e)
+            return failure.Failure(errorCode(709))
 
         def got_error(r):
             return r
 
+        def streamed(count):
+            return (0 < self.stream_threshold <= count and
+                    kwargs.get('X_UPnPClient', '') != 'XBox')
+
+        def stream_response(didl_objects, total):
+            result, returned = self.stream_didl(didl, didl_objects)
+            return {'Result': result, 'TotalMatches': total,
+                    'NumberReturned': returned,
+                    'UpdateID': update_id()}
+
+        def stream_result(children, found_item):
+            d = defer.maybeDeferred(found_item.get_child_count)
+            d.addCallback(lambda count: stream_response(
+                (defer.maybeDeferred(c.get_item) for c in children), count))
+            return d
+
+        def got_children_items(result):
+            items, total = result
+            if streamed(len(items)):
+                return stream_response(items, total)
+            for i in items:
+                if i is not None:
+                    didl.addItem(i)
+            return build_response(total)
+
         def process_result(result, total=None, found_item=None):
             if result == None:
                 result = []
+            if(BrowseFlag == 'BrowseDirectChildren' and
+               found_item is not None and
+               isinstance(result, list) and streamed(len(result))):
+                return stream_result(result, found_item)
             if BrowseFlag == 'BrowseDirectChildren':
                 l = []
 
@@ -265,21 +855,38 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
             return build_response(total)
 
-        def build_response(tm):
-            r = {'Result': didl.toString(), 'TotalMatches': tm,
-                 'NumberReturned': didl.numItems()}
-
+        def update_id():
             if hasattr(item, 'update_id'):
-                r['UpdateID'] = item.update_id
+                return item.update_id
             elif hasattr(self.backend, 'update_id'):
-                r['UpdateID'] = self.backend.update_id  # FIXME
-            else:
-                r['UpdateID'] = 0
+                return self.backend.update_id  # FIXME
+            return 0
 
+        def build_response(tm):
+            r = {'Result': didl.toString(), 'TotalMatches': tm,
+                 'NumberReturned': didl.numItems(),
+                 'UpdateID': update_id()}
             return r
 
+        def page(children):
+            if RequestedCount == 0:
+                return children[StartingIndex:]
+            return children[StartingIndex:StartingIndex + RequestedCount]
+
         def proceed(result):
-            if BrowseFlag == 'BrowseDirectChildren':
+            if BrowseFlag == 'BrowseDirectChildren' and sort:
+                d = self.get_sorted_children(str(ObjectID), result, sort)
+                d.addCallback(page)
+            elif(BrowseFlag == 'BrowseDirectChildren' and
+                 hasattr(result, 'get_children_items')):
+                # one call instead of one per child, mostly synchronous
+                r = result.get_children_items(StartingIndex, RequestedCount)
+                if not isinstance(r, defer.Deferred):
+                    return got_children_items(r)
+                r.addCallback(got_children_items)
+                r.addErrback(got_error)
+                return r
+            elif BrowseFlag == 'BrowseDirectChildren':
                 d = defer.maybeDeferred(result.get_children, StartingIndex, StartingIndex + RequestedCount)
             else:
                 d = defer.maybeDeferred(result.get_item)
@@ -288,6 +895,21 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
             d.addErrback(got_error)
             return d
 
+        def proceed_cached(result):
+            version = self.browse_cache_version(result)
+            if version is None:
+                return proceed(result)
+            key = (str(ObjectID), BrowseFlag, StartingIndex, RequestedCount,
+                   Filter, SortCriteria, kwargs.get('X_UPnPClient', ''))
+            response = self.browse_cache.get(key, version)
+            if response is not None:
+                return response
+            d = proceed(result)
+            if not isinstance(d, defer.Deferred):
+                return self.browse_cache.put(d, key, version)
+            d.addCallback(self.browse_cache.put, key, version)
+            return d
+
         root_id = ObjectID
 
         wmc_mapping = getattr(self.backend, "wmc_mapping", None)
@@ -324,12 +946,17 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
             else:
                 return proceed(item)
 
+        if self.browse_cache is not None:
+            proceed_found = proceed_cached
+        else:
+            proceed_found = proceed
+
         item = self.backend.get_by_id(root_id)
         if item == None:
             return failure.Failure(errorCode(701))
 
         if isinstance(item, defer.Deferred):
-            item.addCallback(proceed)
+            item.addCallback(proceed_found)
             return item
         else:
-            return proceed(item)
+            return proceed_found(item)
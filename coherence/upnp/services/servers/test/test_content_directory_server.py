@@ -14,6 +14,7 @@ import os
 
 from twisted.trial import unittest
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 
 from twisted.python.filepath import FilePath
 
@@ -21,9 +22,13 @@ from coherence import __version__
 from coherence.base import Coherence
 from coherence.upnp.core.uuid import UUID
 from coherence.upnp.devices.control_point import DeviceQuery
-from coherence.upnp.core import DIDLLite
+from coherence.upnp.core import DIDLLite, utils, sort_criteria
 import coherence.extern.louie as louie
 
+from coherence.upnp.services.servers import content_directory_server
+from coherence.upnp.services.servers.content_directory_server import \
+     ContentDirectoryServer, ResponseCache, ChangeJournal, state_event
+from coherence.backends.fs_storage import FSItem
 from coherence.test import wrapped
 
 class TestContentDirectoryServer(unittest.TestCase):
@@ -51,7 +56,7 @@ class TestContentDirectoryServer(unittest.TestCase):
                                'soap': 'error'},
              'controlpoint': 'yes'})
         self.uuid = str(UUID())
-        p = self.coherence.add_plugin('FSStore',
+        self.server = self.coherence.add_plugin('FSStore',
                                       name='MediaServer-%d' % os.getpid(),
                                       content=self.tmp_content.path,
                                       uuid=self.uuid,
@@ -246,3 +251,553 @@ class TestContentDirectoryServer(unittest.TestCase):
             DeviceQuery('uuid', self.uuid, the_result,
                         timeout=10, oneshot=True))
         return d
+
+
+    def test_Search(self):
+        """ searches the whole FSStore for audio items """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.search(container_id='0',
+                              criteria='upnp:class derivedfrom '
+                                       '"object.item.audioItem" and '
+                                       'dc:title contains "track-1"')
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            self.assertEqual(sorted(item.title for item in r),
+                             ['track-1.mp3', 'track-1.ogg'])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Search_Paged(self):
+        """ pages through the search results, searching only once
+            until the content changes
+        """
+        d = Deferred()
+        searches = []
+        search_items = ContentDirectoryServer.search_items
+
+        def counting_search_items(cds, container, expression):
+            searches.append(container)
+            return search_items(cds, container, expression)
+        self.patch(ContentDirectoryServer, 'search_items',
+                   counting_search_items)
+        criteria = 'upnp:class derivedfrom "object.item.audioItem"'
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.search('0', criteria, 0, 2)
+            call.addCallback(got_first_page, cdc)
+
+        @wrapped(d)
+        def got_first_page(r, cdc):
+            self.assertEqual(len(r), 2)
+            call = cdc.search('0', criteria, 2, 2)
+            call.addCallback(got_second_page, cdc, r)
+
+        @wrapped(d)
+        def got_second_page(r, cdc, first):
+            self.assertEqual(len(r), 2)
+            self.assertEqual(len(searches), 1)
+            self.assertEqual(len(set(i.id for i in first + r)), 4)
+            self.server.backend.get_by_id('1000').update_id += 1
+            call = cdc.search('0', criteria, 0, 2)
+            call.addCallback(got_changed)
+
+        @wrapped(d)
+        def got_changed(r):
+            self.assertEqual(len(searches), 2)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+    def test_Search_Invalid_Criteria(self):
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.search(container_id='0', criteria='dc:title like "x"')
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            """ the client turns errors into None, and no items """
+            self.assertEqual(r, [])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_GetSearchCapabilities(self):
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.get_search_capabilities()
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            caps = r['SearchCaps'].split(',')
+            self.assertIn('upnp:class', caps)
+            self.assertIn('dc:title', caps)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Browse_Sorted(self):
+        """ browses the content directory sorted by descending title,
+            twice, the second time from the sorted children kept
+        """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.browse(process_result=False)
+            call.addCallback(got_root, cdc)
+
+        @wrapped(d)
+        def got_root(r, cdc):
+            item = DIDLLite.DIDLElement.fromString(r['Result']).getItems()[0]
+            call = cdc.browse(object_id=item.id, sort_criteria='-dc:title',
+                              requested_count=2, process_result=False)
+            call.addCallback(got_first_page, cdc, item.id)
+
+        @wrapped(d)
+        def got_first_page(r, cdc, object_id):
+            self.assertEqual(int(r['TotalMatches']), 3)
+            items = DIDLLite.DIDLElement.fromString(r['Result']).getItems()
+            self.assertEqual([i.title for i in items], ['video', 'images'])
+            cds = self.server.content_directory_server
+            self.assertEqual(cds._sorted_children.keys(),
+                             [(object_id, '-dc:title')])
+            call = cdc.browse(object_id=object_id, sort_criteria='-dc:title',
+                              starting_index=2, requested_count=2,
+                              process_result=False)
+            call.addCallback(got_second_page)
+
+        @wrapped(d)
+        def got_second_page(r):
+            items = DIDLLite.DIDLElement.fromString(r['Result']).getItems()
+            self.assertEqual([i.title for i in items], ['audio'])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_sorted_children_versions(self):
+        """ sorted children are kept only for containers with an
+            update_id, and sorted again once SystemUpdateID changes
+        """
+        d = Deferred()
+        system_update_id = [1]
+
+        class Child(object):
+            def __init__(self, title):
+                self.item = DIDLLite.Item(title=title)
+            def get_item(self):
+                return self.item
+
+        class Container(object):
+            def __init__(self, *titles):
+                self.children = [Child(t) for t in titles]
+            def get_child_count(self):
+                return len(self.children)
+            def get_children(self, start, end):
+                return self.children
+
+        def titles(children):
+            return [c.item.title for c in children]
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cds = self.server.content_directory_server
+            self.patch(cds, 'get_system_update_id',
+                       lambda: system_update_id[0])
+            sort = sort_criteria.SortCriteria('+dc:title')
+            container = Container('b', 'a')
+            call = cds.get_sorted_children('1', container, sort)
+            call.addCallback(got_unversioned, cds, container, sort)
+
+        @wrapped(d)
+        def got_unversioned(children, cds, container, sort):
+            self.assertEqual(titles(children), ['a', 'b'])
+            self.assertEqual(cds._sorted_children.keys(), [])
+            container.update_id = 3
+            call = cds.get_sorted_children('1', container, sort)
+            call.addCallback(got_versioned, cds, container, sort)
+
+        @wrapped(d)
+        def got_versioned(children, cds, container, sort):
+            self.assertEqual(titles(children), ['a', 'b'])
+            self.assertEqual(len(cds._sorted_children), 1)
+            container.children[0].item.title = 'c'
+            system_update_id[0] = 2
+            call = cds.get_sorted_children('1', container, sort)
+            call.addCallback(got_changed)
+
+        @wrapped(d)
+        def got_changed(children):
+            self.assertEqual(titles(children), ['a', 'c'])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Browse_Invalid_Sort(self):
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.browse(sort_criteria='+dc:nothing',
+                              process_result=False)
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            self.assertIs(r, None)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Browse_Filter(self):
+        """ browses the root with a Filter, the result holds only
+            the required and requested properties
+        """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.browse(filter='@childCount', process_result=False)
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            element = utils.parse_xml(r['Result']).getroot()[0]
+            self.assertEqual(sorted(element.attrib),
+                             ['childCount', 'id', 'parentID', 'restricted'])
+            self.assertEqual(sorted(child.tag.split('}')[-1]
+                                    for child in element),
+                             ['class', 'title'])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Browse_Cached(self):
+        """ browses the root twice, the second response comes from
+            the cache, until the root changes
+        """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.browse(process_result=False)
+            call.addCallback(got_first_answer, cdc)
+
+        @wrapped(d)
+        def got_first_answer(r, cdc):
+            cache = self.server.content_directory_server.browse_cache
+            self.assertEqual(cache.counters['misses'], 1)
+            self.assertEqual(len(cache), 1)
+            call = cdc.browse(process_result=False)
+            call.addCallback(got_second_answer, cdc, r)
+
+        @wrapped(d)
+        def got_second_answer(r, cdc, first):
+            cache = self.server.content_directory_server.browse_cache
+            self.assertEqual(cache.counters['hits'], 1)
+            self.assertEqual(r['Result'], first['Result'])
+            self.server.backend.get_by_id('1000').update_id += 1
+            call = cdc.browse(process_result=False)
+            call.addCallback(got_third_answer)
+
+        @wrapped(d)
+        def got_third_answer(r):
+            cache = self.server.content_directory_server.browse_cache
+            self.assertEqual(cache.counters['hits'], 1)
+            self.assertEqual(cache.counters['misses'], 2)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Browse_Streamed(self):
+        """ browses with every response written while it is produced
+        """
+        d = Deferred()
+        self.patch(ContentDirectoryServer, 'stream_threshold', 1)
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.browse(process_result=False)
+            call.addCallback(got_root, cdc)
+
+        @wrapped(d)
+        def got_root(r, cdc):
+            self.assertEqual(int(r['NumberReturned']), 1)
+            item = DIDLLite.DIDLElement.fromString(r['Result']).getItems()[0]
+            call = cdc.browse(object_id=item.id, process_result=False)
+            call.addCallback(got_children)
+
+        @wrapped(d)
+        def got_children(r):
+            self.assertEqual(int(r['TotalMatches']), 3)
+            self.assertEqual(int(r['NumberReturned']), 3)
+            items = DIDLLite.DIDLElement.fromString(r['Result']).getItems()
+            self.assertEqual(sorted(i.title for i in items),
+                             ['audio', 'images', 'video'])
+            cache = self.server.content_directory_server.browse_cache
+            self.assertEqual(len(cache), 0)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+    def test_Browse_Without_Children_Items(self):
+        """ browses a backend without get_children_items, getting
+            every child on its own
+        """
+        get_children_items = FSItem.get_children_items
+        del FSItem.get_children_items
+        self.addCleanup(setattr, FSItem, 'get_children_items',
+                        get_children_items)
+        return self.test_Browse()
+
+    def test_content_changed(self):
+        """ adds a directory with two files, with one update of
+            SystemUpdateID and ContainerUpdateIDs for all of them
+        """
+        d = Deferred()
+        clock = Clock()
+        self.patch(content_directory_server, 'reactor', clock)
+        new = self.tmp_content.child('content').child('new')
+        new.makedirs()
+        new.child('track-1.mp3').touch()
+        new.child('track-2.mp3').touch()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cds = self.server.content_directory_server
+            store = self.server.backend
+            system_update_id = cds.get_variable('SystemUpdateID').value
+            root = store.get_by_id('1000')
+            store.walk(new.path, root, store.ignore_file_pattern)
+            self.assertEqual(store.update_id, system_update_id + 3)
+            self.assertEqual(cds.get_variable('SystemUpdateID').value,
+                             system_update_id)
+            self.assertEqual(cds.browse_cache_version(root),
+                             (root.update_id, store.update_id))
+            clock.advance(ContentDirectoryServer.update_interval)
+            self.assertEqual(cds.get_variable('SystemUpdateID').value,
+                             store.update_id)
+            value = cds.get_variable('ContainerUpdateIDs').value.split(',')
+            containers = dict(zip(value[::2], value[1::2]))
+            added = store.get_id_by_name('1000', new.path)
+            self.assertEqual(containers['1000'], str(root.update_id))
+            self.assertEqual(containers[added],
+                             str(store.get_by_id(added).update_id))
+            self.assertEqual(clock.getDelayedCalls(), [])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+    def test_GetChangesSince(self):
+        """ adds a directory with two files and gets the changes
+            since the update id before
+        """
+        d = Deferred()
+        clock = Clock()
+        self.patch(content_directory_server, 'reactor', clock)
+        new = self.tmp_content.child('content').child('new')
+        new.makedirs()
+        new.child('track-1.mp3').touch()
+        new.child('track-2.mp3').touch()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cds = self.server.content_directory_server
+            store = self.server.backend
+            since = cds.get_system_update_id()
+            store.walk(new.path, store.get_by_id('1000'),
+                       store.ignore_file_pattern)
+            clock.advance(ContentDirectoryServer.update_interval)
+            last_change = utils.parse_xml(
+                cds.get_variable('LastChange').value).getroot()
+            self.assertEqual(len(last_change), 3)
+            action = mediaserver.client.content_directory.service.get_action(
+                'X_GetChangesSince')
+            call = action.call(SinceUpdateID=str(since))
+            call.addCallback(got_changes, action, since)
+
+        @wrapped(d)
+        def got_changes(r, action, since):
+            store = self.server.backend
+            self.assertEqual(int(r['UpdateID']), store.update_id)
+            root = utils.parse_xml(r['Result']).getroot()
+            self.assertEqual(root.tag, '{urn:schemas-upnp-org:av:cds-event}'
+                                       'StateEvent')
+            self.assertEqual([e.tag.split('}')[1] for e in root],
+                             ['objAdd'] * 3)
+            self.assertEqual([int(e.get('updateID')) for e in root],
+                             range(since + 1, store.update_id + 1))
+            added = store.get_id_by_name('1000', new.path)
+            self.assertEqual(root[0].get('objID'), added)
+            self.assertEqual(root[0].get('objParentID'), '1000')
+            call = action.call(SinceUpdateID=str(since - 1))
+            call.addCallbacks(lambda r: d.errback(AssertionError(r)),
+                              got_error, errbackArgs=(action,))
+
+        @wrapped(d)
+        def got_error(f, action):
+            self.assertIn('800', str(f.value))
+            call = action.call(SinceUpdateID='yesterday')
+            call.addCallbacks(lambda r: d.errback(AssertionError(r)),
+                              got_invalid)
+
+        @wrapped(d)
+        def got_invalid(f):
+            self.assertIn('402', str(f.value))
+            cds = self.server.content_directory_server
+            missing = cds.upnp_X_GetChangesSince()
+            self.assertEqual(missing.value.status, 402)
+            # a change that wasn't recorded hides the ones before it
+            store = self.server.backend
+            since = store.update_id
+            store.update_id += 1
+            store.content_changed()
+            lost = cds.upnp_X_GetChangesSince(SinceUpdateID=str(since))
+            self.assertEqual(lost.value.status, 800)
+            r = cds.upnp_X_GetChangesSince(
+                SinceUpdateID=str(store.update_id))
+            self.assertEqual(len(utils.parse_xml(r['Result']).getroot()), 0)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+class TestChangeJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.journal = ChangeJournal(3)
+
+    def test_since(self):
+        self.assertIdentical(self.journal.since(0), None)
+        for update_id in (5, 6, 7):
+            self.journal.record(4, update_id, 'add', str(update_id), '0',
+                                'object.item')
+        self.assertEqual(self.journal.start, 4)
+        self.assertEqual([e[0] for e in self.journal.since(4)], [5, 6, 7])
+        self.assertEqual([e[0] for e in self.journal.since(6)], [7])
+        self.assertEqual(self.journal.since(7), [])
+        self.assertIdentical(self.journal.since(3), None)
+
+    def test_bounded(self):
+        for update_id in range(1, 6):
+            self.journal.record(0, update_id, 'modify', str(update_id))
+        self.assertEqual(len(self.journal), 3)
+        self.assertEqual(self.journal.start, 2)
+        self.assertIdentical(self.journal.since(1), None)
+        self.assertEqual([e[0] for e in self.journal.since(2)], [3, 4, 5])
+
+    def test_reset(self):
+        for update_id in (5, 6):
+            self.journal.record(4, update_id, 'add', str(update_id))
+        self.journal.reset(7)
+        self.assertEqual(len(self.journal), 0)
+        self.assertIdentical(self.journal.since(6), None)
+        self.assertEqual(self.journal.since(7), [])
+        self.journal.record(7, 8, 'remove', '5')
+        self.assertEqual([e[0] for e in self.journal.since(7)], [8])
+
+    def test_state_event(self):
+        entries = [(1, 'add', '10', '0', 'object.item'),
+                   (2, 'modify', '10', None, None),
+                   (3, 'remove', '10', None, None)]
+        root = utils.parse_xml(state_event(entries)).getroot()
+        ns = '{urn:schemas-upnp-org:av:cds-event}'
+        self.assertEqual([e.tag for e in root],
+                         [ns + 'objAdd', ns + 'objMod', ns + 'objDel'])
+        self.assertEqual(root[0].get('objClass'), 'object.item')
+        self.assertEqual(root[0].get('objParentID'), '0')
+        self.assertEqual(root[2].get('updateID'), '3')
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(10)
+
+    def test_versions(self):
+        response = {'Result': 'abc', 'TotalMatches': 1}
+        self.assertIdentical(self.cache.put(response, 'key', 1), response)
+        self.assertEqual(self.cache.get('key', 1), response)
+        self.assertIdentical(self.cache.get('key', 2), None)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.cache.hit_rate(), 0.5)
+
+    def test_bounded_by_bytes(self):
+        for key in 'abc':
+            self.cache.put({'Result': 'x' * 4}, key, 1)
+        self.assertEqual(self.cache.size, 8)
+        self.assertIdentical(self.cache.get('a', 1), None)
+        self.assertEqual(self.cache.counters['evictions'], 1)
+        # using b leaves c the oldest
+        self.cache.get('b', 1)
+        self.cache.put({'Result': 'x' * 4}, 'd', 1)
+        self.assertIdentical(self.cache.get('c', 1), None)
+        self.assertNotIdentical(self.cache.get('b', 1), None)
+        self.cache.put({'Result': 'x' * 11}, 'e', 1)
+        self.assertIdentical(self.cache.get('e', 1), None)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# http_parser.py
+#
+# micro-benchmark of coherence.upnp.core.utils.parse_http_response
+# over a corpus of SSDP and GENA packets as seen on real networks,
+# compared with the former implementation
+#
+# usage: http_parser.py [number of rounds]
+#
+
+import sys
+import timeit
+
+from coherence.upnp.core import utils
+
+CORPUS = [
+    # NOTIFY alive, Windows Media Player
+    ('NOTIFY * HTTP/1.1\r\n'
+     'Host:239.255.255.250:1900\r\n'
+     'NT:upnp:rootdevice\r\n'
+     'NTS:ssdp:alive\r\n'
+     'Location:http://10.10.222.94:2869/upnp?content=uuid:e711a4bf\r\n'
+     'USN:uuid:e711a4bf::upnp:rootdevice\r\n'
+     'Cache-Control:max-age=1800\r\n'
+     'Server:Microsoft-Windows-NT/5.1 UPnP/1.0 UPnP-Device-Host/1.0\r\n'
+     '\r\n'),
+    # NOTIFY alive, MiniDLNA
+    ('NOTIFY * HTTP/1.1\r\n'
+     'HOST: 239.255.255.250:1900\r\n'
+     'CACHE-CONTROL: max-age=1810\r\n'
+     'LOCATION: http://192.168.1.5:8200/rootDesc.xml\r\n'
+     'SERVER: 3.2.0 DLNADOC/1.50 UPnP/1.0 MiniDLNA/1.1.0\r\n'
+     'NT: urn:schemas-upnp-org:service:ContentDirectory:1\r\n'
+     'USN: uuid:4d696e69-444c-164e-9d41-b827eb1e8fbc::'
+     'urn:schemas-upnp-org:service:ContentDirectory:1\r\n'
+     'NTS: ssdp:alive\r\n'
+     '\r\n'),
+    # NOTIFY alive, UDA 1.1 renderer
+    ('NOTIFY * HTTP/1.1\r\n'
+     'HOST: 239.255.255.250:1900\r\n'
+     'CACHE-CONTROL: max-age=900\r\n'
+     'LOCATION: http://192.168.1.12:1400/xml/device_description.xml\r\n'
+     'NT: urn:schemas-upnp-org:device:ZonePlayer:1\r\n'
+     'NTS: ssdp:alive\r\n'
+     'SERVER: Linux UPnP/1.0 Sonos/29.3-87071 (ZPS1)\r\n'
+     'USN: uuid:RINCON_000E58123456701400::'
+     'urn:schemas-upnp-org:device:ZonePlayer:1\r\n'
+     'X-RINCON-HOUSEHOLD: Sonos_abcdefghijklmnop\r\n'
+     'X-RINCON-BOOTSEQ: 42\r\n'
+     'BOOTID.UPNP.ORG: 42\r\n'
+     'CONFIGID.UPNP.ORG: 1\r\n'
+     '\r\n'),
+    # NOTIFY byebye
+    ('NOTIFY * HTTP/1.1\r\n'
+     'HOST: 239.255.255.250:1900\r\n'
+     'NT: urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+     'NTS: ssdp:byebye\r\n'
+     'USN: uuid:5f9ec1b3-ed59-1900-4530-00a0de8b7d3e::'
+     'urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+     '\r\n'),
+    # M-SEARCH, Samsung TV
+    ('M-SEARCH * HTTP/1.1\r\n'
+     'HOST: 239.255.255.250:1900\r\n'
+     'MAN: "ssdp:discover"\r\n'
+     'MX: 2\r\n'
+     'ST: urn:schemas-upnp-org:device:MediaServer:1\r\n'
+     'USER-AGENT: DLNADOC/1.50 SEC_HHP_[TV]UE40D7000/1.0 UPnP/1.0\r\n'
+     '\r\n'),
+    # M-SEARCH, Coherence
+    ('M-SEARCH * HTTP/1.1\r\n'
+     'HOST: 239.255.255.250:1900\r\n'
+     'MAN: "ssdp:discover"\r\n'
+     'MX: 5\r\n'
+     'ST: ssdp:all\r\n'
+     '\r\n'),
+    # 200 OK, Squeezebox Server
+    ('HTTP/1.1 200 OK\r\n'
+     'Cache-Control: max-age=1800\r\n'
+     'Date: Mon, 02 Jun 2014 18:04:59 GMT\r\n'
+     'Ext: \r\n'
+     'Location: http://192.168.1.4:9000/plugins/UPnP/MediaServer.xml\r\n'
+     'Server: Linux/armv5-linux UPnP/1.0 DLNADOC/1.50 MediaServer/7.3/735\r\n'
+     'ST: urn:microsoft.com:service:X_MS_MediaReceiverRegistrar:1\r\n'
+     'USN: uuid:DDF542FB-A291-4AD0-A0C5-F7129B9D4422::'
+     'urn:microsoft.com:service:X_MS_MediaReceiverRegistrar:1\r\n'
+     '\r\n'),
+    # 200 OK, Fritz!Box
+    ('HTTP/1.1 200 OK\r\n'
+     'LOCATION: http://192.168.178.1:49000/igddesc.xml\r\n'
+     'SERVER: FRITZ!Box 7490 UPnP/1.0 AVM FRITZ!Box 7490 113.06.30\r\n'
+     'CACHE-CONTROL: max-age=1800\r\n'
+     'EXT:\r\n'
+     'ST: upnp:rootdevice\r\n'
+     'USN: uuid:75802409-bccb-40e7-8e6c-989BCB2B93B0::upnp:rootdevice\r\n'
+     '\r\n'),
+    # GENA SUBSCRIBE reply
+    ('HTTP/1.1 200 OK\r\n'
+     'DATE: Tue, 03 Jun 2014 08:12:31 GMT\r\n'
+     'SERVER: Linux/2.6 UPnP/1.0 DLNADOC/1.50 Platinum/1.0.4.2\r\n'
+     'SID: uuid:4e2f1e4a-e87a-11e3-8d8b-00218638ac9b\r\n'
+     'TIMEOUT: Second-1800\r\n'
+     'Content-Length: 0\r\n'
+     '\r\n'),
+    ]
+
+
+def legacy_parse_http_response(data):
+    try:
+        header, content = data.split('\r\n\r\n')[0]
+    except ValueError:
+        header = data.strip()
+        content = ''
+    lines = header.splitlines()
+    cmd = lines.pop(0).split(None, 2)
+    lines = (l.split(':', 1) for l in lines if l)
+    headers = dict((h.strip().lower(), d.strip())
+                   for (h, d) in lines)
+    return cmd, headers, content
+
+
+def run(parser, corpus=CORPUS):
+    for data in corpus:
+        parser(data)
+
+
+def main(number=20000):
+    for data in CORPUS:
+        # both agree on the request line and the header fields
+        assert (utils.parse_http_response(data)[:2] ==
+                tuple(legacy_parse_http_response(data)[:2])), data
+    results = {}
+    for name, parser in (('legacy', legacy_parse_http_response),
+                         ('parse_http_response', utils.parse_http_response)):
+        timer = timeit.Timer(lambda: run(parser))
+        best = min(timer.repeat(3, number))
+        per_packet = best / (number * len(CORPUS)) * 1e6
+        results[name] = per_packet
+        print '%-20s %6.2f us/packet' % (name, per_packet)
+    print 'speedup %.2fx' % (results['legacy'] /
+                             results['parse_http_response'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
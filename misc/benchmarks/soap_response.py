@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# soap_response.py
+#
+# micro-benchmark of coherence.upnp.core.soap_lite.build_soap_response
+# on Browse responses of 10, 100 and 1000 items, compared with
+# serializing them via build_soap_call
+#
+# usage: soap_response.py [number of rounds]
+#
+
+import sys
+import timeit
+
+from twisted.python.util import OrderedDict
+
+from coherence.upnp.core import DIDLLite, soap_lite
+
+BROWSE = '{urn:schemas-upnp-org:service:ContentDirectory:1}Browse'
+
+
+def browse_result(count):
+    didl = DIDLLite.DIDLElement()
+    for i in range(count):
+        item = DIDLLite.MusicTrack('%d' % (i + 1000), '1000',
+                                   'Track %d & friends' % i)
+        item.artist = 'Some Artist'
+        item.album = 'Some Album'
+        item.albumArtURI = 'http://192.168.1.5:30020/cover/%d.jpg' % i
+        item.res.append(DIDLLite.Resource(
+            'http://192.168.1.5:30020/%d.mp3' % i,
+            'http-get:*:audio/mpeg:DLNA.ORG_PN=MP3;DLNA.ORG_OP=01'))
+        didl.addItem(item)
+    return OrderedDict([('Result', didl.toString()),
+                        ('NumberReturned', count),
+                        ('TotalMatches', count),
+                        ('UpdateID', 0)])
+
+
+def build_soap_call(method, arguments):
+    return soap_lite.build_soap_call(method, arguments, is_response=True,
+                                     encoding=None)
+
+
+def main(number=200):
+    for count in (10, 100, 1000):
+        result = browse_result(count)
+        assert (soap_lite.build_soap_response(BROWSE, result) ==
+                build_soap_call(BROWSE, result))
+        rounds = max(1, number * 10 / count)
+        results = {}
+        for name, serializer in (
+                ('build_soap_call', build_soap_call),
+                ('build_soap_response', soap_lite.build_soap_response)):
+            timer = timeit.Timer(lambda: serializer(BROWSE, result))
+            best = min(timer.repeat(3, rounds))
+            per_response = best / rounds * 1e3
+            results[name] = per_response
+            print '%4d items %-20s %8.3f ms/response' % (count, name,
+                                                         per_response)
+        print '%4d items speedup %.2fx' % (count,
+                                           results['build_soap_call'] /
+                                           results['build_soap_response'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()